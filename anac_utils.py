@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Caricamento in streaming dei dump open data ANAC (dataset CIG, aggiudicazioni, ...) da file locale.
+
+I dump sono CSV o JSON da più GB (anche compressi .zip/.gz): qui non si usa pandas, le righe vengono
+lette una alla volta (CSV riga per riga, JSON decodificato un oggetto alla volta), mappate sulle
+colonne di 'gare', filtrate per categorie/regioni e scritte a lotti in una tabella di staging;
+la promozione in 'gare' è quella di import_utils (CIG ripetuti o già presenti saltati).
+
+    anac_utils.stream_import("cig_2024.zip", categorie=['OG1', 'OG3'], regioni=['Lombardia'])
+"""
+import io
+import os
+import csv
+import gzip
+import json
+import math
+import time
+import logging
+import zipfile
+import datetime
+import itertools
+from contextlib import contextmanager, ExitStack
+
+import db_utils
+import import_utils
+import trace_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
+
+DUMP_EXTENSIONS = ('.csv', '.json', '.jsonl', '.ndjson')
+READ_CHUNK_CHARS = 1 << 20 # Caratteri letti per volta dai dump JSON
+STAGING_BATCH_ROWS = 50000 # Righe scritte in staging per transazione
+PROGRESS_SECONDS = 10 # Intervallo minimo tra i messaggi di avanzamento
+
+# Campi ANAC (in minuscolo) -> colonne di 'gare': vale il primo campo non vuoto dell'elenco.
+# Tra dataset diversi (CIG, aggiudicazioni, categorie opera) i nomi cambiano, per questo più candidati.
+FIELD_MAPPING = {
+    'identificativo_gara': ['cig'],
+    'descrizione': ['oggetto_lotto', 'oggetto_gara', 'oggetto'],
+    'data_gara': ['data_pubblicazione', 'data_aggiudicazione_definitiva', 'data_comunicazione_esito'],
+    'importo_base': ['importo_lotto', 'importo_complessivo_gara', 'importo_base_asta'],
+    'categoria_lavori': ['id_categoria', 'categoria_prevalente', 'cod_categoria'],
+    'stazione_appaltante': ['denominazione_amministrazione_appaltante', 'denominazione_centro_costo', 'stazione_appaltante'],
+    'ribasso_aggiudicatario_percentuale': ['ribasso_aggiudicazione', 'ribasso_aggiudicatario'],
+    'importo_aggiudicazione': ['importo_aggiudicazione'],
+    'numero_concorrenti': ['numero_offerte_ammesse', 'numero_offerte'],
+}
+REGION_FIELDS = ['sezione_regionale', 'regione', 'provincia']
+NUMBER_COLUMNS = ['importo_base', 'ribasso_aggiudicatario_percentuale', 'importo_aggiudicazione']
+
+class AnacError(Exception):
+    """Dump non leggibile (formato non supportato, archivio senza CSV/JSON, JSON malformato)."""
+
+# --- Lettura in streaming ---
+@contextmanager
+def open_dump(path):
+    """Apre il dump (anche dentro .zip o .gz) come testo UTF-8; produce (formato, stream) con formato 'csv' o 'json'."""
+    lower = path.lower()
+    with ExitStack() as stack:
+        if lower.endswith('.zip'):
+            archive = stack.enter_context(zipfile.ZipFile(path))
+            members = [info.filename for info in archive.infolist() if not info.is_dir() and info.filename.lower().endswith(DUMP_EXTENSIONS)]
+            if not members: raise AnacError(f"{os.path.basename(path)}: nessun file CSV o JSON nell'archivio.")
+            if len(members) > 1: logger.warning("%s: più file nell'archivio, letto solo '%s'.", os.path.basename(path), members[0])
+            name, raw = members[0], stack.enter_context(archive.open(members[0]))
+        elif lower.endswith('.gz'):
+            name, raw = path[:-3], stack.enter_context(gzip.open(path, 'rb'))
+        else:
+            name, raw = path, stack.enter_context(open(path, 'rb'))
+        if not name.lower().endswith(DUMP_EXTENSIONS):
+            raise AnacError(f"{os.path.basename(name)}: formato non supportato (attesi {', '.join(DUMP_EXTENSIONS)}).")
+        stream = stack.enter_context(io.TextIOWrapper(raw, encoding='utf-8-sig', errors='replace', newline=''))
+        yield ('csv' if name.lower().endswith('.csv') else 'json'), stream
+
+def iter_csv(stream):
+    """Dizionari per riga con chiavi in minuscolo; separatore ';' o ',' dedotto dall'intestazione."""
+    header = stream.readline()
+    delimiter = ';' if header.count(';') >= header.count(',') else ','
+    reader = csv.reader(itertools.chain([header], stream), delimiter=delimiter)
+    keys = [key.strip().lower() for key in next(reader, [])]
+    for values in reader:
+        if values: yield dict(zip(keys, values))
+
+def iter_json(stream, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Oggetti di un dump JSON decodificati uno alla volta: array di oggetti ([{...}, {...}]) letto
+    a blocchi di chunk_chars caratteri, oppure JSON Lines (un oggetto per riga).
+    """
+    buffer = stream.read(chunk_chars).lstrip()
+    if not buffer.startswith('['): # JSON Lines
+        for line in _lines(buffer, stream, chunk_chars):
+            if line.strip():
+                try: yield json.loads(line)
+                except json.JSONDecodeError as e: raise AnacError(f"Riga JSON non valida: {e}") from e
+        return
+    decoder, pos, eof = json.JSONDecoder(), 1, False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,': pos += 1
+        if pos >= len(buffer):
+            if eof: raise AnacError("Dump JSON troncato: manca la ']' finale.")
+            buffer, pos = stream.read(chunk_chars), 0; eof = not buffer; continue
+        if buffer[pos] == ']': return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e: # Oggetto a cavallo del blocco: si legge il blocco successivo e si riprova
+            more = '' if eof else stream.read(chunk_chars)
+            if not more: raise AnacError(f"Dump JSON non valido: {e}") from e
+            buffer, pos = buffer[pos:] + more, 0; continue
+        yield item
+
+def _lines(text, stream, chunk_chars):
+    """Righe complete del testo già letto più il resto dello stream."""
+    while True:
+        more = stream.read(chunk_chars)
+        if not more: # Ultimo blocco: anche l'ultima riga (o l'intero dump, se più corto di un blocco) va divisa
+            yield from text.split('\n'); return
+        *complete, text = (text + more).split('\n')
+        yield from complete
+
+def iter_records(path):
+    """Record del dump (dizionari con chiavi in minuscolo), senza caricare il file in memoria."""
+    with open_dump(path) as (fmt, stream):
+        if fmt == 'csv':
+            yield from iter_csv(stream)
+        else:
+            for item in iter_json(stream):
+                if isinstance(item, dict): yield {str(k).strip().lower(): v for k, v in item.items()}
+
+# --- Mappatura e filtri ---
+def _to_number(value):
+    """
+    Numero da valore ANAC ('1234.56', '1.234,56', '1.234.567', '15,3 %'); None se vuoto o non numerico.
+    Un solo punto senza virgola è sempre il separatore decimale ('1.234' -> 1.234): nei dump ANAC gli
+    importi sono scritti col punto decimale; più punti senza virgola sono separatori delle migliaia.
+    """
+    if value is None or isinstance(value, (int, float)): return value
+    try: number = float(value) # Caso più comune nei dump: '1234.56'
+    except ValueError:
+        text = str(value).replace('€', '').replace('%', '').replace(' ', '').strip()
+        if text.rfind(',') > text.rfind('.'): text = text.replace('.', '').replace(',', '.') # Il separatore più a destra è il decimale
+        elif ',' not in text and text.count('.') > 1: text = text.replace('.', '') # '1.234.567': solo migliaia
+        else:
+            head, dot, tail = text.replace(',', '').rpartition('.')
+            text = head.replace('.', '') + dot + tail
+        try: number = float(text)
+        except ValueError: return None
+    return number if math.isfinite(number) else None # 'nan' / 'inf' testuali
+
+def _to_date(value):
+    """Data 'YYYY-MM-DD' da ISO (anche con ora) o GG/MM/AAAA; None se non riconosciuta."""
+    text = str(value or '').strip()[:10]
+    try: return datetime.date.fromisoformat(text).isoformat() # Molto più veloce di strptime
+    except ValueError: pass
+    try: return datetime.datetime.strptime(text, "%d/%m/%Y").strftime(import_utils.DATE_FORMAT_STR)
+    except ValueError: return None
+
+def _first(record, fields):
+    for field in fields:
+        value = record.get(field)
+        if value not in (None, ''): return value.strip() if isinstance(value, str) else value
+    return None
+
+def map_record(record, categorie=None, regioni=None) -> dict | None:
+    """
+    Record ANAC -> dizionario con le colonne di 'gare', o None se escluso dai filtri: categorie
+    (codici come 'OG1', confronto esatto) e regioni (contenute nella sezione regionale/regione/provincia,
+    es. 'LOMBARDIA' in 'SEZIONE REGIONALE LOMBARDIA'). Con un filtro attivo, i record senza il campo sono esclusi.
+    """
+    categoria = _first(record, FIELD_MAPPING['categoria_lavori'])
+    if categorie and str(categoria or '').upper() not in categorie: return None # Filtri prima della mappatura: la maggior parte dei record è scartata qui
+    region = _first(record, REGION_FIELDS)
+    if regioni and not any(r in str(region or '').upper() for r in regioni): return None
+    row = {col: _first(record, fields) for col, fields in FIELD_MAPPING.items()}
+    for col in NUMBER_COLUMNS: row[col] = _to_number(row[col])
+    concorrenti = _to_number(row['numero_concorrenti'])
+    row['numero_concorrenti'] = int(concorrenti) if concorrenti is not None else None
+    row['data_gara'] = _to_date(row['data_gara'])
+    row['note'] = f"ANAC open data - {region}" if region else "ANAC open data"
+    return row
+
+# --- Importazione ---
+def stream_import(path, categorie=None, regioni=None) -> dict:
+    """
+    Legge il dump in streaming, tiene i record che passano i filtri e li scrive in staging a lotti di
+    STAGING_BATCH_ROWS (transazioni brevi), poi li importa con import_utils.import_staged.
+    Ritorna il risultato di import_staged con 'lette', 'corrispondenti', 'secondi_lettura' e 'righe_al_secondo'.
+    Solleva AnacError (dump non leggibile) o db_utils.DatabaseError.
+    """
+    categorie = {c.strip().upper() for c in categorie or [] if c.strip()}
+    regioni = {r.strip().upper() for r in regioni or [] if r.strip()}
+    stats = {'lette': 0, 'corrispondenti': 0}
+    start = time.perf_counter()
+
+    def matching():
+        for record in iter_records(path):
+            stats['lette'] += 1
+            row = map_record(record, categorie, regioni)
+            if row is None: continue
+            stats['corrispondenti'] += 1
+            if not stats['corrispondenti'] % 1000:
+                log_utils.rate_limited(logger, ('anac', path), PROGRESS_SECONDS, logging.INFO, "%s: %d righe lette, %d corrispondenti (%.0f righe/s).",
+                                       os.path.basename(path), stats['lette'], stats['corrispondenti'], stats['lette'] / (time.perf_counter() - start))
+            yield row
+
+    name = db_utils.create_staging()
+    try:
+        with trace_utils.span('anac.lettura', file=os.path.basename(path)):
+            rows = matching()
+            while True:
+                batch = list(itertools.islice(rows, STAGING_BATCH_ROWS))
+                if not batch: break
+                db_utils.append_staging(name, batch, stats['corrispondenti'] - len(batch) + 1)
+    except BaseException:
+        db_utils.drop_staging(name); raise
+    elapsed = time.perf_counter() - start
+    stats.update(secondi_lettura=elapsed, righe_al_secondo=stats['lette'] / elapsed if elapsed else 0.0)
+    logger.info("%s: %d righe lette in %.1f s (%.0f righe/s), %d corrispondenti ai filtri.", os.path.basename(path),
+                stats['lette'], elapsed, stats['righe_al_secondo'], stats['corrispondenti'], extra={k: v for k, v in stats.items() if k != 'secondi_lettura'})
+    trace_utils.count('anac.righe_lette', stats['lette'])
+    result = import_utils.import_staged({'tabella': name, 'righe': stats['corrispondenti']})
+    return {**result, **stats}
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Elaborazioni della dashboard (conversione tipi, filtri, analisi per segmenti) senza interfaccia.
+
+Le funzioni ricevono e ritornano DataFrame: l'app si occupa solo di widget e messaggi,
+la CLI e i benchmark le usano direttamente.
+"""
+import numpy as np
+import pandas as pd
+
+import trace_utils
+
+NUMERIC_COLUMNS = ['importo_base', 'mio_ribasso_percentuale', 'importo_offerto', 'soglia_anomalia_calcolata',
+                   'ribasso_aggiudicatario_percentuale', 'importo_aggiudicazione']
+INTEGER_COLUMNS = ['numero_concorrenti', 'posizione_in_graduatoria']
+
+# --- Segmenti ---
+SEGMENTO_CATEGORIA = "Categoria Lavori"
+SEGMENTO_IMPORTO = "Fascia Importo"
+SEGMENT_COLUMN = 'segmento' # Nome colonna standard per il raggruppamento
+IMPORTO_BINS = [-np.inf, 50000, 150000, 500000, 1000000, 5000000, np.inf]
+IMPORTO_LABELS = ["<50k", "50k-150k", "150k-500k", "500k-1M", "1M-5M", ">5M"]
+SEGMENT_DISPLAY_COLUMNS = ['Num. Gare', 'Vinte', 'Partecipate (A/P)', 'Win Rate (%)',
+                           'Tuo Rib. Medio %', 'Agg. Rib. Medio %', 'Soglia Media %', 'Num. Conc. Medio']
+
+def normalize_types(df: pd.DataFrame) -> pd.DataFrame:
+    """Riassicura i tipi dopo la lettura dal DB (date, numerici, interi con NaN come Int64). Modifica df sul posto."""
+    for col in ['data_gara', 'data_inserimento']:
+        if col in df.columns: df[col] = pd.to_datetime(df[col], errors='coerce')
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in INTEGER_COLUMNS:
+        if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
+    return df
+
+@trace_utils.traced('analisi.filtri')
+def apply_filters(df: pd.DataFrame, date_range=None, categoria="Tutte", esito="Tutti", importo_range=None) -> pd.DataFrame:
+    """
+    Applica i filtri della dashboard; None / "Tutte" / "Tutti" = filtro non attivo.
+    I filtri si combinano in un'unica maschera booleana e le righe si selezionano una volta sola;
+    senza filtri attivi ritorna df stesso (nessuna copia): il risultato va trattato in sola lettura.
+    """
+    mask = None
+    def combine(condition):
+        nonlocal mask
+        mask = condition if mask is None else mask & condition
+    if date_range:
+        combine(df['data_gara'].between(date_range[0], date_range[1])) # NaT escluse
+    if categoria and categoria != "Tutte":
+        combine(df['categoria_lavori'] == categoria)
+    if esito and esito != "Tutti":
+        combine(df['esito'] == esito)
+    if importo_range:
+        combine(df['importo_base'].between(importo_range[0], importo_range[1])) # NaN escluse
+    return df if mask is None else df[mask.fillna(False).to_numpy(dtype=bool)]
+
+def add_segment_column(df: pd.DataFrame, segment_type: str) -> pd.DataFrame:
+    """Copia di df con la colonna 'segmento'. Solleva ValueError (messaggio per l'utente) se non è possibile segmentare."""
+    df_segmented = df.copy()
+    if segment_type == SEGMENTO_CATEGORIA:
+        if 'categoria_lavori' not in df_segmented.columns or not df_segmented['categoria_lavori'].notna().any():
+            raise ValueError("Colonna 'categoria_lavori' non disponibile o vuota nei dati filtrati per segmentare.")
+        # Riempi NaN con "Non Specificata" e assicurati sia stringa (anche se la colonna è categorica)
+        df_segmented[SEGMENT_COLUMN] = df_segmented['categoria_lavori'].astype(object).fillna("Non Specificata").astype(str)
+    elif segment_type == SEGMENTO_IMPORTO:
+        if 'importo_base' not in df_segmented.columns or not df_segmented['importo_base'].notna().any():
+            raise ValueError("Colonna 'importo_base' non disponibile o vuota nei dati filtrati per segmentare per fascia.")
+        # right=False include il limite inferiore
+        df_segmented[SEGMENT_COLUMN] = pd.cut(df_segmented['importo_base'], bins=IMPORTO_BINS, labels=IMPORTO_LABELS, right=False)
+    else:
+        raise ValueError(f"Tipo di segmentazione sconosciuto: {segment_type}")
+    return df_segmented
+
+@trace_utils.traced('analisi.segmenti')
+def segment_stats(df: pd.DataFrame, segment_type: str) -> pd.DataFrame:
+    """Statistiche per segmento (gare, vinte, win rate, ribassi e soglia medi) indicizzate per 'segmento'."""
+    df_segmented = add_segment_column(df, segment_type)
+    agg_funcs = {
+        'id': 'size', # Conteggio gare totali per segmento
+        'mio_ribasso_percentuale': 'mean',
+        'ribasso_aggiudicatario_percentuale': 'mean',
+        'soglia_anomalia_calcolata': 'mean',
+        'numero_concorrenti': 'mean'
+    }
+    # observed=False include tutte le categorie (anche quelle vuote nei dati filtrati, se create da pd.cut)
+    stats = df_segmented.groupby(SEGMENT_COLUMN, observed=False).agg(agg_funcs).rename(columns={'id': 'Num. Gare'})
+
+    # Vinte e Partecipate (con esito A/P) per il Win Rate
+    wins = df_segmented[df_segmented['esito'] == 'Aggiudicata'].groupby(SEGMENT_COLUMN, observed=False).size().rename("Vinte")
+    partecipate = df_segmented[df_segmented['esito'].isin(['Aggiudicata', 'Persa'])].groupby(SEGMENT_COLUMN, observed=False).size().rename("Partecipate (A/P)")
+    stats = stats.join(wins, how='left').join(partecipate, how='left').fillna(0)
+    stats[['Vinte', 'Partecipate (A/P)']] = stats[['Vinte', 'Partecipate (A/P)']].astype(int)
+    stats['Win Rate (%)'] = ((stats['Vinte'] / stats['Partecipate (A/P)']) * 100).where(stats['Partecipate (A/P)'] > 0, 0)
+
+    stats = stats.rename(columns={
+        'mio_ribasso_percentuale': 'Tuo Rib. Medio %',
+        'ribasso_aggiudicatario_percentuale': 'Agg. Rib. Medio %',
+        'soglia_anomalia_calcolata': 'Soglia Media %',
+        'numero_concorrenti': 'Num. Conc. Medio'
+    })
+    return stats[[col for col in SEGMENT_DISPLAY_COLUMNS if col in stats.columns]]
+
+def memory_report(df: pd.DataFrame) -> pd.DataFrame:
+    """Memoria occupata per colonna (byte effettivi, stringhe comprese), dalla più pesante."""
+    usage = df.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({'colonna': usage.index, 'tipo': [str(df[col].dtype) for col in usage.index], 'kb': usage.to_numpy() / 1024})
+    return report.sort_values('kb', ascending=False, ignore_index=True)
@@ -1,10 +1,8 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 from io import BytesIO
 import datetime
-import traceback
 import os
 import numpy as np
 
@@ -14,6 +12,23 @@ st.set_page_config(page_title="Analisi Gare Appalto v1.7", layout="wide", initia
 # Importa moduli custom
 import db_utils
 import ml_utils
+import job_utils
+import model_store_utils
+import feature_store_utils
+import similarity_utils
+import import_utils
+import analysis_utils
+import cache_utils
+import trace_utils
+import log_utils
+
+logger = log_utils.get_logger('app')
+
+# I moduli core non dipendono da Streamlit: nell'app le loro cache usano st.cache_data/st.cache_resource
+cache_utils.set_backend(cache_utils.streamlit_backend)
+
+# Tempi per sezione di questo rerun (pannello "Tempi di esecuzione" nella sidebar); disattivato = nessuna misura
+trace_utils.start_run("rerun", enabled=st.session_state.get('trace_enabled', False))
 
 # --- Costanti di Formattazione ---
 # Usate per input e logica interna (standard float)
@@ -31,7 +46,6 @@ DATE_DISPLAY_FORMAT = "DD/MM/YYYY" # Formato display date-only
 
 # --- Gestione Stato Sessione ---
 # (Stato Sessione INVARIATO)
-if 'refresh_data' not in st.session_state: st.session_state.refresh_data = 0
 form_widget_keys = ["widget_identificativo_gara", "widget_descrizione", "widget_data_gara", "widget_importo_base", "widget_categoria_lavori", "widget_stazione_appaltante", "widget_mio_ribasso_percentuale", "widget_soglia_anomalia_calcolata", "widget_ribasso_aggiudicatario_percentuale", "widget_numero_concorrenti", "widget_posizione_in_graduatoria", "widget_esito", "widget_note"]
 default_form_values = {"widget_identificativo_gara": "", "widget_descrizione": "", "widget_data_gara": None, "widget_importo_base": None, "widget_categoria_lavori": "", "widget_stazione_appaltante": "", "widget_mio_ribasso_percentuale": None, "widget_soglia_anomalia_calcolata": None, "widget_ribasso_aggiudicatario_percentuale": None, "widget_numero_concorrenti": None, "widget_posizione_in_graduatoria": None, "widget_esito": "", "widget_note": ""}
 for key in form_widget_keys:
@@ -43,193 +57,119 @@ for key in edit_form_keys:
     if key not in st.session_state: st.session_state[key] = None
 if 'edit_form_reset_needed' not in st.session_state: st.session_state.edit_form_reset_needed = False
 
-def trigger_data_refresh():
-    st.session_state.refresh_data += 1
-    db_utils.clear_all_cache()
+def load_gare():
+    """Tutte le gare (cache di db_utils); in caso di errore lo mostra e ritorna un DataFrame vuoto."""
+    try:
+        return db_utils.get_all_gare() # Si rinnova da sola quando cambia la versione dei dati
+    except db_utils.DatabaseError as e:
+        st.error(str(e)); return pd.DataFrame(columns=db_utils.EXPECTED_COLUMNS)
 
 # --- Funzioni App ---
-#@st.cache_data # Caching può essere utile ma attenti con oggetti file
-def load_data_from_file(uploaded_file):
-    """Carica dati da file CSV o Excel, pulisce e mappa le colonne."""
+# Messaggi di import_utils -> componenti Streamlit
+ST_REPORT = {'info': st.write, 'success': st.success, 'warning': st.warning, 'error': st.error}
+
+def load_data_from_files(uploaded_files):
+    """
+    Carica dati da uno o più file CSV/Excel o archivi ZIP, pulisce e mappa le colonne (logica in
+    import_utils, più file letti in parallelo), poi li scrive in un'unica tabella di staging validata
+    in SQL. I file già importati (stessa impronta) vengono saltati. Ritorna il riepilogo dello staging
+    (None se non resta niente da importare): i DataFrame non restano nello stato sessione.
+    """
+    report = lambda level, message: ST_REPORT[level](message)
+    files = import_utils.expand_archives([(f.name, f.getvalue()) for f in uploaded_files], report=report)
+    force = st.session_state.get('force_reimport_sidebar')
+    to_load, fingerprints, seen, journals = [], [], set(), {}
+    for name, data in files:
+        fingerprint = import_utils.file_fingerprint(BytesIO(data))
+        if fingerprint in seen:
+            st.info(f"{name}: stesso contenuto di un altro file caricato, ignorato."); continue
+        seen.add(fingerprint)
+        try: journal = import_utils.import_status(fingerprint)
+        except db_utils.DatabaseError as e: st.warning(str(e)); journal = None
+        if journal and journal['stato'] == 'completato' and not force:
+            st.info(f"{name}: già importato il {journal['aggiornato']} ({journal['importate']} gare importate, {journal['saltate']} saltate), "
+                    "nessuna riga da processare. Per ripeterlo attiva 'Reimporta file già importati'.")
+            continue
+        to_load.append((name, data)); fingerprints.append(fingerprint); journals[fingerprint] = journal
+    if not to_load: return None
+
+    loaded = import_utils.load_many(to_load, fingerprints)
+    del files, to_load
+    mappings = {} # Una revisione per firma delle intestazioni (file con le stesse colonne condividono il profilo)
+    for item in loaded:
+        if item.get('mappatura'):
+            info = mappings.setdefault(item['mappatura']['firma'], {**item['mappatura'], 'file': []})
+            info['file'].append(item['path'])
+    st.session_state.upload_mappings_sidebar = list(mappings.values())
+    for item in loaded:
+        esito = f"{item['righe']} righe" if item['df'] is not None else "non caricato"
+        with st.expander(f"{item['path']}: {esito} in {item['seconds']:.1f} s", expanded=item['df'] is None):
+            for level, message in item['messages']: ST_REPORT[level](message)
     try:
-        file_name = uploaded_file.name
-        df = None
-        read_success = False
-        st.write(f"Lettura file: {file_name}")
-
-        # --- Lettura File ---
-        if file_name.endswith('.csv'):
-            # Prova combinazioni comuni di encoding, separatori, decimali
-            common_encodings=['utf-8', 'latin1', 'iso-8859-1', 'cp1252']
-            common_separators=[None, ';', ','] # None = auto-detect
-            common_decimals=[',', '.']
-            for enc in common_encodings:
-                for sep in common_separators:
-                    for dec in common_decimals:
-                        try:
-                            uploaded_file.seek(0) # Torna all'inizio del file
-                            df_temp = pd.read_csv(uploaded_file, sep=sep, engine='python', encoding=enc, decimal=dec)
-                            # Verifica se la lettura ha prodotto colonne significative
-                            if df_temp is not None and df_temp.shape[1] > 1: # Più di una colonna è un buon segno
-                                df = df_temp
-                                st.write(f"Letto CSV con successo: sep='{sep if sep else 'auto'}', encoding='{enc}', decimal='{dec}'")
-                                read_success = True
-                                break # Esce dal loop decimali
-                        except Exception as e_read:
-                            #st.write(f"Tentativo CSV fallito: sep={sep}, enc={enc}, dec={dec}, Err: {e_read}") # Debug
-                            continue # Prova prossima combinazione
-                    if read_success: break # Esce dal loop separatori
-                if read_success: break # Esce dal loop encoding
-            if not read_success or df is None or df.empty:
-                st.error("Lettura CSV fallita con tutte le combinazioni comuni. Verifica formato, encoding, separatore e decimale del file.")
-                return None
-        elif file_name.endswith(('.xls', '.xlsx')):
-            try:
-                uploaded_file.seek(0)
-                df = pd.read_excel(uploaded_file, engine='openpyxl')
-                st.success("File Excel caricato con successo.")
-            except Exception as e_excel:
-                st.error(f"Errore durante la lettura del file Excel: {e_excel}")
-                st.error(traceback.format_exc())
-                return None
+        if len(loaded) == 1: # Un solo file: importazione a blocchi registrata e riprendibile
+            staged = None if loaded[0]['df'] is None else import_utils.stage_dataframe(loaded[0]['df'])
+            if staged: staged.update(impronta=loaded[0]['impronta'], nome_file=loaded[0]['path'])
         else:
-            st.error("Formato file non supportato. Caricare un file .csv, .xls o .xlsx.")
-            return None
-
-        # --- Mappatura e Pulizia Colonne ---
-        st.write("Colonne originali:", df.columns.tolist())
-        column_mapping = {
-            # Mappature CIG (fondamentale)
-            'cig': 'identificativo_gara', 'id gara': 'identificativo_gara',
-            # Mappature Descrizione
-            'oggetto gara': 'descrizione', 'oggetto': 'descrizione', 'descrizione gara': 'descrizione',
-            # Mappature Data
-            'data scadenza': 'data_gara', 'data': 'data_gara', 'data pubblicazione': 'data_gara',
-            # Mappature Importo Base
-            'importo a base d\'asta': 'importo_base', 'importo': 'importo_base', 'base asta': 'importo_base', 'importo base': 'importo_base',
-            # Mappature Categoria
-            'categoria': 'categoria_lavori', 'cat.': 'categoria_lavori', 'categoria prevalente': 'categoria_lavori',
-            # Mappature Stazione Appaltante
-            'stazione appaltante': 'stazione_appaltante', 'sa': 'stazione_appaltante', 'ente': 'stazione_appaltante',
-            # Mappature Ribasso Offerto (%)
-            'nostro ribasso (%)': 'mio_ribasso_percentuale', 'ribasso offerto %': 'mio_ribasso_percentuale', 'tuo ribasso %': 'mio_ribasso_percentuale', 'mio ribasso %': 'mio_ribasso_percentuale',
-            # Mappature Importo Offerto (€) - Calcolato se non presente
-            'nostra offerta': 'importo_offerto', 'importo offerto': 'importo_offerto',
-            # Mappature Soglia Anomalia (%)
-            'soglia anomalia (%)': 'soglia_anomalia_calcolata', 'soglia %': 'soglia_anomalia_calcolata', 'soglia di anomalia %': 'soglia_anomalia_calcolata',
-            # Mappature Ribasso Aggiudicatario (%)
-            'ribasso aggiudicatario (%)': 'ribasso_aggiudicatario_percentuale', 'ribasso agg. %': 'ribasso_aggiudicatario_percentuale', 'ribasso aggiudicazione %': 'ribasso_aggiudicatario_percentuale',
-            # Mappature Importo Aggiudicazione (€) - Calcolato se non presente
-            'importo aggiudicazione': 'importo_aggiudicazione', 'importo agg.': 'importo_aggiudicazione', 'importo aggiudicato': 'importo_aggiudicazione',
-            # Mappature Numero Concorrenti
-            'num concorrenti': 'numero_concorrenti', 'num. offerte': 'numero_concorrenti', 'numero offerte': 'numero_concorrenti',
-            # Mappature Posizione Graduatoria
-            'posizione graduatoria': 'posizione_in_graduatoria', 'posizione': 'posizione_in_graduatoria', 'ns posizione': 'posizione_in_graduatoria',
-            # Mappature Esito
-            'esito gara': 'esito', 'esito': 'esito', 'stato': 'esito',
-            # Mappature Note
-            'annotazioni': 'note', 'note': 'note'
-        }
-        df.columns = df.columns.str.lower().str.strip() # Pulisci nomi colonne originali
-        df.rename(columns=column_mapping, inplace=True)
-        st.write("Colonne dopo mappatura preliminare:", df.columns.tolist())
-
-        # --- Conversione Tipi Numerici ---
-        # Lista colonne target che devono essere numeriche nel DB
-        numeric_cols_db = ['importo_base', 'mio_ribasso_percentuale', 'importo_offerto',
-                           'soglia_anomalia_calcolata', 'ribasso_aggiudicatario_percentuale',
-                           'importo_aggiudicazione', 'numero_concorrenti', 'posizione_in_graduatoria']
-        for col in numeric_cols_db:
-            if col in df.columns:
-                # Salva originale per debug
-                df[col+'_original'] = df[col]
-                # Converti a stringa, pulisci simboli (€, %), spazi
-                # Gestisci separatore migliaia (.) e decimale (,) -> converti a standard (.)
-                cleaned_series = df[col].astype(str).str.replace('€', '', regex=False)\
-                                    .str.replace('%', '', regex=False)\
-                                    .str.replace(r'\s+', '', regex=True)\
-                                    .str.strip()
-                # Prima rimuovi punti (migliaia), poi sostituisci virgola (decimale) con punto
-                standardized_series = cleaned_series.str.replace(r'\.(?=.*\.)', '', regex=True) # Rimuove punti tranne l'ultimo (se presente)
-                # Caso speciale: se c'è solo un punto e nessuna virgola, è prob. decimale
-                mask_single_dot = standardized_series.str.count(r'\.') == 1 & ~standardized_series.str.contains(',')
-                # Caso generale: sostituisci virgola con punto
-                standardized_series = standardized_series.str.replace(',', '.', regex=False)
-
-                df[col] = pd.to_numeric(standardized_series, errors='coerce')
-
-                # Warning se la conversione fallisce per valori non vuoti
-                failed_numeric = df[df[col].isna() & df[col+'_original'].notna() & (df[col+'_original'].astype(str).str.strip() != '')]
-                if not failed_numeric.empty:
-                    st.warning(f"Conversione numerica fallita per alcuni valori in '{col}'. Esempi non convertiti: {failed_numeric[col+'_original'].unique()[:5]}")
-            #else:
-            #    st.write(f"Colonna numerica attesa '{col}' non trovata nel file.")
-
-        # --- Conversione Data ---
-        if 'data_gara' in df.columns:
-            df['data_gara_original'] = df['data_gara']
-            # Prova il formato DD/MM/YYYY prima (comune in Italia)
-            df['data_gara'] = pd.to_datetime(df['data_gara'], errors='coerce', dayfirst=True)
-            # Se fallisce, prova il formato standard YYYY-MM-DD o altri riconosciuti da pandas
-            mask_failed = df['data_gara'].isna() & df['data_gara_original'].notna()
-            if mask_failed.any():
-                df.loc[mask_failed, 'data_gara'] = pd.to_datetime(df.loc[mask_failed, 'data_gara_original'], errors='coerce')
-            # Warning se ancora NaN
-            failed_dates = df[df['data_gara'].isna() & df['data_gara_original'].notna() & (df['data_gara_original'] != '')]
-            if not failed_dates.empty:
-                st.warning(f"Conversione data fallita per alcuni valori in 'data_gara'. Esempi non convertiti: {failed_dates['data_gara_original'].unique()[:5]}")
-        #else:
-        #    st.write("Colonna 'data_gara' non trovata nel file.")
-
-
-        # --- Calcoli Derivati (se mancano colonne) ---
-        # Calcola importo_offerto se mancano ma ci sono base e ribasso
-        if 'importo_offerto' not in df.columns and ('importo_base' in df.columns and 'mio_ribasso_percentuale' in df.columns):
-            mask = df['importo_base'].notna() & df['mio_ribasso_percentuale'].notna()
-            df.loc[mask, 'importo_offerto'] = df.loc[mask, 'importo_base'] * (1 - df.loc[mask, 'mio_ribasso_percentuale'] / 100)
-            st.write("Colonna 'importo_offerto' calcolata da importo base e ribasso.")
-
-        # Calcola importo_aggiudicazione se mancano ma ci sono base e ribasso aggiudicatario
-        if 'importo_aggiudicazione' not in df.columns and ('importo_base' in df.columns and 'ribasso_aggiudicatario_percentuale' in df.columns):
-            mask = df['importo_base'].notna() & df['ribasso_aggiudicatario_percentuale'].notna()
-            df.loc[mask, 'importo_aggiudicazione'] = df.loc[mask, 'importo_base'] * (1 - df.loc[mask, 'ribasso_aggiudicatario_percentuale'] / 100)
-            st.write("Colonna 'importo_aggiudicazione' calcolata da importo base e ribasso aggiudicatario.")
-
-        # --- Selezione Colonne Finali e Validazione CIG ---
-        db_cols_expected = db_utils.EXPECTED_COLUMNS
-        # Seleziona solo le colonne che esistono nel DataFrame E sono attese dal DB (escludendo quelle auto-generate)
-        final_cols = [col for col in db_cols_expected if col in df.columns and col not in ['id', 'data_inserimento']]
-        if not final_cols:
-             st.error("Nessuna colonna mappata corrisponde alle colonne attese dal database.")
-             return None
-        df_final = df[final_cols].copy()
-
-        # Validazione CIG (essenziale)
-        if 'identificativo_gara' not in df_final.columns:
-            st.error("Colonna 'identificativo_gara' (CIG) MANCANTE dopo la mappatura. Impossibile importare.")
-            return None
-        elif df_final['identificativo_gara'].astype(str).str.strip().replace('', np.nan).isna().any():
-            missing_id_count = df_final['identificativo_gara'].astype(str).str.strip().replace('', np.nan).isna().sum()
-            st.warning(f"{missing_id_count} righe non hanno un 'identificativo_gara' (CIG) valido e saranno saltate durante l'importazione.")
-            # Opzionale: potresti filtrare qui le righe senza CIG valido
-            # df_final = df_final.dropna(subset=['identificativo_gara'])
-            # df_final = df_final[df_final['identificativo_gara'].astype(str).str.strip() != '']
-
-        st.success(f"File processato. Colonne pronte per l'importazione: {df_final.columns.tolist()}")
-        st.dataframe(df_final.head())
-        st.write(f"Numero totale righe pronte (potrebbero esserci CIG duplicati o mancanti): {len(df_final)}")
-        return df_final
-
-    except Exception as e:
-        st.error(f"Errore imprevisto durante il caricamento/processamento del file: {e}")
-        st.error(traceback.format_exc())
-        return None
+            staged = import_utils.stage_loaded(loaded)
+    except db_utils.DatabaseError as e:
+        st.error(str(e)); return None
+    del loaded
+    if staged is None: return None
+    st.success(f"Processati {len(staged.get('file') or [staged])} file: {staged['righe']} righe ({import_utils.describe_counts(staged['conteggi'])}).")
+    journal = journals.get(staged.get('impronta'))
+    if journal and journal['stato'] == 'in_corso' and journal['righe_totali'] == staged['righe']:
+        st.info(f"Importazione precedente interrotta dopo {journal['righe_processate']} righe su {staged['righe']}: riprenderà da lì.")
+    try: st.dataframe(db_utils.get_staging_preview(staged['tabella']), hide_index=True)
+    except db_utils.DatabaseError as e: st.warning(str(e))
+    return staged
+
+def discard_staged_upload():
+    """Elimina la tabella di staging del file caricato in precedenza (sostituito o rimosso)."""
+    if st.session_state.get('staged_upload_sidebar'):
+        db_utils.drop_staging(st.session_state.staged_upload_sidebar['tabella'])
+    st.session_state.staged_upload_sidebar = None
+    st.session_state.uploaded_file_id_sidebar = None
+    st.session_state.upload_mappings_sidebar = []
+
+MAPPING_IGNORE = "(ignora)"
+
+def render_mapping_review():
+    """
+    Colonne associate per i file caricati, modificabili: la mappatura confermata si salva come profilo
+    (applicato subito ai file con le stesse intestazioni) e i file vengono riprocessati.
+    """
+    for info in st.session_state.get('upload_mappings_sidebar') or []:
+        origin = f"profilo '{info['nome_profilo'] or info['firma']}'" if info['origine'] == 'profilo' else "automatica"
+        to_review = info['origine'] != 'profilo' and bool(info['incerte'] or info['ignorate'] or 'identificativo_gara' not in info['mappatura'].values())
+        with st.expander(f"Colonne di {', '.join(info['file'])} ({origin})", expanded=to_review):
+            table = pd.DataFrame({'Intestazione': info['intestazioni'],
+                                  'Colonna': [info['mappatura'].get(key, MAPPING_IGNORE) for key in info['intestazioni']],
+                                  'Somiglianza': [info['punteggi'].get(key) for key in info['intestazioni']]})
+            edited = st.data_editor(table, hide_index=True, disabled=['Intestazione', 'Somiglianza'], key=f"mapping_editor_{info['firma']}",
+                                    column_config={'Colonna': st.column_config.SelectboxColumn("Colonna", options=[MAPPING_IGNORE] + import_utils.MAPPING_TARGETS, required=True),
+                                                   'Somiglianza': st.column_config.ProgressColumn("Somiglianza", min_value=0.0, max_value=1.0, format="%.2f")})
+            profile_name = st.text_input("Nome profilo", value=info.get('nome_profilo') or os.path.basename(info['file'][0]), key=f"mapping_name_{info['firma']}")
+            col_save, col_delete = st.columns(2)
+            if col_save.button("💾 Salva profilo", key=f"mapping_save_{info['firma']}", help="Usato automaticamente per i file con le stesse intestazioni. I file caricati vengono riprocessati."):
+                mapping = {row['Intestazione']: row['Colonna'] for row in edited.to_dict('records') if row['Colonna'] != MAPPING_IGNORE}
+                try: import_utils.save_mapping_profile(info['intestazioni'], mapping, name=profile_name.strip() or None)
+                except (ValueError, db_utils.DatabaseError) as e: st.error(str(e))
+                else:
+                    discard_staged_upload(); st.rerun()
+            if info['origine'] == 'profilo' and col_delete.button("🗑️ Elimina profilo", key=f"mapping_delete_{info['firma']}"):
+                try: db_utils.delete_mapping_profile(info['firma'])
+                except db_utils.DatabaseError as e: st.error(str(e))
+                else:
+                    discard_staged_upload(); st.rerun()
 
 def load_gara_for_editing(gara_id: int):
     """Carica dati gara nello stato sessione per modifica."""
-    print(f"Tentativo caricamento dati per modifica Gara ID: {gara_id}")
-    # Usa _cache_key_modifier per forzare il ri-caricamento se necessario
-    gara_data = db_utils.get_gara_by_id(gara_id, _cache_key_modifier=pd.Timestamp.now())
+    logger.debug("Tentativo caricamento dati per modifica Gara ID: %s", gara_id)
+    # Cache per ID di db_utils: invalidata da update/delete, il record è sempre aggiornato
+    try:
+        gara_data = db_utils.get_gara_by_id(gara_id)
+    except db_utils.DatabaseError as e:
+        st.error(str(e)); gara_data = None
     if gara_data:
         st.session_state.editing_gara_id = gara_id
         for key in form_widget_keys: # Itera sui widget del form
@@ -260,7 +200,7 @@ def load_gara_for_editing(gara_id: int):
                  # Usa stringa vuota se il valore è None per widget testuali/selectbox
                  st.session_state[edit_key] = value if value is not None else default_form_values.get(key, "")
 
-        print(f"Dati caricati nello stato sessione per modifica Gara ID: {gara_id}")
+        logger.debug("Dati caricati nello stato sessione per modifica Gara ID: %s", gara_id)
         st.session_state.edit_form_reset_needed = False # Reset flag perché stiamo caricando NUOVI dati
     else:
         st.error(f"Impossibile caricare i dati per la Gara ID {gara_id}. Potrebbe essere stata eliminata.")
@@ -279,7 +219,7 @@ def reset_edit_state():
           else: # Campi numerici e data
               st.session_state[key] = default_form_values.get(edit_base_key, None)
      st.session_state.edit_form_reset_needed = False # Assicura che il flag sia False dopo il reset
-     print("Stato sessione di modifica resettato.")
+     logger.debug("Stato sessione di modifica resettato.")
 
 
 # --- TITOLO ---
@@ -289,11 +229,12 @@ st.caption("Uno strumento per centralizzare e analizzare le tue partecipazioni."
 # --- Check e reset flag stato modifica ---
 # Esegui il reset SE il flag è True. Il flag viene impostato a True dopo un update riuscito o annullamento.
 if st.session_state.get('edit_form_reset_needed', False):
-    print("Reset edit state richiesto dal flag...")
+    logger.debug("Reset stato di modifica richiesto dal flag.")
     reset_edit_state()
     # Non serve rerun qui, il rerun che ha triggerato il reset (es. dopo submit) gestirà l'aggiornamento UI
 
 # --- SIDEBAR ---
+trace_utils.section('app.sidebar')
 with st.sidebar:
     st.image("logo.png", width=150) # Esempio logo
     st.header("Azioni Rapide")
@@ -302,7 +243,7 @@ with st.sidebar:
     with st.expander("➕ Inserisci Nuova Gara", expanded=False):
         # Reset campi form se l'inserimento precedente ha avuto successo
         if st.session_state.get('form_submit_success', False):
-            print("Resetting insert form fields after successful submission.")
+            logger.debug("Reset campi del form di inserimento dopo l'invio.")
             for key in form_widget_keys: st.session_state[key] = default_form_values[key]
             st.session_state.form_submit_success = False # Resetta il flag
 
@@ -365,14 +306,16 @@ with st.sidebar:
                 # Pulisci eventuali valori vuoti/None prima di passare al DB (anche se add_gara lo fa già)
                 # gara_data_clean = {k: v for k, v in gara_data.items() if not (v is None or (isinstance(v, str) and not v.strip()))}
 
-                if db_utils.add_gara(gara_data): # Passa direttamente gara_data, la pulizia è in add_gara
+                try:
+                    saved = db_utils.add_gara(gara_data) # Passa direttamente gara_data, la pulizia è in add_gara
+                except db_utils.DatabaseError as e: # Es. CIG duplicato
+                    st.error(f"Errore: {e}"); saved = None
+                if saved:
                     st.success(f"Gara '{gara_data['identificativo_gara']}' salvata con successo!")
                     st.session_state.form_submit_success = True # Flag per resettare i campi al prossimo rerun
-                    trigger_data_refresh() # Invalida cache DB
                     st.rerun() # Ricarica la pagina per aggiornare la tabella e resettare il form
                 else:
-                    # L'errore (es. CIG duplicato) viene mostrato da add_gara tramite st.error
-                    st.error(f"Errore durante il salvataggio della Gara '{gara_data['identificativo_gara']}'. Controllare i messaggi di errore sopra.")
+                    st.error(f"Errore durante il salvataggio della Gara '{gara_data['identificativo_gara']}'.")
             else:
                 # Mostra errori di validazione
                 for error in error_messages: st.warning(error)
@@ -381,98 +324,86 @@ with st.sidebar:
 
     # --- Caricamento da File ---
     st.subheader("Carica Dati da File")
-    uploaded_file_sb = st.file_uploader("Seleziona file Excel o CSV", type=["csv", "xlsx", "xls"], key="file_uploader_sidebar", label_visibility="collapsed", help="Carica più gare da un file CSV o Excel.")
+    uploaded_files_sb = st.file_uploader("Seleziona file Excel, CSV o ZIP", type=["csv", "xlsx", "xls", "zip"], accept_multiple_files=True,
+                                         key="file_uploader_sidebar", label_visibility="collapsed",
+                                         help="Carica più gare da uno o più file CSV/Excel, anche raccolti in un archivio ZIP.")
+    st.checkbox("Reimporta file già importati", key="force_reimport_sidebar",
+                help="Di norma un file con lo stesso contenuto di uno già importato viene saltato.")
 
     # Gestione stato per evitare ricaricamento ad ogni interazione
-    if 'df_loaded_sidebar' not in st.session_state: st.session_state.df_loaded_sidebar = None
+    # Nello stato sessione resta solo il riepilogo della tabella di staging, non il DataFrame
+    if 'staged_upload_sidebar' not in st.session_state: st.session_state.staged_upload_sidebar = None
     if 'uploaded_file_id_sidebar' not in st.session_state: st.session_state.uploaded_file_id_sidebar = None
+    if 'upload_mappings_sidebar' not in st.session_state: st.session_state.upload_mappings_sidebar = []
 
-    if uploaded_file_sb is not None:
-        # Identificativo univoco del file caricato
-        current_file_id_sb = uploaded_file_sb.id + str(uploaded_file_sb.size) + uploaded_file_sb.name
-        # Processa il file solo se è nuovo o non ancora processato
-        if st.session_state.df_loaded_sidebar is None or current_file_id_sb != st.session_state.uploaded_file_id_sidebar:
+    if not uploaded_files_sb and st.session_state.staged_upload_sidebar is not None:
+        discard_staged_upload() # File rimossi dal widget: lo staging non serve più
+
+    if uploaded_files_sb:
+        # Identificativo univoco dei file caricati (cambiando 'Reimporta' i file vengono riprocessati)
+        current_file_id_sb = "|".join(f.file_id + str(f.size) + f.name for f in uploaded_files_sb) + str(st.session_state.force_reimport_sidebar)
+        # Processa i file solo se sono nuovi o non ancora processati
+        if current_file_id_sb != st.session_state.uploaded_file_id_sidebar:
+            discard_staged_upload()
             with st.spinner("Processo file in corso..."):
-                st.session_state.df_loaded_sidebar = load_data_from_file(uploaded_file_sb)
+                st.session_state.staged_upload_sidebar = load_data_from_files(uploaded_files_sb)
             st.session_state.uploaded_file_id_sidebar = current_file_id_sb # Salva ID file processato
+        render_mapping_review() # Anche se il file non è stato caricato: la mappatura corretta può risolverlo
 
-        # Se il DataFrame è stato caricato con successo, mostra il bottone di importazione
-        if st.session_state.df_loaded_sidebar is not None:
+        # Se il file è in staging, mostra il bottone di importazione
+        staged_sb = st.session_state.staged_upload_sidebar
+        if staged_sb is not None:
             if st.button("⚡ Importa Dati da File Caricato", key="import_button_sidebar", type="primary", use_container_width=True):
-                df_to_import_sb = st.session_state.df_loaded_sidebar
-                imported_count_sb = 0
-                skipped_count_sb = 0
-                error_cigs_sb = []
-
                 with st.spinner("Importazione dati in corso..."):
-                    data_to_insert_sb = df_to_import_sb.to_dict('records')
-                    for record_sb in data_to_insert_sb:
-                        record_cig = record_sb.get('identificativo_gara', 'N/D')
-                        # Pulisci record (solo colonne DB valide, gestisci NaN)
-                        record_clean_sb = {k: v for k, v in record_sb.items() if pd.notna(v) and k in db_utils.EXPECTED_COLUMNS}
-                        # Formatta data se presente e valida
-                        if 'data_gara' in record_clean_sb and isinstance(record_clean_sb['data_gara'], (datetime.datetime, pd.Timestamp)):
-                             record_clean_sb['data_gara'] = record_clean_sb['data_gara'].strftime(DATE_FORMAT_STR)
-                        # Gestisci posizione 0 come NULL
-                        if record_clean_sb.get('posizione_in_graduatoria') == 0: record_clean_sb['posizione_in_graduatoria'] = None
-
-                        # Prova ad aggiungere, gestendo CIG mancante/vuoto
-                        if 'identificativo_gara' in record_clean_sb and str(record_clean_sb['identificativo_gara']).strip():
-                            if db_utils.add_gara(record_clean_sb):
-                                imported_count_sb += 1
-                            else:
-                                skipped_count_sb += 1
-                                error_cigs_sb.append(record_cig) # Salva CIG con errore (es. duplicato)
-                        else:
-                            skipped_count_sb +=1 # Salta righe senza CIG valido
-                            error_cigs_sb.append("(CIG Mancante)")
+                    esito_import_sb = import_utils.import_staged(staged_sb, fingerprint=staged_sb.get('impronta'), file_name=staged_sb.get('nome_file'))
 
                 # Report importazione
-                report_msg_sb = f"Importazione completata: {imported_count_sb} gare aggiunte/aggiornate, {skipped_count_sb} saltate/errate."
-                st.info(report_msg_sb)
+                if esito_import_sb['conteggi']:
+                    st.info(f"Importazione completata: {esito_import_sb['importate']} gare aggiunte, {esito_import_sb['saltate']} saltate "
+                            f"({import_utils.describe_counts(esito_import_sb['conteggi'])})"
+                            + (f", ripresa dalla riga {esito_import_sb['ripresa_da'] + 1}." if esito_import_sb['ripresa_da'] else "."))
+                if esito_import_sb['ultimo_errore']: # CIG già presenti o errore DB (con il registro si riprende dal blocco interrotto)
+                    st.warning(esito_import_sb['ultimo_errore'])
+                error_cigs_sb = list(dict.fromkeys(esito_import_sb['cig_saltati']))
                 if error_cigs_sb:
-                     st.warning(f"CIG saltati o con errori: {', '.join(list(set(error_cigs_sb))[:10])}{'...' if len(set(error_cigs_sb)) > 10 else ''}") # Mostra alcuni CIG errati
+                     st.warning(f"CIG saltati: {', '.join(error_cigs_sb[:10])}{'...' if len(error_cigs_sb) > 10 else ''}") # Mostra alcuni CIG saltati
 
-                # Reset stato file upload dopo importazione
-                st.session_state.df_loaded_sidebar = None
-                st.session_state.uploaded_file_id_sidebar = None
+                # Staging già eliminato; l'ID file resta, così lo stesso file non viene riprocessato al rerun
+                st.session_state.staged_upload_sidebar = None
                 # Forse resetta anche il widget file_uploader? Non sempre funziona bene
                 # st.session_state.file_uploader_sidebar = None
-                trigger_data_refresh() # Aggiorna cache DB
                 st.rerun() # Ricarica pagina
 
 # --- Area Principale ---
 st.header("📚 Storico Gare Inserite")
 st.markdown("Visualizza, filtra e gestisci le gare inserite nel database.")
 
+trace_utils.section('app.caricamento_dati')
 # Carica dati (usa cache di db_utils)
-df_gare = db_utils.get_all_gare(_refresh_trigger=st.session_state.refresh_data)
+df_gare = load_gare()
 
 if df_gare.empty:
     st.info("Nessuna gara trovata nel database. Inizia caricando un file o inserendo dati manualmente dalla sidebar.")
 else:
     # --- Conversione Tipi Post-Lettura (già fatta in db_utils, ma riassicura per sicurezza) ---
-    # Non dovrebbe essere necessario se db_utils.get_all_gare è corretto, ma ridondanza non guasta
-    if 'data_gara' in df_gare.columns: df_gare['data_gara'] = pd.to_datetime(df_gare['data_gara'], errors='coerce')
-    if 'data_inserimento' in df_gare.columns: df_gare['data_inserimento'] = pd.to_datetime(df_gare['data_inserimento'], errors='coerce')
-    numeric_cols_viz = ['importo_base', 'mio_ribasso_percentuale', 'importo_offerto','soglia_anomalia_calcolata', 'ribasso_aggiudicatario_percentuale','importo_aggiudicazione']
-    for col in numeric_cols_viz:
-        if col in df_gare.columns: df_gare[col] = pd.to_numeric(df_gare[col], errors='coerce')
-    integer_cols_viz = ['numero_concorrenti', 'posizione_in_graduatoria']
-    for col in integer_cols_viz:
-        if col in df_gare.columns: df_gare[col] = pd.to_numeric(df_gare[col], errors='coerce').astype('Int64') # Usa Int64 per gestire NaN in interi
+    analysis_utils.normalize_types(df_gare)
 
+    trace_utils.section('app.filtri')
     # --- Filtri ---
     st.subheader("🔍 Filtra Dati Visualizzati")
     # Layout filtri migliorato
     filter_cols = st.columns([1.5, 1, 1, 1.5]) # Proporzioni colonne
+    # Limiti e opzioni da aggregati SQL sugli indici (cache per versione dati), senza scandire df_gare
+    try: filter_options = db_utils.get_filter_options()
+    except db_utils.DatabaseError as e:
+        st.warning(str(e))
+        filter_options = {'data_min': None, 'data_max': None, 'importo_min': None, 'importo_max': None, 'categorie': [], 'esiti': []}
 
     with filter_cols[0]: # Data Gara
-        valid_dates = df_gare['data_gara'].dropna()
         date_filter = None
-        if not valid_dates.empty:
-            min_date_dt = valid_dates.min()
-            max_date_dt = valid_dates.max()
+        if filter_options['data_min'] is not None:
+            min_date_dt = filter_options['data_min']
+            max_date_dt = filter_options['data_max']
             # Conversione a date per il widget
             min_date = min_date_dt.date()
             max_date = max_date_dt.date()
@@ -508,23 +439,22 @@ else:
     with filter_cols[1]: # Categoria Lavori
         selected_category = "Tutte"
         # Opzioni: "Tutte" + lista unica e ordinata delle categorie presenti (ignorando NaN)
-        cat_options = ["Tutte"] + sorted(df_gare['categoria_lavori'].dropna().astype(str).unique().tolist())
+        cat_options = ["Tutte"] + filter_options['categorie']
         if len(cat_options) > 1: # Mostra selectbox solo se c'è più di un'opzione oltre a "Tutte"
             selected_category = st.selectbox("Categoria", options=cat_options, key="category_filter", index=0, help="Filtra per categoria lavori.")
 
     with filter_cols[2]: # Esito
        selected_esito = "Tutti"
        # Opzioni: "Tutti" + lista unica e ordinata degli esiti presenti (ignorando NaN)
-       esito_options = ["Tutti"] + sorted(df_gare['esito'].dropna().astype(str).unique().tolist())
+       esito_options = ["Tutti"] + filter_options['esiti']
        if len(esito_options) > 1:
            selected_esito = st.selectbox("Esito", options=esito_options, key="esito_filter", index=0, help="Filtra per esito gara.")
 
     with filter_cols[3]: # Importo Base
         selected_importo_range = None
-        if 'importo_base' in df_gare.columns and df_gare['importo_base'].notna().any():
-             valid_importi = df_gare['importo_base'].dropna()
-             min_imp = float(valid_importi.min())
-             max_imp = float(valid_importi.max())
+        if filter_options['importo_min'] is not None:
+             min_imp = filter_options['importo_min']
+             max_imp = filter_options['importo_max']
              if min_imp < max_imp:
                  # Calcola step dinamico per lo slider
                  step_value = max(1000.0, float(round((max_imp - min_imp) / 100))) # Circa 100 step
@@ -544,20 +474,15 @@ else:
                  selected_importo_range = (min_imp, max_imp) # Range fittizio
 
     # --- Applica Filtri ---
-    df_filtered = df_gare.copy() # Lavora su una copia per non alterare l'originale
-    if date_filter:
-        df_filtered = df_filtered.dropna(subset=['data_gara'])
-        df_filtered = df_filtered[(df_filtered['data_gara'] >= date_filter[0]) & (df_filtered['data_gara'] <= date_filter[1])]
-    if selected_category != "Tutte":
-        df_filtered = df_filtered[df_filtered['categoria_lavori'] == selected_category]
-    if selected_esito != "Tutti":
-        df_filtered = df_filtered[df_filtered['esito'] == selected_esito]
-    if selected_importo_range:
-        df_filtered = df_filtered.dropna(subset=['importo_base'])
-        df_filtered = df_filtered[(df_filtered['importo_base'] >= selected_importo_range[0]) & (df_filtered['importo_base'] <= selected_importo_range[1])]
+    df_filtered = analysis_utils.apply_filters(df_gare, date_range=date_filter, categoria=selected_category,
+                                               esito=selected_esito, importo_range=selected_importo_range)
 
+    trace_utils.section('app.tabella')
     # --- Visualizza Tabella Filtrata ---
-    st.dataframe( df_filtered,
+    # Descrizione e note non sono nella tabella in cache: si leggono solo per le righe filtrate
+    try: df_display = db_utils.add_text_columns(df_filtered)
+    except db_utils.DatabaseError as e: st.warning(str(e)); df_display = df_filtered
+    st.dataframe( df_display,
         hide_index=True,
         use_container_width=True,
         key="main_dataframe",
@@ -594,7 +519,7 @@ else:
             st.error(f"Errore durante la conversione in CSV: {e_csv}")
             return None
 
-    csv_data = convert_df_to_csv(df_filtered)
+    csv_data = convert_df_to_csv(df_display)
     if csv_data:
         st.download_button(
             label="📥 Scarica Dati Filtrati (CSV)",
@@ -606,6 +531,7 @@ else:
     st.divider()
 
     # --- Sezione Azioni: Modifica e Elimina ---
+    trace_utils.section('app.azioni_gare')
     st.subheader("✍️ Azioni sulle Gare Filtrate")
     st.caption("Seleziona una gara dalla lista sottostante per modificarne i dettagli o eliminarla.")
     col_actions_1, col_actions_2 = st.columns(2)
@@ -646,12 +572,12 @@ else:
                 # Carica i dati solo se l'ID selezionato è DIVERSO da quello già in modifica
                 # Questo evita loop di caricamento/rerun se l'utente non cambia selezione
                 if selected_id_edit != st.session_state.editing_gara_id:
-                    print(f"Selezione modifica cambiata a ID: {selected_id_edit}")
+                    logger.debug("Selezione modifica cambiata a ID: %s", selected_id_edit)
                     load_gara_for_editing(selected_id_edit)
                     st.rerun() # Ricarica per mostrare il form di modifica aggiornato
             elif st.session_state.editing_gara_id is not None and selected_gara_str_edit == edit_options_list[0]:
                  # L'utente è tornato all'opzione placeholder => resetta lo stato di modifica
-                 print("Placeholder selezionato per modifica, resetto stato.")
+                 logger.debug("Placeholder selezionato per modifica, resetto stato.")
                  # reset_edit_state() # Il flag farà il reset al prossimo giro
                  st.session_state.edit_form_reset_needed = True
                  st.rerun() # Ricarica per nascondere il form
@@ -704,16 +630,17 @@ else:
                     with col_del1:
                         if st.button("🔴 CONFERMA ELIMINA", key=f"delete_confirm_{gara_id_to_delete}", type="primary", use_container_width=True):
                             with st.spinner(f"Eliminazione Gara ID {gara_id_to_delete}..."):
-                                if db_utils.delete_gara_by_id(gara_id_to_delete):
+                                try: deleted = db_utils.delete_gara_by_id(gara_id_to_delete)
+                                except db_utils.DatabaseError as e: st.error(str(e)); deleted = None
+                                if deleted:
                                     st.success(f"Gara ID {gara_id_to_delete} eliminata con successo.")
                                     # Resetta il VALORE del widget nello stato sessione al placeholder DOPO l'azione
                                     st.session_state.selected_gara_to_delete = delete_options_list[0]
                                     if st.session_state.editing_gara_id == gara_id_to_delete:
                                         st.session_state.edit_form_reset_needed = True
-                                    trigger_data_refresh()
                                     st.rerun()
-                                else:
-                                    st.error(f"Errore durante l'eliminazione della Gara ID {gara_id_to_delete}.")
+                                elif deleted is False:
+                                    st.error(f"Gara ID {gara_id_to_delete} non trovata: potrebbe essere già stata eliminata.")
                     with col_del2:
                         if st.button("Annulla", key=f"delete_cancel_{gara_id_to_delete}", use_container_width=True):
                             # Resetta il VALORE del widget nello stato sessione al placeholder
@@ -797,20 +724,20 @@ else:
 
                 # Prepara dati per l'update (la funzione update_gara gestirà la pulizia finale)
                 current_editing_id = st.session_state.editing_gara_id
-                if db_utils.update_gara(current_editing_id, gara_data_update):
+                try: updated = db_utils.update_gara(current_editing_id, gara_data_update)
+                except db_utils.DatabaseError as e: st.error(str(e)); updated = None
+                if updated:
                     st.success(f"Gara ID {current_editing_id} aggiornata con successo!")
                     st.session_state.edit_form_reset_needed = True # Imposta flag per reset al prox rerun
-                    trigger_data_refresh() # Aggiorna cache DB
                     st.rerun() # Ricarica pagina
-                else:
-                    # L'errore viene mostrato da update_gara
-                    st.error(f"Errore durante l'aggiornamento della Gara ID {current_editing_id}.")
+                elif updated is False:
+                    st.warning(f"Nessuna modifica salvata per la Gara ID {current_editing_id} (dati invariati o gara non trovata).")
             else:
                 # Mostra errori di validazione (idealmente DENTRO il form, ma qui va bene sopra/sotto)
                 for error in edit_error_messages: st.warning(error)
 
         if cancelled_edit:
-             print("Annulla Modifica premuto.")
+             logger.debug("Annulla Modifica premuto.")
              st.session_state.edit_form_reset_needed = True # Flag per reset al prossimo giro
              st.rerun() # Triggera il rerun per far scattare il reset
 
@@ -818,6 +745,8 @@ else:
 
     # --- Dashboard e Analisi (Solo se ci sono dati filtrati) ---
     if not df_filtered.empty:
+        import plotly.express as px # Import differito: plotly viene caricato solo se ci sono grafici da disegnare
+        trace_utils.section('app.dashboard_kpi')
         st.header("📈 Dashboard Analitica")
         st.markdown("Metriche e grafici calcolati sui dati **filtrati** visualizzati nella tabella sopra.")
 
@@ -841,6 +770,7 @@ else:
 
 
         # --- Analisi Delta Ribassi ---
+        trace_utils.section('app.delta_ribassi')
         st.subheader("📉 Analisi Delta Ribassi", help="Differenza tra il tuo ribasso e quello dell'aggiudicatario (per gare perse) o la soglia di anomalia.")
         df_analysis = df_filtered.copy() # Usa copia per calcoli
 
@@ -938,6 +868,7 @@ else:
 
 
         # --- Grafici Generali ---
+        trace_utils.section('app.grafici')
         st.subheader("📊 Grafici Generali")
         graph_col1, graph_col2 = st.columns(2)
 
@@ -978,7 +909,7 @@ else:
                     st.plotly_chart(fig_time, use_container_width=True)
                 except Exception as e_time:
                     st.warning(f"Errore durante la creazione del grafico temporale: {e_time}")
-                    # print(traceback.format_exc()) # Per debug
+                    logger.debug("Errore grafico temporale", exc_info=True)
             else:
                 st.caption("Dati insufficienti per generare il grafico temporale (controlla filtri e presenza di date/percentuali).")
 
@@ -1002,6 +933,7 @@ else:
 
 
         # --- Grafico Scatter: Posizionamento vs Soglia ---
+        trace_utils.section('app.posizionamento')
         st.subheader("🎯 Posizionamento Offerta vs Soglia", help="Visualizza il tuo ribasso rispetto alla soglia di anomalia. La dimensione del punto indica l'importo base.")
         required_cols_scatter = ['mio_ribasso_percentuale', 'soglia_anomalia_calcolata']
         if all(col in df_filtered.columns for col in required_cols_scatter):
@@ -1075,112 +1007,50 @@ else:
 
 
         # --- Analisi per Segmenti ---
+        trace_utils.section('app.segmenti')
         st.subheader("🧩 Analisi per Segmenti", help="Analizza le performance aggregate per Categoria Lavori o per Fascia d'Importo Base.")
         # Scelta tipo segmentazione
-        segment_type = st.radio("Raggruppa Dati Per:", ["Categoria Lavori", "Fascia Importo"], horizontal=True, key="segment_radio", index=0)
-
-        df_segmented = df_filtered.copy()
-        segment_col = 'segmento' # Nome colonna standard per il raggruppamento
-        segment_valid = False # Flag per indicare se la segmentazione è possibile
-
-        # Logica segmentazione per Categoria
-        if segment_type == "Categoria Lavori":
-            if 'categoria_lavori' in df_segmented.columns and df_segmented['categoria_lavori'].notna().any():
-                # Riempi NaN con "Non Specificata" e assicurati sia stringa
-                df_segmented[segment_col] = df_segmented['categoria_lavori'].fillna("Non Specificata").astype(str)
-                segment_valid = True
-            else:
-                st.warning("Colonna 'categoria_lavori' non disponibile o vuota nei dati filtrati per segmentare.")
-
-        # Logica segmentazione per Fascia d'Importo
-        else: # Fascia Importo
-            if 'importo_base' in df_segmented.columns and df_segmented['importo_base'].notna().any():
-                df_importo_valid = df_segmented.dropna(subset=['importo_base'])
-                if not df_importo_valid.empty:
-                    min_imp_seg = df_importo_valid['importo_base'].min()
-                    max_imp_seg = df_importo_valid['importo_base'].max()
-                    # Definisci fasce (bins) dinamicamente o staticamente
-                    # Esempio fasce statiche (adattabili)
-                    bins = [-np.inf, 50000, 150000, 500000, 1000000, 5000000, np.inf]
-                    labels = ["<50k", "50k-150k", "150k-500k", "500k-1M", "1M-5M", ">5M"]
-                    # Applica pd.cut per creare la colonna segmento
-                    df_segmented[segment_col] = pd.cut(df_segmented['importo_base'], bins=bins, labels=labels, right=False) # right=False include il limite inferiore
-                    segment_valid = True
-                else:
-                     st.warning("Nessun importo base valido nei dati filtrati per segmentare per fascia.")
-            else:
-                st.warning("Colonna 'importo_base' non disponibile o vuota nei dati filtrati per segmentare per fascia.")
+        segment_type = st.radio("Raggruppa Dati Per:", [analysis_utils.SEGMENTO_CATEGORIA, analysis_utils.SEGMENTO_IMPORTO], horizontal=True, key="segment_radio", index=0)
+        segment_col = analysis_utils.SEGMENT_COLUMN
+
+        try:
+            segment_stats_display = analysis_utils.segment_stats(df_filtered, segment_type)
+        except ValueError as e_segment: # Segmentazione non possibile con i dati filtrati
+            st.warning(str(e_segment))
+            segment_stats_display = None
+        except Exception as e_segment:
+            st.error(f"Errore durante l'analisi per segmenti: {e_segment}")
+            logger.exception("Errore durante l'analisi per segmenti")
+            segment_stats_display = None
+
+        # Visualizza statistiche se la segmentazione è valida
+        if segment_stats_display is not None:
+            # Visualizza la tabella con stile e formattazione
+            st.dataframe(segment_stats_display.style.format({
+                'Win Rate (%)': '{:.1f}%', # 1 decimale per win rate
+                'Tuo Rib. Medio %': PERCENTAGE_DISPLAY_FORMAT, # 4 decimali per medie %
+                'Agg. Rib. Medio %': PERCENTAGE_DISPLAY_FORMAT,
+                'Soglia Media %': PERCENTAGE_DISPLAY_FORMAT,
+                'Num. Conc. Medio': '{:.1f}' # 1 decimale per media concorrenti
+            }).highlight_max(subset=['Win Rate (%)'], color='lightgreen', axis=0) # Evidenzia max win rate
+              .highlight_min(subset=['Tuo Rib. Medio %', 'Agg. Rib. Medio %'], color='lightblue', axis=0) # Evidenzia min ribassi medi
+              , use_container_width=True)
+
+            # Grafico opzionale: Win Rate per Segmento
+            if not segment_stats_display.empty and 'Win Rate (%)' in segment_stats_display.columns:
+                 plot_df = segment_stats_display.reset_index() # Porta il segmento da indice a colonna per Plotly
+                 # Ordina per Num. Gare per possibile visualizzazione migliore
+                 plot_df = plot_df.sort_values(by='Num. Gare', ascending=False)
+                 fig_segment = px.bar(plot_df, x=segment_col, y='Win Rate (%)',
+                                      color='Num. Gare', # Colora barre per numero gare nel segmento
+                                      color_continuous_scale=px.colors.sequential.Viridis, # Scala colori
+                                      title=f"Win Rate per {segment_type}",
+                                      labels={segment_col: segment_type, 'Win Rate (%)': 'Win Rate (%)'},
+                                      hover_data=plot_df.columns # Mostra tutti i dati nel tooltip
+                                      )
+                 fig_segment.update_layout(yaxis_ticksuffix="%")
+                 st.plotly_chart(fig_segment, use_container_width=True)
 
-        # Calcola e visualizza statistiche se la segmentazione è valida
-        if segment_valid:
-            try:
-                # Funzioni di aggregazione desiderate
-                agg_funcs = {
-                    'id': 'size', # Conteggio gare totali per segmento
-                    'mio_ribasso_percentuale': 'mean',
-                    'ribasso_aggiudicatario_percentuale': 'mean',
-                    'soglia_anomalia_calcolata': 'mean',
-                    'numero_concorrenti': 'mean' # Esempio: aggiungi media concorrenti
-                }
-                # Raggruppa e aggrega
-                # observed=False include tutte le categorie (anche quelle vuote nei dati filtrati, se create da pd.cut)
-                segment_stats = df_segmented.groupby(segment_col, observed=False).agg(agg_funcs).rename(columns={'id': 'Num. Gare'})
-
-                # Calcola separatamente Vinte e Partecipate (con esito A/P) per Win Rate
-                segment_wins = df_segmented[df_segmented['esito'] == 'Aggiudicata'].groupby(segment_col, observed=False).size().rename("Vinte")
-                segment_partecipate = df_segmented[df_segmented['esito'].isin(['Aggiudicata', 'Persa'])].groupby(segment_col, observed=False).size().rename("Partecipate (A/P)")
-
-                # Unisci i conteggi Vinte/Partecipate alle statistiche principali
-                segment_stats = segment_stats.join(segment_wins, how='left').join(segment_partecipate, how='left').fillna(0)
-                # Assicura che Vinte/Partecipate siano interi
-                segment_stats[['Vinte', 'Partecipate (A/P)']] = segment_stats[['Vinte', 'Partecipate (A/P)']].astype(int)
-
-                # Calcola Win Rate (%)
-                segment_stats['Win Rate (%)'] = ((segment_stats['Vinte'] / segment_stats['Partecipate (A/P)']) * 100).where(segment_stats['Partecipate (A/P)'] > 0, 0)
-
-                # Rinomina colonne medie per chiarezza nella tabella
-                segment_stats.rename(columns={
-                    'mio_ribasso_percentuale': 'Tuo Rib. Medio %',
-                    'ribasso_aggiudicatario_percentuale': 'Agg. Rib. Medio %',
-                    'soglia_anomalia_calcolata': 'Soglia Media %',
-                    'numero_concorrenti': 'Num. Conc. Medio'
-                }, inplace=True)
-
-                # Seleziona e ordina colonne per la visualizzazione finale
-                display_cols = ['Num. Gare', 'Vinte', 'Partecipate (A/P)', 'Win Rate (%)',
-                                'Tuo Rib. Medio %', 'Agg. Rib. Medio %', 'Soglia Media %', 'Num. Conc. Medio']
-                # Mantieni solo le colonne effettivamente calcolate
-                segment_stats_display = segment_stats[[col for col in display_cols if col in segment_stats.columns]]
-
-                # Visualizza la tabella con stile e formattazione
-                st.dataframe(segment_stats_display.style.format({
-                    'Win Rate (%)': '{:.1f}%', # 1 decimale per win rate
-                    'Tuo Rib. Medio %': PERCENTAGE_DISPLAY_FORMAT, # 4 decimali per medie %
-                    'Agg. Rib. Medio %': PERCENTAGE_DISPLAY_FORMAT,
-                    'Soglia Media %': PERCENTAGE_DISPLAY_FORMAT,
-                    'Num. Conc. Medio': '{:.1f}' # 1 decimale per media concorrenti
-                }).highlight_max(subset=['Win Rate (%)'], color='lightgreen', axis=0) # Evidenzia max win rate
-                  .highlight_min(subset=['Tuo Rib. Medio %', 'Agg. Rib. Medio %'], color='lightblue', axis=0) # Evidenzia min ribassi medi
-                  , use_container_width=True)
-
-                # Grafico opzionale: Win Rate per Segmento
-                if not segment_stats_display.empty and 'Win Rate (%)' in segment_stats_display.columns:
-                     plot_df = segment_stats_display.reset_index() # Porta il segmento da indice a colonna per Plotly
-                     # Ordina per Num. Gare per possibile visualizzazione migliore
-                     plot_df = plot_df.sort_values(by='Num. Gare', ascending=False)
-                     fig_segment = px.bar(plot_df, x=segment_col, y='Win Rate (%)',
-                                          color='Num. Gare', # Colora barre per numero gare nel segmento
-                                          color_continuous_scale=px.colors.sequential.Viridis, # Scala colori
-                                          title=f"Win Rate per {segment_type}",
-                                          labels={segment_col: segment_type, 'Win Rate (%)': 'Win Rate (%)'},
-                                          hover_data=plot_df.columns # Mostra tutti i dati nel tooltip
-                                          )
-                     fig_segment.update_layout(yaxis_ticksuffix="%")
-                     st.plotly_chart(fig_segment, use_container_width=True)
-
-            except Exception as e_segment:
-                 st.error(f"Errore durante l'analisi per segmenti: {e_segment}")
-                 print(traceback.format_exc())
         st.divider()
 
     else:
@@ -1188,6 +1058,7 @@ else:
 
 
     # --- Stima Soglia Statistica ---
+    trace_utils.section('app.stima_statistica')
     st.header("🔮 Stima Soglia Anomalia (Statistica)")
     st.markdown("Stima basata sui dati storici **filtrati**. Utile per avere un'idea del range probabile di soglia per gare simili a quelle visualizzate.")
     # Verifica se ci sono dati filtrati e la colonna soglia esiste e ha valori
@@ -1221,6 +1092,7 @@ else:
             col_stats3.caption("Valore minimo e massimo osservati.")
 
             # Istogramma distribuzione soglie
+            import plotly.express as px
             st.markdown("**Distribuzione delle Soglie (sui dati filtrati)**")
             fig_hist_soglie = px.histogram(df_pred_base, x='soglia_anomalia_calcolata', nbins=15, # Adeguato numero di bin
                                            title="Distribuzione Soglie Anomalia Gare Filtrate")
@@ -1244,16 +1116,66 @@ else:
         else: # Colonna esiste ma non ha valori validi
             st.warning("Nessun valore valido per 'soglia_anomalia_calcolata' trovato nei dati filtrati per calcolare la stima.")
 
+    # --- Gare Simili (k-nearest neighbour su tutte le gare storiche) ---
+    trace_utils.section('app.gare_simili')
+    st.subheader("🔎 Gare Simili a un Nuovo Bando")
+    st.markdown("Invece della media sui filtri, cerca tra **tutte** le gare storiche con soglia nota quelle più simili al bando "
+                "(importo, categoria, stazione appaltante, numero concorrenti, data e, se indicata, descrizione).")
+    with st.form("similar_gare_form"):
+        c1_sim, c2_sim, c3_sim = st.columns(3)
+        with c1_sim:
+            sim_importo = st.number_input("Importo Base (€)*", value=None, format=CURRENCY_INTERNAL_FORMAT, step=1000.0, key="sim_imp", placeholder="Es: 250000.00")
+            sim_data = st.date_input("Data Gara", value=datetime.date.today(), key="sim_data")
+        with c2_sim:
+            sim_categoria = st.selectbox("Categoria", options=["Sconosciuto"] + sorted(df_gare['categoria_lavori'].dropna().astype(str).unique().tolist()), key="sim_cat")
+            sim_stazione = st.selectbox("Stazione Appaltante", options=["Sconosciuto"] + sorted(df_gare['stazione_appaltante'].dropna().astype(str).unique().tolist()), key="sim_stazione")
+        with c3_sim:
+            sim_num_conc = st.number_input("Num. Concorrenti Stimato", value=None, min_value=1, step=1, key="sim_conc", placeholder="Opzionale")
+            sim_k = st.slider("Gare simili da mostrare", min_value=5, max_value=50, value=10, step=5, key="sim_k")
+        sim_descrizione = st.text_input("Descrizione / Oggetto (opzionale)", key="sim_descr", help="Se indicata, le gare con oggetto simile vengono favorite (TF-IDF sulle descrizioni).")
+        submitted_sim = st.form_submit_button("🔎 Cerca Gare Simili", use_container_width=True)
+
+    if submitted_sim:
+        if sim_importo is None:
+            st.error("L'importo base è obbligatorio per la ricerca di gare simili.")
+        else:
+            bando = {'importo_base': float(sim_importo), 'data_gara': sim_data.strftime(DATE_FORMAT_STR) if sim_data else None,
+                     'categoria_lavori': None if sim_categoria == "Sconosciuto" else sim_categoria,
+                     'stazione_appaltante': None if sim_stazione == "Sconosciuto" else sim_stazione,
+                     'numero_concorrenti': sim_num_conc, 'descrizione': sim_descrizione or None}
+            try:
+                df_simili = similarity_utils.find_similar(db_utils.add_text_columns(df_gare, ['descrizione']), bando, k=sim_k)
+            except Exception as e_sim:
+                st.error(f"Errore durante la ricerca di gare simili: {e_sim}"); logger.exception("Errore ricerca gare simili"); df_simili = pd.DataFrame()
+            if df_simili.empty:
+                st.warning("Nessuna gara storica con soglia nota disponibile per il confronto.")
+            else:
+                stats_simili = similarity_utils.soglia_distribution(df_simili)
+                sim_col1, sim_col2, sim_col3 = st.columns(3)
+                sim_col1.metric("Soglia Media (pesata per similarità)", PERCENTAGE_METRIC_FORMAT.format(stats_simili['media_pesata']),
+                                help="Media delle soglie delle gare simili, con peso maggiore alle più vicine.")
+                sim_col2.metric("Mediana", PERCENTAGE_METRIC_FORMAT.format(stats_simili['mediana']))
+                sim_col3.metric("Range 10°-90° percentile", f"{stats_simili['p10']:.2f}% - {stats_simili['p90']:.2f}%")
+                st.caption(f"{stats_simili['n']} gare simili trovate in {df_simili.attrs.get('elapsed_ms', 0):.1f} ms.")
+                st.dataframe(df_simili[['identificativo_gara', 'data_gara', 'importo_base', 'categoria_lavori', 'stazione_appaltante',
+                                        'numero_concorrenti', 'soglia_anomalia_calcolata', 'esito', 'distanza']],
+                             hide_index=True, use_container_width=True,
+                             column_config={"importo_base": st.column_config.NumberColumn("Importo Base", format="€ %.2f"),
+                                            "data_gara": st.column_config.DateColumn("Data Gara", format=DATE_FORMAT_STR),
+                                            "soglia_anomalia_calcolata": st.column_config.NumberColumn("Soglia", format="%.4f%%"),
+                                            "distanza": st.column_config.NumberColumn("Distanza", format="%.3f", help="Più bassa = più simile.")})
+
 # --- FINE BLOCCO ELSE (quando df_gare non è vuoto) ---
 st.divider()
 
 # --- Modulo Machine Learning ---
+trace_utils.section('app.ml_modello')
 st.header("🤖 Modulo Previsione Avanzata (Machine Learning)")
 st.markdown("Utilizza un modello predittivo (Random Forest) per stimare la soglia di anomalia basandosi sulle caratteristiche della gara. Richiede addestramento preliminare.",
-            help="Il modello usa Importo Base, Categoria, Num. Concorrenti, Anno/Mese Gara.")
+            help="Il modello usa Importo Base, Categoria, Stazione Appaltante, Num. Concorrenti, Anno/Mese Gara e la soglia media storica (solo gare precedenti) per stazione appaltante e categoria.")
 
 # Carica TUTTI i dati per training/info ML (non filtrati)
-df_gare_ml = db_utils.get_all_gare(_refresh_trigger=st.session_state.refresh_data)
+df_gare_ml = load_gare()
 
 # Condizioni per poter addestrare il modello
 target_col='soglia_anomalia_calcolata'
@@ -1274,59 +1196,165 @@ else:
     st.warning(f"Dati storici insufficienti o colonne essenziali mancanti ('{target_col}', '{required_feature_cols[0]}', '{required_feature_cols[1]}') per addestrare il modello ML.")
 
 # --- Sezione Addestramento (se possibile) ---
+def show_training_results(results):
+    """Mostra metriche e importanza feature di un addestramento completato."""
+    col_met1, col_met2 = st.columns(2)
+    with col_met1:
+        st.metric("Errore Medio Assoluto (MAE)", f"{results['mae']:.4f}%" if pd.notna(results['mae']) else "N/D", delta=None,
+                  help="Errore medio di previsione sul test set (in punti percentuali). Più basso è, meglio è.")
+    with col_met2:
+        st.metric("Coefficiente R²", f"{results['r2']:.3f}" if pd.notna(results['r2']) else "N/D", delta=None,
+                  help="Indica quanto bene il modello spiega la varianza della soglia (0-1). Più vicino a 1 è, meglio è.")
+    st.caption(f"Modello addestrato usando {results['n_samples']} campioni validi (dopo preprocessing).")
+    if results.get('training_mode') == 'incrementale':
+        st.caption("Aggiornamento incrementale: metriche calcolate sulle gare nuove, predette dal modello precedente prima dell'aggiornamento.")
+
+    # Mostra importanza delle feature se disponibile
+    if 'feature_importances' in results and not results['feature_importances'].empty:
+        st.divider()
+        st.subheader("Importanza delle Feature nel Modello")
+        st.markdown("Quanto ogni fattore ha contribuito alla previsione della soglia nel modello addestrato (valori più alti indicano maggiore importanza).")
+        try:
+            df_imp = results['feature_importances'].reset_index()
+            df_imp.columns = ['Feature', 'Importanza']
+            # Pulisci nomi feature per leggibilità (es: 'anno_gara' -> 'Anno Gara')
+            df_imp['Feature'] = df_imp['Feature'].str.replace('_', ' ').str.title()
+            # Grafico a barre orizzontale
+            import plotly.express as px
+            fig_imp = px.bar(df_imp.sort_values(by='Importanza', ascending=True), # Ordina per vedere meglio
+                             x='Importanza', y='Feature', orientation='h',
+                             title="Importanza Feature per Previsione Soglia",
+                             labels={'Importanza': 'Importanza Relativa (Gini Importance)'},
+                             height=max(400, len(df_imp) * 30)) # Altezza dinamica
+            fig_imp.update_layout(xaxis_tickformat=".1%") # Formatta asse x come percentuale
+            st.plotly_chart(fig_imp, use_container_width=True)
+        except Exception as e_imp:
+            st.warning(f"Impossibile visualizzare l'importanza delle feature: {e_imp}")
+
+def show_search_results(results):
+    """Mostra la classifica delle configurazioni valutate dalla selezione modello."""
+    st.caption(f"Cross-validation temporale su {results['n_samples']} gare ({results['n_splits']} fold: addestramento sul passato, test sulle gare successive). "
+               f"Fold calcolati: {results['n_evaluated']}, letti dalla cache: {results['n_cached']}.")
+    df_search = pd.DataFrame(results['results']).drop(columns=['config'])
+    st.dataframe(df_search, hide_index=True, use_container_width=True, column_config={
+        "model": st.column_config.TextColumn("Modello"),
+        "params": st.column_config.TextColumn("Parametri", width="large"),
+        "mae_mean": st.column_config.NumberColumn("MAE Medio (%)", format="%.4f"),
+        "mae_std": st.column_config.NumberColumn("Dev. Std MAE", format="%.4f"),
+        "r2_mean": st.column_config.NumberColumn("R² Medio", format="%.3f"),
+        "n_folds": st.column_config.NumberColumn("Fold", format="%d"),
+    })
+    best = results['best']
+    if st.button(f"🏆 Addestra Configurazione Migliore ({best['model']})", key="train_best_config_button",
+                 disabled=job_utils.get_latest_job(db_utils.DB_FILENAME, stati=job_utils.STATI_ATTIVI) is not None):
+        job_utils.submit_training_job(db_utils.DB_FILENAME, df_gare_ml, model_config=best)
+        st.rerun()
+
+def show_job_panel(tipo: str, poll: bool, show_result):
+    """Pannello stato dell'ultimo job del tipo indicato (condiviso tra sessioni, persistito su DB).
+    Se c'è un job attivo il frammento si aggiorna da solo ogni 2 secondi senza rieseguire la pagina."""
+    @st.fragment(run_every=2 if poll else None)
+    def _panel():
+        job = job_utils.get_latest_job(db_utils.DB_FILENAME, tipo=tipo)
+        if job is None: return
+        if job['stato'] in job_utils.STATI_ATTIVI:
+            st.progress(min(max(job['progresso'] or 0.0, 0.0), 1.0), text=f"Job {job['id']}: {job['messaggio'] or job['stato']}")
+            annullamento_in_corso = job['stato'] == job_utils.STATO_ANNULLAMENTO
+            if st.button("⛔ Annulla", key=f"cancel_job_{job['id']}", disabled=annullamento_in_corso):
+                job_utils.cancel_job(db_utils.DB_FILENAME, job['id'])
+            if not poll: st.rerun() # Job avviato da un'altra sessione: riesegui per attivare il polling
+        else:
+            if poll: st.rerun() # Job appena terminato: aggiorna tutta la pagina (form di previsione, pulsanti)
+            if job['stato'] == job_utils.STATO_COMPLETATO and job.get('risultato'):
+                st.success(f"Ultimo job completato (job {job['id']}, {job['aggiornato_il']}).")
+                show_result(job['risultato'])
+            elif job['stato'] == job_utils.STATO_ANNULLATO:
+                st.info(f"Ultimo job annullato (job {job['id']}).")
+            else:
+                st.error(f"Job {job['id']} fallito. Controllare i log o i dati nel database.")
+                if job.get('errore'):
+                    with st.expander("Dettagli errore"): st.code(job['errore'])
+    _panel()
+
 if can_train:
     with st.expander("🔧 Addestra / Riaddestra Modello di Previsione Soglia"):
-        st.markdown("Addestra un modello *Random Forest* usando tutti i dati storici disponibili nel database che hanno una soglia di anomalia nota e le feature richieste. Il modello impara a predire la `soglia_anomalia_calcolata` basandosi su `importo_base`, `categoria_lavori`, `numero_concorrenti`, anno e mese della gara.")
-        st.caption("L'addestramento sovrascrive eventuali modelli precedenti e può richiedere qualche istante.")
-
-        if st.button("🚀 Avvia Addestramento Modello", key="train_ml_button"):
-            with st.spinner("Addestramento modello ML in corso..."):
-                # Passa l'intero DataFrame (la funzione train_model farà il preprocessing)
-                results = ml_utils.train_model(df_gare_ml)
-
-            if results:
-                st.success("Addestramento modello completato e salvato!")
-                # Mostra metriche di valutazione sul test set
-                col_met1, col_met2 = st.columns(2)
-                with col_met1:
-                    st.metric("Errore Medio Assoluto (MAE)", f"{results['mae']:.4f}%", delta=None,
-                              help="Errore medio di previsione sul test set (in punti percentuali). Più basso è, meglio è.")
-                with col_met2:
-                    st.metric("Coefficiente R²", f"{results['r2']:.3f}", delta=None,
-                              help="Indica quanto bene il modello spiega la varianza della soglia (0-1). Più vicino a 1 è, meglio è.")
-                st.caption(f"Modello addestrato usando {results['n_samples']} campioni validi (dopo preprocessing).")
-
-                # Mostra importanza delle feature se disponibile
-                if 'feature_importances' in results and not results['feature_importances'].empty:
-                    st.divider()
-                    st.subheader("Importanza delle Feature nel Modello")
-                    st.markdown("Quanto ogni fattore ha contribuito alla previsione della soglia nel modello appena addestrato (valori più alti indicano maggiore importanza).")
-                    try:
-                        df_imp = results['feature_importances'].reset_index()
-                        df_imp.columns = ['Feature', 'Importanza']
-                        # Pulisci nomi feature per leggibilità (es: 'anno_gara' -> 'Anno Gara')
-                        df_imp['Feature'] = df_imp['Feature'].str.replace('_', ' ').str.title()
-                        # Grafico a barre orizzontale
-                        fig_imp = px.bar(df_imp.sort_values(by='Importanza', ascending=True), # Ordina per vedere meglio
-                                         x='Importanza', y='Feature', orientation='h',
-                                         title="Importanza Feature per Previsione Soglia",
-                                         labels={'Importanza': 'Importanza Relativa (Gini Importance)'},
-                                         height=max(400, len(df_imp) * 30)) # Altezza dinamica
-                        fig_imp.update_layout(xaxis_tickformat=".1%") # Formatta asse x come percentuale
-                        st.plotly_chart(fig_imp, use_container_width=True)
-                    except Exception as e_imp:
-                        st.warning(f"Impossibile visualizzare l'importanza delle feature: {e_imp}")
-
-                # Potrebbe essere utile ricaricare per assicurarsi che il form di predizione veda il nuovo modello
+        st.markdown("Addestra un modello *Random Forest* usando tutti i dati storici disponibili nel database che hanno una soglia di anomalia nota e le feature richieste. Il modello impara a predire la `soglia_anomalia_calcolata` basandosi su `importo_base`, `categoria_lavori`, `stazione_appaltante`, `numero_concorrenti`, anno e mese della gara e sugli aggregati storici (soglia media e numero di gare precedenti per stazione appaltante e per categoria).")
+        st.caption("L'addestramento viene eseguito in background: puoi continuare a usare l'app mentre procede. Ogni addestramento crea una nuova versione del modello; le precedenti restano disponibili per il rollback.")
+
+        job_utils.get_executor(db_utils.DB_FILENAME) # Assicura tabella job e pool di processi
+        active_job = job_utils.get_latest_job(db_utils.DB_FILENAME, stati=job_utils.STATI_ATTIVI)
+        active_model_meta = model_store_utils.get_metadata()
+        n_new_labelled = ml_utils.count_new_labelled(df_gare_ml, active_model_meta)
+
+        # Politica di aggiornamento automatico: abbastanza nuove gare con soglia rispetto al modello attivo,
+        # nessun job in corso, versione non bloccata e ultimo job non fallito (niente tentativi a ripetizione)
+        if (active_model_meta is not None and active_job is None and n_new_labelled >= ml_utils.AUTO_RETRAIN_THRESHOLD
+                and not model_store_utils.is_pinned()):
+            last_job = job_utils.get_latest_job(db_utils.DB_FILENAME)
+            if last_job is None or last_job['stato'] != job_utils.STATO_FALLITO:
+                job_utils.submit_training_job(db_utils.DB_FILENAME, df_gare_ml, incremental=True)
+                st.toast(f"{n_new_labelled} nuove gare con soglia: aggiornamento del modello avviato in background.")
                 st.rerun()
-            else:
-                st.error("Addestramento del modello ML fallito. Controllare i log o i dati nel database.")
+
+        if active_model_meta is not None:
+            st.caption(f"Nuove gare con soglia dall'ultimo modello: **{n_new_labelled}** (aggiornamento automatico da {ml_utils.AUTO_RETRAIN_THRESHOLD}).")
+        incremental_train = st.checkbox("Aggiornamento incrementale (aggiunge alberi al modello attivo)", key="train_incremental_checkbox",
+                                        value=False, disabled=active_model_meta is None,
+                                        help=f"Aggiunge {ml_utils.INCREMENTAL_TREES} alberi addestrati sui dati correnti invece di ricostruire l'intero modello. Le metriche sono calcolate sulle gare nuove (valutazione prequenziale).")
+        if st.button("🚀 Avvia Addestramento Modello", key="train_ml_button", disabled=active_job is not None):
+            # Passa l'intero DataFrame (la funzione train_model farà il preprocessing nel worker)
+            job_utils.submit_training_job(db_utils.DB_FILENAME, df_gare_ml, incremental=incremental_train)
+            st.rerun() # Riesegui per mostrare il pannello di avanzamento
+        show_job_panel(job_utils.TIPO_ADDESTRAMENTO, poll=active_job is not None, show_result=show_training_results)
+
+    with st.expander("🧪 Selezione Modello (Cross-Validation Temporale)"):
+        st.markdown("Confronta *Random Forest*, *HistGradientBoosting* e un modello *quantile* (mediana) su più combinazioni di iperparametri. "
+                    "Ogni fold addestra sulle gare passate e misura l'errore sulle gare successive per `data_gara`, come avviene in uso reale. "
+                    "Le valutazioni girano in parallelo su tutti i core e quelle già calcolate sugli stessi dati vengono riutilizzate.")
+        active_search = job_utils.get_latest_job(db_utils.DB_FILENAME, tipo=job_utils.TIPO_RICERCA, stati=job_utils.STATI_ATTIVI)
+        if st.button(f"🔎 Avvia Selezione Modello ({len(ml_utils.candidate_configs())} configurazioni)", key="search_ml_button", disabled=active_search is not None):
+            job_utils.submit_search_job(db_utils.DB_FILENAME, df_gare_ml)
+            st.rerun()
+        show_job_panel(job_utils.TIPO_RICERCA, poll=active_search is not None, show_result=show_search_results)
+
+# --- Versioni del Modello ---
+model_versions = model_store_utils.list_models()
+if model_versions:
+    with st.expander(f"🗂️ Versioni Modello ({len(model_versions)})"):
+        df_versions = pd.DataFrame([{
+            'Attiva': m.get('active', False),
+            'Versione': m['version_id'],
+            'Addestrato il': m.get('trained_at'),
+            'Campioni': m.get('n_samples'),
+            'MAE (%)': (m.get('metrics') or {}).get('mae'),
+            'R²': (m.get('metrics') or {}).get('r2'),
+            'Impronta Dati': (m.get('data_fingerprint') or '')[:12],
+            'Feature': ', '.join(m.get('features') or []),
+        } for m in model_versions])
+        st.dataframe(df_versions, hide_index=True, use_container_width=True,
+                     column_config={"MAE (%)": st.column_config.NumberColumn(format="%.4f"), "R²": st.column_config.NumberColumn(format="%.3f")})
+        pinned = model_store_utils.is_pinned()
+        st.caption("Versione attiva **bloccata**: i nuovi addestramenti vengono salvati ma non attivati." if pinned
+                   else "La versione attiva segue automaticamente l'ultimo addestramento.")
+        ver_col1, ver_col2, ver_col3 = st.columns([2, 1, 1])
+        with ver_col1:
+            version_to_pin = st.selectbox("Versione da attivare", options=[m['version_id'] for m in model_versions], key="model_version_select", label_visibility="collapsed")
+            if st.button("📌 Attiva e Blocca Versione", key="pin_model_button", use_container_width=True):
+                model_store_utils.pin_version(version_to_pin); st.rerun()
+        with ver_col2:
+            if st.button("↩️ Rollback", key="rollback_model_button", use_container_width=True, help="Torna alla versione precedente a quella attiva e la blocca."):
+                if model_store_utils.rollback(): st.rerun()
+                else: st.warning("Nessuna versione precedente disponibile.")
+        with ver_col3:
+            if st.button("🔓 Sblocca", key="unpin_model_button", use_container_width=True, disabled=not pinned, help="La versione attiva tornerà a seguire l'ultimo addestramento."):
+                model_store_utils.unpin(); st.rerun()
 
 # --- Sezione Previsione (se il modello esiste) ---
-model_exists = os.path.exists(ml_utils.MODEL_PATH)
+model_exists = model_store_utils.get_active_version() is not None
 if not model_exists:
     st.info("Il modello di previsione ML non è stato ancora addestrato. Addestralo usando l'opzione sopra (se i dati sono sufficienti).")
 else:
+    trace_utils.section('app.ml_previsione')
     st.subheader("🔮 Prevedi Soglia per Nuova Gara (con ML)")
     st.markdown("Inserisci i dati stimati di una nuova gara per ottenere una previsione della soglia di anomalia basata sul modello Machine Learning addestrato.")
 
@@ -1336,12 +1364,17 @@ else:
             pred_importo = st.number_input("Importo Base (€) Stimato*", value=None, format=CURRENCY_INTERNAL_FORMAT, step=1000.0, key="pred_imp", placeholder="Es: 250000.00", help="Importo base stimato della nuova gara.")
             pred_data = st.date_input("Data Gara Stimata*", value=datetime.date.today(), key="pred_data", help="Data di riferimento stimata (influenza anno/mese usati dal modello).")
         with c2_pred: # Input secondari/stimati
-            # Carica categorie valide DAL MODELLO salvato per coerenza
-            _, _, saved_encoders = ml_utils.load_model_and_dependencies()
+            # Categorie valide DAL MODELLO attivo: dai metadati (senza caricare il modello e sklearn);
+            # per modelli salvati prima che i metadati le contenessero si caricano gli encoder.
+            classi_modello = (model_store_utils.get_metadata() or {}).get('encoder_classes')
+            if classi_modello is None:
+                try: _, _, saved_encoders = ml_utils.load_model_and_dependencies()
+                except ml_utils.MLError as e: st.error(str(e)); saved_encoders = None
+                classi_modello = {col: [str(c) for c in le.classes_] for col, le in (saved_encoders or {}).items()}
             categorie_valide_modello = ["Sconosciuto"] # Opzione di default
-            if saved_encoders and 'categoria_lavori' in saved_encoders:
+            if 'categoria_lavori' in classi_modello:
                  # Prendi le classi dall'encoder salvato
-                 categorie_valide_modello.extend(list(saved_encoders['categoria_lavori'].classes_))
+                 categorie_valide_modello.extend(classi_modello['categoria_lavori'])
                  # Rimuovi eventuale 'Sconosciuto' duplicato se già presente nelle classi
                  categorie_valide_modello = sorted(list(set(categorie_valide_modello)))
                  if 'Sconosciuto' not in categorie_valide_modello: categorie_valide_modello.insert(0, 'Sconosciuto')
@@ -1354,7 +1387,13 @@ else:
             pred_categoria = st.selectbox("Categoria Stimata", options=categorie_valide_modello, index=0, key="pred_cat", help="Categoria stimata (seleziona 'Sconosciuto' se non nota). Deve essere una categoria vista durante l'addestramento.")
             # Stima numero concorrenti (usa mediana storica come default sensato)
             num_conc_med = df_gare_ml['numero_concorrenti'].median() if 'numero_concorrenti' in df_gare_ml and df_gare_ml['numero_concorrenti'].notna().any() else 10
+            # Stazioni appaltanti viste dal modello (le altre vengono trattate come sconosciute)
+            stazioni_modello = classi_modello['stazione_appaltante'] if 'stazione_appaltante' in classi_modello else sorted(df_gare_ml['stazione_appaltante'].dropna().astype(str).unique().tolist())
+            pred_stazione = st.selectbox("Stazione Appaltante Stimata", options=["Sconosciuto"] + [s for s in stazioni_modello if s != "Sconosciuto"], index=0, key="pred_stazione",
+                                         help="Ente che bandisce la gara: il modello usa la sua soglia media nelle gare precedenti.")
             pred_num_conc = st.number_input("Num. Concorrenti Stimato", value=int(num_conc_med) if pd.notna(num_conc_med) else 10, min_value=1, step=1, key="pred_conc", help="Numero stimato di concorrenti (influenza la previsione).")
+            pred_livello = st.select_slider("Livello Intervallo", options=[80, 90, 95], value=int(round((1 - ml_utils.INTERVAL_ALPHA) * 100)), format_func=lambda v: f"{v}%", key="pred_livello",
+                                            help="Probabilità che la soglia reale cada nell'intervallo mostrato accanto alla stima.")
 
         # Bottone per avviare la previsione
         predict_button = st.form_submit_button("⚡ Prevedi Soglia con ML", use_container_width=True, type="primary")
@@ -1369,16 +1408,85 @@ else:
                    'importo_base': float(pred_importo),
                    'data_gara': pred_data.strftime(DATE_FORMAT_STR), # Passa data come stringa YYYY-MM-DD
                    'categoria_lavori': pred_categoria, # Passa la categoria selezionata
+                   'stazione_appaltante': None if pred_stazione == "Sconosciuto" else pred_stazione,
                    'numero_concorrenti': int(pred_num_conc)
                    }
-                # Chiama la funzione di previsione
-                prediction = ml_utils.predict_soglia(input_features)
+                # Aggregati storici aggiornati alle gare attualmente nel DB
+                feature_store_utils.sync(df_gare_ml)
+                # Chiama la funzione di previsione (stima puntuale + intervallo)
+                try:
+                    with st.spinner("Esecuzione previsione ML..."):
+                        prediction = ml_utils.predict_soglia_interval(input_features, alpha=1 - pred_livello / 100)
+                except ml_utils.MLError as e:
+                    st.error(str(e)); prediction = None
                 # Mostra il risultato se la previsione ha successo
                 if prediction is not None:
-                    st.success(f"**Previsione Soglia ML Stimata: {prediction:.4f}%**")
+                    st.success(f"**Previsione Soglia ML Stimata: {prediction['prediction']:.4f}%**")
+                    if np.isfinite(prediction['lower']) and np.isfinite(prediction['upper']):
+                        st.info(f"Intervallo al {pred_livello}%: **{prediction['lower']:.4f}% – {prediction['upper']:.4f}%**")
+                        st.caption("Intervallo conformal: basato sugli errori del modello su gare non viste in addestramento." if prediction['method'] == 'conformal'
+                                   else "Intervallo dai quantili delle previsioni dei singoli alberi (modello senza residui di calibrazione).")
+                    else:
+                        st.caption("Intervallo non disponibile per questo modello: riaddestralo per calcolarlo.")
                     st.caption("Nota: Questa è una stima basata sul modello ML attualmente addestrato e sui dati forniti.")
-                # Gli errori vengono gestiti e mostrati da predict_soglia tramite st.error
+
+    # --- Previsione in blocco: gare nel DB senza soglia nota ---
+    with st.expander("📋 Previsione in Blocco (gare senza soglia nota)"):
+        df_senza_soglia = df_gare_ml[df_gare_ml[target_col].isna()] if target_col in df_gare_ml.columns else pd.DataFrame()
+        if df_senza_soglia.empty:
+            st.info("Nessuna gara nel database senza soglia di anomalia.")
+        else:
+            st.caption(f"{len(df_senza_soglia)} gare senza soglia: stima e intervallo calcolati in un'unica passata sul modello attivo.")
+            batch_livello = st.select_slider("Livello Intervallo", options=[80, 90, 95], value=int(round((1 - ml_utils.INTERVAL_ALPHA) * 100)), format_func=lambda v: f"{v}%", key="batch_livello")
+            batch_metodo = st.radio("Metodo Intervallo", options=list(ml_utils.INTERVAL_METHODS), horizontal=True, key="batch_metodo",
+                                    format_func=lambda m: "Conformal (residui)" if m == 'conformal' else "Quantili alberi")
+            if st.button("⚡ Prevedi Soglie", key="batch_predict_button", use_container_width=True):
+                feature_store_utils.sync(df_gare_ml)
+                try:
+                    with st.spinner("Esecuzione previsione ML..."):
+                        batch_pred = ml_utils.predict_soglia_batch(df_senza_soglia, alpha=1 - batch_livello / 100, method=batch_metodo)
+                except ml_utils.MLError as e:
+                    st.error(str(e)); batch_pred = None
+                if batch_pred is not None:
+                    df_batch = df_senza_soglia[['identificativo_gara', 'data_gara', 'importo_base', 'categoria_lavori', 'numero_concorrenti']].join(batch_pred)
+                    st.dataframe(df_batch, hide_index=True, use_container_width=True,
+                                 column_config={"importo_base": st.column_config.NumberColumn("Importo Base", format="€ %.2f"),
+                                                "data_gara": st.column_config.DateColumn("Data Gara", format=DATE_FORMAT_STR),
+                                                "soglia_prevista": st.column_config.NumberColumn("Soglia Prevista", format="%.4f%%"),
+                                                "soglia_min": st.column_config.NumberColumn(f"Min ({batch_livello}%)", format="%.4f%%"),
+                                                "soglia_max": st.column_config.NumberColumn(f"Max ({batch_livello}%)", format="%.4f%%")})
+                    st.download_button("📥 Scarica Previsioni (CSV)",
+                                       data=df_batch.to_csv(index=False, sep=';', decimal=',', date_format=DATE_FORMAT_STR, encoding='utf-8-sig').encode('utf-8-sig'),
+                                       file_name=f"previsioni_soglia_{datetime.date.today().strftime('%Y%m%d')}.csv", mime="text/csv", key="batch_download_button")
 
 # --- Footer ---
+trace_utils.section('app.footer')
 st.sidebar.divider()
-st.sidebar.caption(f"Analisi Gare Appalto v1.7 - DB: {db_utils.DB_FILENAME}")
\ No newline at end of file
+st.sidebar.caption(f"Analisi Gare Appalto v1.7 - DB: {db_utils.DB_FILENAME}")
+
+# --- Tempi di Esecuzione (diagnostica) ---
+trace_run = trace_utils.end_run()
+with st.sidebar.expander("⏱️ Tempi di Esecuzione", expanded=trace_run is not None):
+    st.checkbox("Misura i tempi di ogni rerun", key="trace_enabled", help="Tempo per sezione della pagina, query DB, importazione e ML.")
+    if trace_run is not None:
+        st.caption(f"Ultimo rerun: {trace_run.duration:,.0f} ms")
+        df_trace = pd.DataFrame(trace_utils.summary(trace_run))
+        if not df_trace.empty:
+            df_trace['nome'] = ["  " * livello + nome for livello, nome in zip(df_trace['livello'], df_trace['nome'])] # Rientro = annidamento
+            st.dataframe(df_trace.drop(columns='livello'), hide_index=True, use_container_width=True,
+                         column_config={"totale_ms": st.column_config.NumberColumn("Totale (ms)", format="%.1f"),
+                                        "max_ms": st.column_config.NumberColumn("Max (ms)", format="%.1f"),
+                                        "quota_%": st.column_config.NumberColumn("Quota", format="%.0f%%")})
+        if trace_run.counters:
+            st.caption(" · ".join(f"{nome}: {valore:,}" for nome, valore in trace_run.counters.items()))
+        record_stats = db_utils.record_cache_stats()
+        st.caption("Cache gare per ID: " + " · ".join(f"{nome}: {valore:,}" for nome, valore in record_stats.items()))
+        if not df_gare.empty:
+            df_memoria = analysis_utils.memory_report(df_gare)
+            st.caption(f"Tabella gare in cache: {df_memoria['kb'].sum() / 1024:,.2f} MB per copia ({len(df_gare):,} righe)")
+            st.dataframe(df_memoria.head(8), hide_index=True, use_container_width=True,
+                         column_config={"kb": st.column_config.NumberColumn("KB", format="%.1f")})
+        st.download_button("📥 Esporta Log Tempi (JSONL)", data=trace_utils.export_jsonl().encode('utf-8'),
+                           file_name=f"tempi_rerun_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+                           mime="application/json", key="trace_download_button",
+                           help=f"Ultimi {trace_utils.HISTORY_SIZE} rerun misurati (uno per riga).")
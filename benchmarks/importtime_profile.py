@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Profilo dei tempi di import dei moduli dell'app (basato su `python -X importtime`).
+
+Esegue gli import di primo livello di app.py (quelli eseguiti prima di disegnare la pagina; app.py
+stesso non si importa perché esegue l'interfaccia) in un processo pulito, più volte tenendo la mediana,
+somma il tempo cumulativo dei pacchetti di primo livello e stampa/scrive un report Markdown.
+Con --prima REV misura anche l'albero del repository alla revisione REV (git archive), con gli import
+del suo app.py, e il report affianca le due misure.
+
+Uso (dalla radice del repository):
+    python benchmarks/importtime_profile.py [--runs 5] [--prima d8b9f57] [--output benchmarks/importtime_report.md]
+"""
+import argparse
+import ast
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+from contextlib import contextmanager
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Dipendenze pesanti che dovrebbero essere caricate solo quando servono
+HEAVY_PACKAGES = ['plotly', 'sklearn', 'scipy', 'joblib']
+
+def app_modules(root=REPO_ROOT):
+    """Moduli importati a livello di modulo da app.py (nell'ordine, senza ripetizioni)."""
+    with open(os.path.join(root, 'app.py'), encoding='utf-8') as f: tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import): modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and not node.level: modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+@contextmanager
+def checkout(revision):
+    """Directory temporanea con l'albero del repository alla revisione indicata."""
+    archive = subprocess.run(['git', 'archive', '--format=tar', revision], cwd=REPO_ROOT, capture_output=True, check=True).stdout
+    with tempfile.TemporaryDirectory() as root:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar: tar.extractall(root)
+        yield root
+
+def _run_importtime(modules, root=REPO_ROOT):
+    """
+    Ritorna ({pacchetto di primo livello: microsecondi cumulativi}, totale, pacchetti importati a
+    qualunque livello) per un singolo processo, con i moduli dell'app presi da root.
+    """
+    code = "; ".join(f"import {m}" for m in modules)
+    env = {**os.environ, 'PYTHONPATH': root + os.pathsep + os.environ.get('PYTHONPATH', '')}
+    # Directory temporanea: db_utils crea il DB nella cwd, il repository non viene toccato
+    with tempfile.TemporaryDirectory() as cwd:
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                              capture_output=True, text=True, check=True)
+    packages, loaded = {}, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        top = name.strip().split('.')[0]
+        loaded.add(top)
+        if name.startswith('  '): continue # Import annidato: già contato nel cumulativo del padre
+        packages[top] = packages.get(top, 0) + int(cumulative)
+    return packages, sum(packages.values()), loaded
+
+def profile(modules, runs, root=REPO_ROOT):
+    """Mediana su più processi dei tempi per pacchetto (ms) e del totale (ms)."""
+    samples = [_run_importtime(modules, root) for _ in range(runs)]
+    names = {name for packages, _, _ in samples for name in packages}
+    per_package = {name: statistics.median(p.get(name, 0) for p, _, _ in samples) / 1000 for name in names}
+    return per_package, statistics.median(total for _, total, _ in samples) / 1000, samples[0][2]
+
+def format_report(per_package, total, runs, loaded, top=12):
+    lines = [f"Tempo totale di import (mediana su {runs} processi): **{total:.0f} ms**", "",
+             "| Pacchetto | ms (cumulativo) |", "|---|---:|"]
+    for name, ms in sorted(per_package.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"| {name} | {ms:.0f} |")
+    loaded_heavy = [p for p in HEAVY_PACKAGES if p in loaded]
+    lines += ["", f"Dipendenze pesanti caricate all'avvio: {', '.join(loaded_heavy) if loaded_heavy else 'nessuna'}"]
+    return "\n".join(lines)
+
+def format_section(title, modules, runs, root=REPO_ROOT):
+    per_package, total, loaded = profile(modules, runs, root)
+    return "\n".join([f"## {title}", "", f"Moduli: `{' '.join(modules)}`", "", format_report(per_package, total, runs, loaded)])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="Processi da misurare (si usa la mediana).")
+    parser.add_argument('--modules', nargs='+', help="Moduli da importare (default: gli import di primo livello di app.py).")
+    parser.add_argument('--prima', metavar='REV', help="Revisione git da misurare per confronto (es. il commit precedente a una modifica).")
+    parser.add_argument('--output', help="File Markdown in cui scrivere il report.")
+    args = parser.parse_args()
+
+    command = " ".join(['python benchmarks/importtime_profile.py'] + sys.argv[1:])
+    sections = ["# Profilo tempi di import all'avvio", "",
+                f"Generato con `{command}` (`python -X importtime`, processo pulito, mediana di {args.runs} esecuzioni)."]
+    if args.prima:
+        with checkout(args.prima) as root:
+            sections += ["", format_section(f"Prima ({args.prima})", args.modules or app_modules(root), args.runs, root)]
+        sections += ["", format_section("Dopo (albero di lavoro)", args.modules or app_modules(), args.runs)]
+    else:
+        sections += ["", format_section("Albero di lavoro", args.modules or app_modules(), args.runs)]
+    report = "\n".join(sections)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: f.write(report + "\n")
+
+if __name__ == '__main__':
+    main()
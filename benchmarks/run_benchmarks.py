@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark dei percorsi critici dell'app su gare sintetiche (10k, 100k, 1M righe).
+
+Per ogni dimensione genera le gare (benchmarks/synthetic_data.py, seme fisso), le scrive in CSV/Excel
+formattati all'italiana e misura, in una directory temporanea con DB e ml_model/ propri:
+lettura e pulizia file, importazione (staging e INSERT ... SELECT), get_all_gare (da SQLite, da snapshot e dalla cache),
+opzioni e blocco filtri, analisi per segmenti, preprocess_data (feature store vuoto e già popolato),
+train_model e previsione della soglia (batch e gara singola).
+
+Gli scenari veloci vengono ripetuti (si tiene la mediana); quelli lenti sono eseguiti una volta e,
+oltre un numero di righe (LIMITI), saltati salvo --senza-limiti. Il report JSON può essere passato
+come --baseline a un'esecuzione successiva: le variazioni oltre --soglia-regressione sono segnalate
+e il codice di uscita diventa 1.
+
+Uso (dalla radice del repository):
+    python benchmarks/run_benchmarks.py [--sizes 10000 100000 1000000] [--scenari load_csv filtri ...]
+                                        [--output benchmarks/risultati.json] [--baseline vecchi.json]
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd
+
+import synthetic_data
+
+SCENARI = ['load_csv', 'load_excel', 'import', 'get_all_gare_sql', 'get_all_gare_snapshot', 'get_all_gare_cache', 'opzioni_filtri', 'filtri', 'segmenti',
+           'preprocess_cold', 'preprocess_warm', 'train', 'predict_batch', 'predict_singola']
+# Righe oltre le quali uno scenario lento viene saltato (minuti per dimensione); --senza-limiti li ignora
+LIMITI = {'load_excel': 100_000, 'train': 200_000}
+TRAIN_SAMPLE = 50_000 # Gare usate per il modello di previsione quando 'train' è saltato
+PREDICT_SINGOLA = {'importo_base': 350000.0, 'data_gara': '2025-06-01', 'categoria_lavori': 'OG1',
+                   'stazione_appaltante': 'Comune di Milano', 'numero_concorrenti': 15}
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    """Silenzia le stampe dei moduli dell'app durante le misure (il costo di formattazione resta)."""
+    if verbose:
+        yield; return
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+def _measure(fn, repeat, setup=None, verbose=False):
+    """Esegue setup() (non misurato) e fn() repeat volte; ritorna (tempi in secondi, ultimo risultato)."""
+    times, result = [], None
+    for _ in range(repeat):
+        with _quiet(verbose):
+            if setup: setup()
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+    return times, result
+
+def _bulk_insert(db_utils, df_clean):
+    """Popola il DB senza passare dal ciclo di importazione (preparazione degli scenari successivi)."""
+    df_db = df_clean.copy()
+    df_db['data_gara'] = df_db['data_gara'].dt.strftime('%Y-%m-%d')
+    df_db['posizione_in_graduatoria'] = df_db['posizione_in_graduatoria'].where(df_db['posizione_in_graduatoria'] != 0)
+    conn = db_utils.init_connection()
+    df_db.to_sql('gare', conn, if_exists='append', index=False, chunksize=50_000)
+    conn.commit()
+
+def run_size(n, scenari, repeat, seed, no_limits, verbose, workdir):
+    """Esegue gli scenari su n gare in workdir (DB, snapshot e ml_model/ isolati). Ritorna la lista dei risultati."""
+    os.chdir(workdir) # DB e snapshot di db_utils sono relativi alla cwd
+    with _quiet(verbose):
+        import cache_utils, db_utils, import_utils, analysis_utils, ml_utils, feature_store_utils
+
+    results = []
+    def record(scenario, times, note=""):
+        entry = {'scenario': scenario, 'righe': n, 'secondi': statistics.median(times), 'min': min(times),
+                 'ripetizioni': len(times), 'note': note}
+        results.append(entry)
+        print(f"  {scenario:<22} {entry['secondi']:9.3f} s  (min {entry['min']:.3f}, x{len(times)}){'  ' + note if note else ''}")
+
+    def skipped(scenario):
+        limit = LIMITI.get(scenario)
+        if scenario not in scenari: return True
+        if limit and n > limit and not no_limits:
+            results.append({'scenario': scenario, 'righe': n, 'secondi': None, 'min': None, 'ripetizioni': 0,
+                            'note': f"saltato (> {limit} righe)"})
+            print(f"  {scenario:<22} saltato (> {limit} righe, usa --senza-limiti)"); return True
+        return False
+
+    cache_utils.clear_all() # Connessione, modelli e dati del workdir precedente
+    with _quiet(verbose): db_utils.create_table()
+
+    start = time.perf_counter()
+    df_source = synthetic_data.generate_gare(n, seed=seed)
+    csv_path = os.path.join(workdir, 'gare.csv')
+    synthetic_data.write_file(df_source, csv_path)
+    print(f"  (generazione e scrittura CSV: {time.perf_counter() - start:.1f} s)")
+
+    # --- Lettura file ---
+    df_clean = None
+    if not skipped('load_csv'):
+        times, loaded = _measure(lambda: import_utils.load_path(csv_path), repeat, verbose=verbose)
+        record('load_csv', times); df_clean = loaded['df']
+    if df_clean is None: # Serve comunque il DataFrame pulito per gli scenari successivi
+        with _quiet(verbose): df_clean = import_utils.load_path(csv_path)['df']
+    if not skipped('load_excel'):
+        xlsx_path = os.path.join(workdir, 'gare.xlsx')
+        synthetic_data.write_file(df_source, xlsx_path)
+        times, _ = _measure(lambda: import_utils.load_path(xlsx_path), 1, verbose=verbose)
+        record('load_excel', times)
+
+    # --- Importazione ---
+    if not skipped('import'):
+        times, esito = _measure(lambda: import_utils.import_dataframe(df_clean), 1, verbose=verbose)
+        record('import', times, f"{esito['importate'] / times[0]:.0f} righe/s")
+    else:
+        with _quiet(verbose): _bulk_insert(db_utils, df_clean)
+
+    # --- Lettura gare ---
+    def drop_snapshot():
+        db_utils.clear_all_cache()
+        if os.path.exists(db_utils.SNAPSHOT_PATH): os.remove(db_utils.SNAPSHOT_PATH)
+    if 'get_all_gare_sql' in scenari:
+        times, _ = _measure(db_utils.get_all_gare, repeat, setup=drop_snapshot, verbose=verbose)
+        record('get_all_gare_sql', times)
+    with _quiet(verbose):
+        db_utils.clear_all_cache()
+        df_gare = db_utils.get_all_gare() # Scrive lo snapshot se mancante
+    memoria_mb = analysis_utils.memory_report(df_gare)['kb'].sum() / 1024
+    if 'get_all_gare_snapshot' in scenari:
+        times, _ = _measure(db_utils.get_all_gare, repeat, setup=db_utils.clear_all_cache, verbose=verbose)
+        record('get_all_gare_snapshot', times, "" if db_utils.pa is not None else "pyarrow non installato: legge SQLite")
+    if 'get_all_gare_cache' in scenari: # Costo per rerun a dati invariati: controllo versione + copia dalla cache
+        with _quiet(verbose): db_utils.get_all_gare()
+        times, _ = _measure(db_utils.get_all_gare, repeat, verbose=verbose)
+        record('get_all_gare_cache', times, f"{memoria_mb:.1f} MB per copia in cache")
+
+    # --- Dashboard ---
+    if 'opzioni_filtri' in scenari: # Aggregati SQL sugli indici, cache svuotata ad ogni ripetizione
+        times, _ = _measure(db_utils.get_filter_options, repeat, setup=db_utils.clear_all_cache, verbose=verbose)
+        record('opzioni_filtri', times, "MIN/MAX e DISTINCT in SQL")
+    if 'filtri' in scenari:
+        max_date = df_gare['data_gara'].max()
+        def filter_block(): # Come l'app: tipi riassicurati, ultimo anno, una categoria, tutti gli importi
+            df = analysis_utils.normalize_types(df_gare.copy())
+            return analysis_utils.apply_filters(df, date_range=(max_date - pd.Timedelta(days=365), max_date), categoria='OG1',
+                                                importo_range=(df['importo_base'].min(), df['importo_base'].max()))
+        times, df_filtered = _measure(filter_block, repeat, verbose=verbose)
+        record('filtri', times, f"{len(df_filtered)} gare filtrate")
+    if 'segmenti' in scenari:
+        def segments():
+            return [analysis_utils.segment_stats(df_gare, tipo) for tipo in (analysis_utils.SEGMENTO_CATEGORIA, analysis_utils.SEGMENTO_IMPORTO)]
+        times, _ = _measure(segments, repeat, verbose=verbose)
+        record('segmenti', times, "categoria + fascia importo")
+
+    # --- ML ---
+    if 'preprocess_cold' in scenari:
+        times, _ = _measure(lambda: ml_utils.preprocess_data(df_gare, fit_encoders=True), repeat,
+                            setup=feature_store_utils.clear_store, verbose=verbose)
+        record('preprocess_cold', times, "feature store vuoto")
+    if 'preprocess_warm' in scenari:
+        with _quiet(verbose): ml_utils.preprocess_data(df_gare, fit_encoders=True) # Popola il feature store
+        times, _ = _measure(lambda: ml_utils.preprocess_data(df_gare, fit_encoders=True), repeat, verbose=verbose)
+        record('preprocess_warm', times, "feature store popolato")
+
+    need_model = 'predict_batch' in scenari or 'predict_singola' in scenari
+    if not skipped('train'):
+        times, train_result = _measure(lambda: ml_utils.train_model(df_gare), 1, verbose=verbose)
+        record('train', times, f"{train_result['n_samples']} campioni")
+    elif need_model:
+        with _quiet(verbose): ml_utils.train_model(df_gare.sample(min(n, TRAIN_SAMPLE), random_state=seed))
+    if need_model:
+        cache_utils.clear_all() # Il modello attivo è cambiato: si parte da cache fredde come dopo un riavvio
+        df_predict = df_gare[df_gare[ml_utils.TARGET_COLUMN].isna()]
+        if 'predict_batch' in scenari:
+            times, _ = _measure(lambda: ml_utils.predict_soglia_batch(df_predict), repeat, verbose=verbose)
+            record('predict_batch', times, f"{len(df_predict)} gare senza soglia")
+        if 'predict_singola' in scenari:
+            times, _ = _measure(lambda: ml_utils.predict_soglia_interval(PREDICT_SINGOLA), max(repeat, 5), verbose=verbose)
+            record('predict_singola', times)
+    return results
+
+def _metadata(sizes, repeat, seed):
+    def version(module):
+        try: return __import__(module).__version__
+        except Exception: return None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {'data': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'python': platform.python_version(),
+            'piattaforma': platform.platform(), 'cpu': os.cpu_count(), 'dimensioni': sizes, 'ripetizioni': repeat, 'seed': seed,
+            'versioni': {m: version(m) for m in ['pandas', 'numpy', 'sklearn', 'pyarrow']}}
+
+def _key(entry):
+    return (entry['scenario'], entry['righe'])
+
+def compare(results, baseline, threshold):
+    """Variazione % rispetto alla baseline per (scenario, righe) e lista delle regressioni oltre la soglia."""
+    base = {_key(e): e['secondi'] for e in baseline.get('risultati', []) if e.get('secondi')}
+    deltas, regressions = {}, []
+    for entry in results:
+        old = base.get(_key(entry))
+        if old and entry['secondi'] is not None:
+            deltas[_key(entry)] = (entry['secondi'] - old) / old * 100
+            if deltas[_key(entry)] > threshold: regressions.append((entry, old, deltas[_key(entry)]))
+    return deltas, regressions
+
+def format_report(meta, results, deltas=None, regressions=None, baseline_meta=None):
+    """Report Markdown: una riga per scenario, una colonna per dimensione (mediana, variazione vs baseline)."""
+    sizes = sorted({e['righe'] for e in results})
+    cells = {_key(e): e for e in results}
+    lines = [f"Benchmark del {meta['data']} (commit {meta['commit'] or 'n/d'}, Python {meta['python']}, {meta['cpu']} CPU, "
+             f"mediana su {meta['ripetizioni']} ripetizioni per gli scenari veloci)"]
+    if baseline_meta:
+        lines.append(f"Confronto con la baseline del {baseline_meta.get('data')} (commit {baseline_meta.get('commit') or 'n/d'})")
+    lines += ["", "| Scenario | " + " | ".join(f"{n:,} gare".replace(",", ".") for n in sizes) + " |",
+              "|---|" + "---:|" * len(sizes)]
+    for scenario in [s for s in SCENARI if any(e['scenario'] == s for e in results)]:
+        row = []
+        for n in sizes:
+            entry = cells.get((scenario, n))
+            if entry is None: row.append(""); continue
+            if entry['secondi'] is None: row.append("saltato"); continue
+            cell = f"{entry['secondi']:.3f} s"
+            if deltas and (scenario, n) in deltas: cell += f" ({deltas[(scenario, n)]:+.0f}%)"
+            row.append(cell)
+        lines.append(f"| {scenario} | " + " | ".join(row) + " |")
+    if regressions is not None:
+        lines += ["", "Regressioni: " + ("nessuna" if not regressions else "")]
+        for entry, old, delta in regressions:
+            lines.append(f"- {entry['scenario']} ({entry['righe']} gare): {old:.3f} s -> {entry['secondi']:.3f} s ({delta:+.0f}%)")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dell'app su gare sintetiche.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help="Numero di gare per esecuzione.")
+    parser.add_argument('--scenari', nargs='+', default=SCENARI, choices=SCENARI, help="Scenari da eseguire (default: tutti).")
+    parser.add_argument('--repeat', type=int, default=3, help="Ripetizioni degli scenari veloci (si usa la mediana).")
+    parser.add_argument('--seed', type=int, default=42, help="Seme del generatore di gare.")
+    parser.add_argument('--senza-limiti', action='store_true', help="Esegue anche gli scenari lenti oltre i limiti di righe.")
+    parser.add_argument('--output', help="File JSON dei risultati (accanto viene scritto il report .md).")
+    parser.add_argument('--baseline', help="JSON di un'esecuzione precedente con cui confrontare i tempi.")
+    parser.add_argument('--soglia-regressione', type=float, default=20.0, help="Peggioramento %% oltre il quale segnalare una regressione.")
+    parser.add_argument('--verbose', action='store_true', help="Mostra stampe e log (livello INFO) dei moduli dell'app.")
+    args = parser.parse_args()
+
+    import log_utils
+    log_utils.configure(level='INFO' if args.verbose else 'WARNING', force=True) # I log vanno su stderr: _quiet non li intercetta
+    meta = _metadata(args.sizes, args.repeat, args.seed)
+    results, cwd = [], os.getcwd()
+    try:
+        for n in args.sizes:
+            print(f"\n== {n} gare ==")
+            # Directory temporanea: DB, snapshot e ml_model/ isolati, il repository non viene toccato
+            with tempfile.TemporaryDirectory(prefix=f"bench_{n}_") as workdir:
+                results += run_size(n, args.scenari, args.repeat, args.seed, args.senza_limiti, args.verbose, workdir)
+                os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+
+    deltas = regressions = baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f: baseline = json.load(f)
+        deltas, regressions = compare(results, baseline, args.soglia_regressione)
+    report = format_report(meta, results, deltas, regressions, baseline['meta'] if baseline else None)
+    print("\n" + report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump({'meta': meta, 'risultati': results}, f, indent=2)
+        with open(os.path.splitext(args.output)[0] + '.md', 'w', encoding='utf-8') as f: f.write(report + "\n")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
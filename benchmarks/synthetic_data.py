@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Generatore di gare sintetiche realistiche per i benchmark.
+
+Le gare imitano gli export reali: CIG alfanumerici, categorie OG/OS con frequenze sbilanciate,
+importi a distribuzione log-normale (molte gare piccole, poche milionarie), stazioni appaltanti
+con poche grandi e molte piccole, soglie legate a categoria/stazione/concorrenti ed esiti coerenti.
+I file sono scritti come li produce un ufficio gare italiano: separatore ';', virgola decimale,
+punto delle migliaia, date gg/mm/aaaa e intestazioni "umane" (mappate da import_utils).
+
+Uso (dalla radice del repository):
+    python benchmarks/synthetic_data.py 10000 gare_10k.csv [--seed 42]
+    python benchmarks/synthetic_data.py 10000 gare_10k.xlsx
+"""
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+
+# Categorie SOA: (codice, peso relativo, effetto medio sulla soglia in punti %)
+CATEGORIE = [('OG1', 22, 0.8), ('OG3', 20, 1.5), ('OG2', 6, -1.2), ('OG6', 9, 0.9), ('OG8', 4, 0.3), ('OG10', 4, -0.6),
+             ('OG11', 8, -0.4), ('OG12', 2, -0.8), ('OG13', 1, -1.0), ('OS3', 2, 0.2), ('OS6', 3, 0.4), ('OS18-A', 2, -1.5),
+             ('OS21', 2, -0.3), ('OS23', 3, 1.1), ('OS24', 4, 1.3), ('OS28', 3, -0.5), ('OS30', 3, -0.2), ('OS32', 1, 0.0)]
+TIPI_ENTE = ['Comune di', 'Comune di', 'Comune di', 'Provincia di', 'Unione dei Comuni di', 'ASL', 'Consorzio di Bonifica', 'ATER']
+LOCALITA = ['Milano', 'Roma', 'Napoli', 'Torino', 'Bari', 'Palermo', 'Bologna', 'Firenze', 'Genova', 'Verona', 'Padova',
+            'Brescia', 'Bergamo', 'Salerno', 'Lecce', 'Catania', 'Perugia', 'Ancona', 'Pescara', 'Cagliari', 'Trento',
+            'Udine', 'Parma', 'Modena', 'Reggio Emilia', 'Latina', 'Caserta', 'Foggia', 'Taranto', 'Cosenza']
+LAVORI = ['Lavori di manutenzione straordinaria', 'Riqualificazione', 'Adeguamento sismico', 'Efficientamento energetico',
+          'Messa in sicurezza', 'Ristrutturazione', 'Realizzazione', 'Completamento', 'Rifacimento']
+OGGETTI = ['della scuola primaria', 'delle strade comunali', 'del palazzo municipale', 'della rete idrica', 'del depuratore',
+           'della palestra comunale', 'dei marciapiedi', 'del cimitero', 'della pubblica illuminazione', 'del ponte sul torrente',
+           'della caserma', 'degli alloggi ERP', 'del centro sportivo', 'della rete fognaria']
+# Intestazioni dei file generati (chiavi riconosciute da import_utils.COLUMN_MAPPING)
+FILE_HEADERS = {
+    'identificativo_gara': 'CIG', 'descrizione': 'Oggetto', 'data_gara': 'Data', 'importo_base': "Importo a base d'asta",
+    'categoria_lavori': 'Categoria prevalente', 'stazione_appaltante': 'Stazione appaltante',
+    'mio_ribasso_percentuale': 'Mio ribasso %', 'soglia_anomalia_calcolata': 'Soglia anomalia (%)',
+    'ribasso_aggiudicatario_percentuale': 'Ribasso aggiudicatario (%)', 'numero_concorrenti': 'Num. offerte',
+    'posizione_in_graduatoria': 'Posizione graduatoria', 'esito': 'Esito', 'note': 'Note'
+}
+
+def _stazioni(rng, n_stazioni):
+    """Nomi delle stazioni appaltanti e relativo effetto sulla soglia."""
+    nomi = [f"{rng.choice(TIPI_ENTE)} {LOCALITA[i % len(LOCALITA)]}" + (f" ({i // len(LOCALITA)})" if i >= len(LOCALITA) else "")
+            for i in range(n_stazioni)]
+    return np.array(nomi, dtype=object), rng.normal(0, 1.2, n_stazioni)
+
+def generate_gare(n, seed=42, start=datetime.date(2015, 1, 1), end=datetime.date(2025, 12, 31)) -> pd.DataFrame:
+    """
+    Genera n gare con le colonne del DB (tipi già puliti, come dopo import_utils.clean_data).
+    Stesso seed -> stesse gare: i benchmark restano confrontabili tra esecuzioni.
+    """
+    rng = np.random.default_rng(seed)
+    codici, pesi, effetti_cat = zip(*CATEGORIE)
+    cat_idx = rng.choice(len(codici), size=n, p=np.array(pesi) / sum(pesi))
+
+    # Stazioni: pesi tipo Zipf (pochi enti con molte gare, coda lunga di enti piccoli)
+    nomi_sa, effetti_sa = _stazioni(rng, max(10, n // 40))
+    pesi_sa = (np.arange(len(nomi_sa)) + 5.0) ** -1.05
+    sa_idx = rng.choice(len(nomi_sa), size=n, p=pesi_sa / pesi_sa.sum())
+
+    giorni = (end - start).days
+    data_gara = pd.to_datetime(start) + pd.to_timedelta(rng.integers(0, giorni + 1, size=n), unit='D')
+    # Importi log-normali (mediana ~300k), limitati ai valori tipici dei lavori pubblici
+    importo = np.clip(np.round(rng.lognormal(np.log(300_000), 1.1, size=n), 2), 40_000, 25_000_000)
+    # Più concorrenti nelle gare piccole
+    concorrenti = 2 + rng.negative_binomial(2, 2 / (2 + 12 * (300_000 / importo) ** 0.25), size=n)
+
+    anni = data_gara.year.to_numpy() - start.year
+    soglia = (24 + np.array(effetti_cat)[cat_idx] + effetti_sa[sa_idx] + 1.1 * np.log(concorrenti) + 0.15 * anni
+              + rng.normal(0, 1.5, size=n))
+    soglia = np.round(np.clip(soglia, 5, 45), 4)
+    mio_ribasso = np.round(soglia + rng.normal(-1.0, 1.2, size=n), 4)
+    ribasso_agg = np.round(soglia - rng.exponential(0.35, size=n), 4)
+
+    # Esiti coerenti con ribasso e soglia; una parte delle gare è ancora in corso (soglia non nota)
+    esito = np.where(mio_ribasso > soglia, 'Esclusa (Anomala)', 'Persa').astype(object)
+    vinta = (mio_ribasso <= soglia) & (mio_ribasso >= ribasso_agg)
+    esito[vinta] = 'Aggiudicata'
+    ribasso_agg = np.where(vinta, mio_ribasso, ribasso_agg)
+    esito[rng.random(n) < 0.02] = 'Annullata'
+    in_corso = data_gara > pd.Timestamp(end) - pd.Timedelta(days=120)
+    in_corso |= rng.random(n) < 0.05
+    esito[in_corso] = 'In corso'
+
+    posizione = np.where(esito == 'Aggiudicata', 1.0, np.nan)
+    persa = esito == 'Persa'
+    posizione[persa] = 2 + np.floor(rng.random(persa.sum()) * np.maximum(concorrenti[persa] - 1, 1))
+
+    df = pd.DataFrame({
+        'identificativo_gara': [f"{c:010X}" for c in rng.choice(16 ** 10, size=n, replace=False)], # CIG univoci
+        'descrizione': (np.array(LAVORI)[rng.integers(0, len(LAVORI), n)].astype(object) + " "
+                        + np.array(OGGETTI)[rng.integers(0, len(OGGETTI), n)].astype(object)),
+        'data_gara': data_gara,
+        'importo_base': importo,
+        'categoria_lavori': np.array(codici)[cat_idx],
+        'stazione_appaltante': nomi_sa[sa_idx],
+        'mio_ribasso_percentuale': mio_ribasso,
+        'soglia_anomalia_calcolata': np.where(in_corso, np.nan, soglia),
+        'ribasso_aggiudicatario_percentuale': np.where(in_corso, np.nan, ribasso_agg),
+        'numero_concorrenti': np.where(in_corso, np.nan, concorrenti),
+        'posizione_in_graduatoria': posizione,
+        'esito': esito,
+        'note': np.where(rng.random(n) < 0.1, "Sopralluogo obbligatorio", None),
+    })
+    # Buchi tipici degli export: stazione o categoria non compilate
+    df.loc[rng.random(n) < 0.01, 'stazione_appaltante'] = None
+    df.loc[rng.random(n) < 0.005, 'categoria_lavori'] = None
+    return df
+
+def _italian_number(series, decimals):
+    """1234567.891 -> '1.234.567,89' (vuoto per NaN)."""
+    return series.map(lambda v: "" if pd.isna(v) else f"{v:,.{decimals}f}".replace(",", "_").replace(".", ",").replace("_", "."))
+
+def to_file_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Gare -> DataFrame di testo formattato all'italiana con le intestazioni dei file."""
+    out = pd.DataFrame(index=df.index)
+    for col, header in FILE_HEADERS.items():
+        values = df[col]
+        if col == 'data_gara':
+            out[header] = values.dt.strftime('%d/%m/%Y')
+        elif col == 'importo_base':
+            out[header] = _italian_number(values, 2)
+        elif col in ('mio_ribasso_percentuale', 'soglia_anomalia_calcolata', 'ribasso_aggiudicatario_percentuale'):
+            out[header] = _italian_number(values, 4)
+        elif col in ('numero_concorrenti', 'posizione_in_graduatoria'):
+            out[header] = values.map(lambda v: "" if pd.isna(v) else str(int(v)))
+        else:
+            out[header] = values
+    return out
+
+def write_file(df: pd.DataFrame, path: str) -> None:
+    """Scrive le gare in CSV (';', UTF-8) o Excel secondo l'estensione di path."""
+    file_df = to_file_frame(df)
+    if path.lower().endswith('.csv'):
+        file_df.to_csv(path, sep=';', index=False, encoding='utf-8')
+    elif path.lower().endswith(('.xls', '.xlsx')):
+        file_df.to_excel(path, index=False)
+    else:
+        raise ValueError(f"Estensione non supportata: {path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera un file di gare sintetiche (CSV o Excel).")
+    parser.add_argument('n', type=int, help="Numero di gare.")
+    parser.add_argument('output', help="File .csv o .xlsx da scrivere.")
+    parser.add_argument('--seed', type=int, default=42, help="Seme del generatore (stesso seme = stesse gare).")
+    args = parser.parse_args()
+    write_file(generate_gare(args.n, seed=args.seed), args.output)
+    print(f"Scritte {args.n} gare in {args.output}.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Cache dei moduli core (db_utils, ml_utils, ...) indipendente dall'interfaccia.
+
+Le funzioni si decorano con @cached('data' | 'resource', ttl=..., max_entries=...). Il backend è
+intercambiabile: di default una cache in memoria del processo (CLI, worker, benchmark); l'app
+Streamlit installa streamlit_backend per usare st.cache_data / st.cache_resource.
+Come in Streamlit, i parametri il cui nome inizia con '_' non fanno parte della chiave.
+
+- 'data': valori copiati ad ogni lettura (il chiamante può modificarli senza alterare la cache).
+- 'resource': stesso oggetto condiviso (connessioni, modelli, pool di processi).
+
+LRUCache è una cache per chiave con invalidazione mirata (es. i record letti per ID).
+"""
+import copy
+import time
+import inspect
+import threading
+from collections import OrderedDict
+
+_backend = None # None = memory_backend
+_registry = [] # Funzioni decorate, per ricostruirle al cambio di backend e per clear_all
+
+class _MemoryCache:
+    """Cache LRU in memoria con scadenza opzionale, sicura tra thread."""
+    def __init__(self, func, kind, ttl, max_entries):
+        self.func, self.kind, self.ttl, self.max_entries = func, kind, ttl, max_entries
+        self.signature = inspect.signature(func)
+        self.entries = OrderedDict() # chiave -> (scadenza, valore)
+        self.lock = threading.Lock()
+
+    def _key(self, args, kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return tuple((name, repr(value)) for name, value in bound.arguments.items() if not name.startswith('_'))
+
+    def __call__(self, *args, **kwargs):
+        key = self._key(args, kwargs)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self.entries.move_to_end(key)
+                value = entry[1]
+            else:
+                entry = None
+        if entry is None:
+            # Calcolo fuori dal lock: le eccezioni non vengono memorizzate
+            value = self.func(*args, **kwargs)
+            with self.lock:
+                self.entries[key] = (now + self.ttl if self.ttl else None, value)
+                self.entries.move_to_end(key)
+                while self.max_entries and len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return copy.deepcopy(value) if self.kind == 'data' else value
+
+    def clear(self):
+        with self.lock: self.entries.clear()
+
+class LRUCache:
+    """
+    Cache LRU limitata per chiave con invalidazione esplicita delle singole chiavi e contatori
+    (hit, miss, evizioni). A differenza di @cached non dipende dal backend: è del processo.
+    I valori vanno copiati dal chiamante se mutabili.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys: self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock: self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'voci': len(self.entries), 'max_voci': self.max_entries,
+                    'hit': self.hits, 'miss': self.misses, 'evizioni': self.evictions}
+
+def memory_backend(func, kind, ttl, max_entries):
+    return _MemoryCache(func, kind, ttl, max_entries)
+
+def streamlit_backend(func, kind, ttl, max_entries):
+    import streamlit as st
+    decorator = st.cache_data if kind == 'data' else st.cache_resource
+    return decorator(ttl=ttl, max_entries=max_entries)(func)
+
+class _CachedFunction:
+    """Funzione cachata: il backend viene scelto alla prima chiamata (dopo eventuale set_backend)."""
+    def __init__(self, func, kind, ttl, max_entries):
+        self.func, self.kind, self.ttl, self.max_entries = func, kind, ttl, max_entries
+        self._impl = None
+        self.__name__, self.__doc__, self.__wrapped__ = func.__name__, func.__doc__, func
+
+    def _resolve(self):
+        if self._impl is None:
+            self._impl = (_backend or memory_backend)(self.func, self.kind, self.ttl, self.max_entries)
+        return self._impl
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def clear(self):
+        if self._impl is not None: self._impl.clear()
+
+def cached(kind='data', ttl=None, max_entries=None):
+    """Decoratore: cache della funzione con il backend configurato (vedi docstring del modulo)."""
+    if kind not in ('data', 'resource'): raise ValueError(f"Tipo di cache sconosciuto: {kind}")
+    def decorator(func):
+        wrapped = _CachedFunction(func, kind, ttl, max_entries)
+        _registry.append(wrapped)
+        return wrapped
+    return decorator
+
+def set_backend(backend):
+    """Imposta il backend (callable(func, kind, ttl, max_entries) -> funzione con .clear()). Idempotente."""
+    global _backend
+    if backend is _backend: return
+    _backend = backend
+    for wrapped in _registry: wrapped._impl = None # Ricostruite con il nuovo backend alla prossima chiamata
+
+def clear_all():
+    """Svuota tutte le cache registrate."""
+    for wrapped in _registry: wrapped.clear()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Riga di comando per le operazioni senza interfaccia (es. importazione notturna da cron).
+
+Uso (dalla directory dell'app, dove si trovano il DB e ml_model/):
+    python cli.py import file1.csv file2.xlsx [--jobs 4]
+    python cli.py anac cig_2024.zip [--categorie OG1,OG3] [--regioni Lombardia,Veneto]   # dump open data ANAC
+    python cli.py export gare.csv
+    python cli.py train [--incremental]
+    python cli.py predict [--output previsioni.csv]            # gare nel DB senza soglia
+    python cli.py predict --file nuove.csv [--output ...]      # gare di un file
+    python cli.py predict --importo 250000 --data 2024-06-01 [--categoria OG1] [--stazione ...] [--concorrenti 10]
+
+Ogni comando stampa il tempo delle singole fasi; il codice di uscita è 0 se l'operazione riesce.
+Con --trace tempi.jsonl (prima del comando) i tempi dettagliati (query DB, importazione, ML) vengono
+aggiunti al file in formato JSON Lines, come l'esportazione del pannello tempi dell'app.
+I log dei moduli vanno su stderr: livello e formato da ANALISIGARE_LOG_LEVEL / ANALISIGARE_LOG_FORMAT=json.
+"""
+import argparse
+import os
+import sys
+import time
+import datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+import db_utils
+import import_utils
+import anac_utils
+import feature_store_utils
+import ml_utils # Leggero: sklearn viene importato solo in addestramento/previsione
+import trace_utils
+
+OUTPUT_COLUMNS = ['identificativo_gara', 'data_gara', 'importo_base', 'categoria_lavori', 'stazione_appaltante', 'numero_concorrenti']
+CSV_OPTIONS = {'index': False, 'sep': ';', 'decimal': ',', 'date_format': import_utils.DATE_FORMAT_STR, 'encoding': 'utf-8-sig'} # Come i download dell'app
+
+# --- Tempi per fase ---
+_stage_times = []
+
+@contextmanager
+def stage(name):
+    """Misura e stampa la durata di una fase; il riepilogo finale le elenca tutte."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _stage_times.append((name, elapsed))
+        print(f"[tempo] {name}: {elapsed:.2f} s")
+
+def print_stage_summary():
+    if not _stage_times: return
+    print("\nRiepilogo tempi:")
+    width = max(len(name) for name, _ in _stage_times)
+    for name, elapsed in _stage_times:
+        print(f"  {name:<{width}}  {elapsed:8.2f} s")
+    print(f"  {'totale':<{width}}  {sum(elapsed for _, elapsed in _stage_times):8.2f} s")
+
+def _print_messages(path, messages):
+    for level, message in messages:
+        import_utils.print_report(level, f"[{os.path.basename(path)}] {message}")
+
+def _load_all_gare(include_text=False):
+    with stage("lettura gare dal DB"):
+        return db_utils.get_all_gare(include_text=include_text)
+
+# --- Comandi ---
+def cmd_import(args) -> int:
+    """Legge e pulisce i file (in parallelo su più processi), poi li inserisce nel DB in ordine."""
+    paths = [p for p in args.files if os.path.isfile(p)]
+    for missing in sorted(set(args.files) - set(paths)): print(f"ERRORE: file non trovato: {missing}")
+    if not paths: return 1
+
+    # File già importati (stessa impronta nel registro) o ripetuti nel comando: saltati prima della lettura
+    fingerprints, to_import = {}, []
+    with stage(f"impronta di {len(paths)} file"):
+        for path in paths:
+            fingerprint = import_utils.file_fingerprint(path)
+            journal = import_utils.import_status(fingerprint)
+            if fingerprint in fingerprints.values():
+                print(f"[{os.path.basename(path)}] stesso contenuto di un file precedente: saltato.")
+            elif journal and journal['stato'] == 'completato' and not args.forza:
+                print(f"[{os.path.basename(path)}] già importato il {journal['aggiornato']} ({journal['importate']} gare): saltato (--forza per ripeterlo).")
+            else:
+                fingerprints[path] = fingerprint; to_import.append(path)
+    paths = to_import
+    if not paths: return 0
+
+    jobs = max(1, min(args.jobs or os.cpu_count() or 1, len(paths)))
+    profiles = import_utils.load_mapping_profiles() # Letti una volta qui: i processi di lettura non usano il DB
+    with stage(f"lettura e pulizia di {len(paths)} file ({jobs} processi)"):
+        if jobs == 1:
+            loaded = [import_utils.load_path(p, profiles) for p in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                loaded = list(executor.map(import_utils.load_path, paths, [profiles] * len(paths)))
+
+    totals = {'importate': 0, 'saltate': 0}
+    failed = 0
+    for item in loaded: # L'inserimento resta sequenziale: SQLite ha un solo scrittore alla volta
+        _print_messages(item['path'], item['messages'])
+        print(f"[tempo] lettura {os.path.basename(item['path'])}: {item['seconds']:.2f} s")
+        if item['df'] is None:
+            failed += 1; continue
+        with stage(f"inserimento {os.path.basename(item['path'])} ({len(item['df'])} righe)"):
+            result = import_utils.import_dataframe(item['df'], fingerprint=fingerprints[item['path']], file_name=os.path.basename(item['path']))
+        if result['ripresa_da']: print(f"  ripresa dalla riga {result['ripresa_da'] + 1} (importazione precedente interrotta)")
+        totals['importate'] += result['importate']; totals['saltate'] += result['saltate']
+        if result['conteggi']: print(f"  {import_utils.describe_counts(result['conteggi'])}")
+        elif result['ultimo_errore']: print(f"ERRORE: {result['ultimo_errore']}")
+        skipped = list(dict.fromkeys(result['cig_saltati']))
+        if skipped:
+            print(f"  CIG saltati (duplicati o mancanti): {', '.join(skipped[:10])}{'...' if len(skipped) > 10 else ''}")
+    print(f"Totale: {totals['importate']} gare importate, {totals['saltate']} saltate, {failed} file non leggibili.")
+    return 1 if failed else 0
+
+def cmd_anac(args) -> int:
+    """Importa in streaming un dump open data ANAC, tenendo solo le gare delle categorie/regioni indicate."""
+    if not os.path.isfile(args.file):
+        print(f"ERRORE: file non trovato: {args.file}"); return 1
+    split = lambda value: [v for v in (value or '').split(',') if v.strip()]
+    with stage(f"lettura e importazione {os.path.basename(args.file)}"):
+        result = anac_utils.stream_import(args.file, categorie=split(args.categorie), regioni=split(args.regioni))
+    print(f"Lette {result['lette']} righe in {result['secondi_lettura']:.1f} s ({result['righe_al_secondo']:,.0f} righe/s), "
+          f"{result['corrispondenti']} corrispondenti ai filtri.")
+    if result['conteggi']: print(f"  {import_utils.describe_counts(result['conteggi'])}")
+    if result['ultimo_errore']: print(f"ATTENZIONE: {result['ultimo_errore']}")
+    print(f"Totale: {result['importate']} gare importate, {result['saltate']} saltate.")
+    return 0
+
+def cmd_export(args) -> int:
+    df = _load_all_gare(include_text=True)
+    with stage(f"scrittura CSV ({len(df)} gare)"):
+        df.to_csv(args.output, **CSV_OPTIONS)
+    print(f"Esportate {len(df)} gare in {args.output}.")
+    return 0
+
+def _print_progress(fraction, message):
+    print(f"  [{fraction:4.0%}] {message}")
+
+def cmd_train(args) -> int:
+    df = _load_all_gare()
+    with stage("addestramento incrementale" if args.incremental else "addestramento"):
+        results = ml_utils.train_model(df, progress_callback=_print_progress, incremental=args.incremental)
+    print(f"Modello {results['version_id']} salvato - MAE: {results['mae']:.4f}%, R2: {results['r2']:.4f}, campioni: {results['n_samples']}.")
+    return 0
+
+def _predict_input(args, df_gare):
+    """DataFrame delle gare da stimare secondo le opzioni: gara singola, file o gare nel DB senza soglia."""
+    if args.importo is not None:
+        return pd.DataFrame([{'identificativo_gara': None, 'importo_base': args.importo,
+                              'data_gara': pd.to_datetime(args.data or datetime.date.today()),
+                              'categoria_lavori': args.categoria, 'stazione_appaltante': args.stazione,
+                              'numero_concorrenti': args.concorrenti}])
+    if args.file:
+        with stage(f"lettura {os.path.basename(args.file)}"):
+            item = import_utils.load_path(args.file)
+        _print_messages(args.file, item['messages'])
+        return item['df']
+    return df_gare[df_gare[ml_utils.TARGET_COLUMN].isna()]
+
+def cmd_predict(args) -> int:
+    df_gare = _load_all_gare()
+    df_input = _predict_input(args, df_gare)
+    if df_input is None: return 1
+    if df_input.empty:
+        print("Nessuna gara da stimare."); return 0
+    with stage("aggiornamento feature store"):
+        feature_store_utils.sync(df_gare) # Aggregati storici aggiornati alle gare nel DB
+    with stage(f"previsione ({len(df_input)} gare)"):
+        predictions = ml_utils.predict_soglia_batch(df_input, alpha=1 - args.livello / 100, method=args.metodo)
+    df_out = df_input.reindex(columns=OUTPUT_COLUMNS).join(predictions)
+    if args.output:
+        df_out.to_csv(args.output, **CSV_OPTIONS)
+        print(f"Previsioni scritte in {args.output} (intervallo al {args.livello}%, metodo {predictions.attrs.get('method', args.metodo)}).")
+    else:
+        print(df_out.to_string(index=False))
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Analisi Gare d'Appalto - operazioni da riga di comando.")
+    parser.add_argument('--trace', metavar='FILE', help="Aggiunge a FILE (JSON Lines) i tempi dettagliati dell'esecuzione.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p_import = commands.add_parser('import', help="Importa nel DB uno o più file CSV/Excel.")
+    p_import.add_argument('files', nargs='+', help="File .csv, .xls o .xlsx.")
+    p_import.add_argument('--jobs', type=int, default=None, help="Processi per lettura e pulizia (default: numero di core).")
+    p_import.add_argument('--forza', action='store_true', help="Reimporta anche i file già importati (stessa impronta).")
+    p_import.set_defaults(func=cmd_import)
+
+    p_anac = commands.add_parser('anac', help="Importa in streaming un dump open data ANAC (CSV/JSON, anche .zip/.gz).")
+    p_anac.add_argument('file', help="Dump ANAC: .csv, .json, .jsonl o archivio .zip/.gz che li contiene.")
+    p_anac.add_argument('--categorie', help="Codici categoria da tenere, separati da virgola (es. OG1,OS3).")
+    p_anac.add_argument('--regioni', help="Regioni o province da tenere, separate da virgola (es. Lombardia,Veneto).")
+    p_anac.set_defaults(func=cmd_anac)
+
+    p_export = commands.add_parser('export', help="Esporta tutte le gare in CSV (stesso formato dell'app).")
+    p_export.add_argument('output', help="File CSV di destinazione.")
+    p_export.set_defaults(func=cmd_export)
+
+    p_train = commands.add_parser('train', help="Addestra il modello di previsione della soglia.")
+    p_train.add_argument('--incremental', action='store_true', help="Aggiunge alberi al modello attivo invece di ricostruirlo.")
+    p_train.set_defaults(func=cmd_train)
+
+    p_predict = commands.add_parser('predict', help="Stima la soglia di anomalia con il modello attivo.")
+    p_predict.add_argument('--file', help="File CSV/Excel di gare da stimare (default: gare nel DB senza soglia).")
+    p_predict.add_argument('--importo', type=float, help="Gara singola: importo base (€).")
+    p_predict.add_argument('--data', help="Gara singola: data gara YYYY-MM-DD (default: oggi).")
+    p_predict.add_argument('--categoria', help="Gara singola: categoria lavori.")
+    p_predict.add_argument('--stazione', help="Gara singola: stazione appaltante.")
+    p_predict.add_argument('--concorrenti', type=int, help="Gara singola: numero concorrenti stimato.")
+    p_predict.add_argument('--livello', type=int, default=int(round((1 - ml_utils.INTERVAL_ALPHA) * 100)), choices=[80, 90, 95], help="Livello dell'intervallo (%%).")
+    p_predict.add_argument('--metodo', default='conformal', choices=list(ml_utils.INTERVAL_METHODS), help="Metodo dell'intervallo.")
+    p_predict.add_argument('--output', help="File CSV per le previsioni (default: stampa a video).")
+    p_predict.set_defaults(func=cmd_predict)
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    trace_utils.start_run(args.command, enabled=bool(args.trace))
+    try:
+        return args.func(args)
+    except (db_utils.DatabaseError, ml_utils.MLError, anac_utils.AnacError) as e:
+        print(f"ERRORE: {e}"); return 1
+    finally:
+        print_stage_summary()
+        run = trace_utils.end_run()
+        if run is not None:
+            with open(args.trace, 'a', encoding='utf-8') as f: f.write(trace_utils.export_jsonl([run]))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,36 @@
 # -*- coding: utf-8 -*-
 import sqlite3
+import logging
 import pandas as pd
-import streamlit as st
-import traceback
 import os
+import re
+import json
+import uuid
+import datetime
+import threading
 from contextlib import contextmanager
 import numpy as np
 
+import cache_utils
+import trace_utils
+import log_utils
+try: # pyarrow (in requirements.txt, richiesto anche da Streamlit) per lo snapshot colonnare
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+except ImportError:
+    pa = None
+
+logger = log_utils.get_logger(__name__)
+if pa is None: logger.warning("pyarrow non installato: snapshot gare disattivato, ogni processo rilegge la tabella da SQLite.")
+
 # --- Costanti ---
 DB_FILENAME = "gare_appalto.db"
+# Snapshot colonnare (file Arrow IPC) della tabella gare già tipizzata.
+# Il DB resta la fonte di verità: lo snapshot vale solo se la versione dati coincide.
+SNAPSHOT_PATH = "gare_snapshot.arrow"
+SNAPSHOT_FORMAT = "3" # Da incrementare se cambiano colonne o tipizzazione di get_all_gare
+RECORD_CACHE_SIZE = 256 # Gare lette per ID tenute in memoria (cache LRU del processo)
+CHANGE_LOG_SIZE = 10000 # Modifiche/eliminazioni conservate in gare_modifiche (potatura all'avvio)
 EXPECTED_COLUMNS = [
     'id', 'identificativo_gara', 'descrizione', 'data_gara', 'importo_base',
     'categoria_lavori', 'stazione_appaltante', 'mio_ribasso_percentuale',
@@ -16,51 +38,76 @@ EXPECTED_COLUMNS = [
     'importo_aggiudicazione', 'numero_concorrenti', 'posizione_in_graduatoria',
     'esito', 'note', 'data_inserimento'
 ]
+# Rappresentazione compatta della tabella in cache (get_all_gare):
+# testi lunghi esclusi e letti per ID solo dove servono (add_text_columns), testo a bassa cardinalità
+# come categorie, percentuali in float32 (4 decimali significativi bastano); importi e soglia di anomalia
+# (il target dei modelli ML: addestramento e metriche non devono dipendere dalla cache) restano float64.
+TEXT_COLUMNS = ['descrizione', 'note']
+CATEGORY_COLUMNS = ['categoria_lavori', 'stazione_appaltante', 'esito']
+FLOAT32_COLUMNS = ['mio_ribasso_percentuale', 'ribasso_aggiudicatario_percentuale']
+FLOAT64_COLUMNS = ['importo_base', 'importo_offerto', 'importo_aggiudicazione', 'soglia_anomalia_calcolata']
+INT_COLUMNS = ['numero_concorrenti', 'posizione_in_graduatoria']
+
+# --- Eccezioni ---
+# Gli errori vengono sollevati (con messaggio già leggibile dall'utente) e mostrati dal chiamante:
+# l'app li presenta con st.error, la CLI e i worker li stampano o li contano.
+class DatabaseError(Exception):
+    """Operazione sul database fallita."""
+
+class DuplicateGaraError(DatabaseError):
+    """Esiste già una gara con lo stesso CIG."""
 
 # --- Gestione Connessione ---
-@st.cache_resource(ttl=3600)
+@cache_utils.cached('resource', ttl=3600)
 def init_connection():
-    """Inizializza e ritorna la connessione al DB, gestendo errori."""
+    """Inizializza e ritorna la connessione al DB (DatabaseError se non è possibile)."""
     try:
-        if not os.path.exists(DB_FILENAME): print(f"DB '{DB_FILENAME}' non trovato. Creo.")
+        if not os.path.exists(DB_FILENAME): logger.info("DB '%s' non trovato: viene creato.", DB_FILENAME)
         conn = sqlite3.connect(DB_FILENAME, check_same_thread=False, timeout=15.0)
         conn.row_factory = sqlite3.Row # Permette accesso per nome colonna
-        print("Connessione DB inizializzata."); return conn
-    except sqlite3.Error as e: print(f"Errore SQLite conn: {e}"); st.error(f"Errore critico DB: {e}"); traceback.print_exc(); return None
+        logger.info("Connessione DB inizializzata (%s).", DB_FILENAME)
+        _create_schema(conn) # Alla prima connessione del processo, non all'import del modulo (worker, test)
+        return conn
+    except sqlite3.Error as e:
+        logger.exception("Errore SQLite in connessione: %s", e)
+        raise DatabaseError(f"Errore critico DB: {e}") from e
 
 @contextmanager
 def get_db_cursor():
     """Fornisce un cursore DB gestendo commit/rollback."""
-    conn = init_connection();
-    if conn is None: yield None; return # Esce subito se non c'è connessione
+    conn = init_connection()
     cursor = None
     try:
         cursor = conn.cursor(); yield cursor; conn.commit()
     except sqlite3.Error as e:
-        print(f"Errore DB durante operazione: {e}. Eseguo Rollback.");
+        # Vincoli violati (es. CIG duplicato) sono attesi nelle importazioni: solo DEBUG, il chiamante li conta
+        logger.log(logging.DEBUG if isinstance(e, sqlite3.IntegrityError) else logging.WARNING, "Errore DB durante operazione: %s. Eseguo rollback.", e)
         if conn:
-            try: conn.rollback(); print("Rollback eseguito.")
-            except Exception as rb_err: print(f"Errore durante rollback: {rb_err}")
+            try: conn.rollback()
+            except Exception as rb_err: logger.error("Errore durante rollback: %s", rb_err)
         # Rilancia l'eccezione per segnalare il fallimento all'esterno
         raise e
     except Exception as e:
-        print(f"Errore imprevisto context DB: {e}. Eseguo Rollback.")
+        logger.warning("Errore imprevisto durante operazione DB: %s. Eseguo rollback.", e)
         if conn:
-            try: conn.rollback(); print("Rollback eseguito.")
-            except Exception as rb_err: print(f"Errore durante rollback: {rb_err}")
+            try: conn.rollback()
+            except Exception as rb_err: logger.error("Errore durante rollback: %s", rb_err)
         raise e
     finally:
-        # Non chiudiamo conn qui, è gestita da cache_resource
+        # Non chiudiamo conn qui, è condivisa tramite cache_utils (risorsa)
         # Il cursore viene chiuso implicitamente uscendo dal 'with' nel chiamante
         pass
 
 
 # --- Funzioni CRUD ---
 def create_table():
-    """Crea tabella e indici se non esistono."""
+    """Crea tabella e indici se non esistono (già fatto da init_connection alla prima connessione)."""
+    _create_schema(init_connection())
+
+def _create_schema(conn):
     try:
-        with get_db_cursor() as cursor:
-            if cursor is None: print("Impossibile creare tabella: no cursor."); return
+        with conn: # Commit, o rollback in caso di errore
+            cursor = conn.cursor()
             # Definisci tipi colonne più specifici e vincoli
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS gare (
@@ -87,13 +134,55 @@ def create_table():
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_categoria ON gare (categoria_lavori);")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_esito ON gare (esito);")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_importo_base ON gare (importo_base);") # Indice su importo per filtri range
-            print("Tabella 'gare' e indici verificati/creati con successo.")
-    except Exception as e: print(f"Errore durante create_table: {e}"); traceback.print_exc()
+            # Versione dei dati: incrementata dai trigger ad ogni scrittura su gare (da qualunque processo).
+            # uid distingue un DB ricreato da zero, che ripartirebbe dalla stessa versione.
+            cursor.execute("CREATE TABLE IF NOT EXISTS data_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL, uid TEXT NOT NULL);")
+            cursor.execute("INSERT OR IGNORE INTO data_version (id, version, uid) VALUES (1, 0, lower(hex(randomblob(8))));")
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS gare_versione_insert AFTER INSERT ON gare "
+                           "BEGIN UPDATE data_version SET version = version + 1 WHERE id = 1; END;")
+            # Modifiche ed eliminazioni registrano anche l'ID: gli altri processi invalidano solo quei record.
+            # (Gli inserimenti non toccano record già letti.)
+            cursor.execute("CREATE TABLE IF NOT EXISTS gare_modifiche (version INTEGER PRIMARY KEY, gara_id INTEGER NOT NULL);")
+            for event in ['UPDATE', 'DELETE']:
+                cursor.execute(f"DROP TRIGGER IF EXISTS gare_versione_{event.lower()};") # Versione senza registro
+                cursor.execute(f"CREATE TRIGGER IF NOT EXISTS gare_registro_{event.lower()} AFTER {event} ON gare "
+                               "BEGIN UPDATE data_version SET version = version + 1 WHERE id = 1; "
+                               "INSERT INTO gare_modifiche (version, gara_id) SELECT version, OLD.id FROM data_version WHERE id = 1; END;")
+            cursor.execute("DELETE FROM gare_modifiche WHERE version < (SELECT version FROM gare_modifiche ORDER BY version DESC LIMIT 1 OFFSET ?);",
+                           (CHANGE_LOG_SIZE - 1,))
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS import_journal (
+                    impronta TEXT PRIMARY KEY, -- SHA-256 del contenuto del file
+                    nome_file TEXT,
+                    righe_totali INTEGER NOT NULL,
+                    righe_processate INTEGER NOT NULL DEFAULT 0,
+                    importate INTEGER NOT NULL DEFAULT 0,
+                    saltate INTEGER NOT NULL DEFAULT 0,
+                    stato TEXT NOT NULL, -- 'in_corso' | 'completato'
+                    iniziato TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                    aggiornato TIMESTAMP
+                )""")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS mapping_profiles (
+                    firma TEXT PRIMARY KEY, -- Impronta delle intestazioni del file (vedi import_utils.header_signature)
+                    nome TEXT,
+                    intestazioni TEXT NOT NULL, -- JSON: intestazioni del file (minuscole)
+                    mappatura TEXT NOT NULL, -- JSON: intestazione -> colonna di 'gare'
+                    creato TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                    aggiornato TIMESTAMP
+                )""")
+            _drop_stale_staging(cursor)
+            logger.info("Tabella 'gare' e indici verificati/creati con successo.")
+    except Exception as e: logger.exception("Errore durante create_table: %s", e)
 
+@trace_utils.traced('db.add_gara')
 def add_gara(data: dict) -> bool:
-    """Aggiunge una nuova gara al database."""
+    """
+    Aggiunge una nuova gara al database. Ritorna False se i dati non sono validi (CIG mancante);
+    solleva DuplicateGaraError se il CIG esiste già e DatabaseError per gli altri errori SQL.
+    """
     if 'identificativo_gara' not in data or not str(data['identificativo_gara']).strip():
-        print("Errore add_gara: CIG mancante o vuoto."); return False
+        logger.warning("add_gara: CIG mancante o vuoto."); return False
 
     # Pulisci dati: prendi solo colonne attese, converti NaN/None in NULL per SQL
     clean_data = {}
@@ -110,7 +199,7 @@ def add_gara(data: dict) -> bool:
                 clean_data[col] = value
 
     if not clean_data:
-        print("Errore add_gara: Nessun dato valido da inserire."); return False
+        logger.warning("add_gara: nessun dato valido da inserire."); return False
 
     columns = ', '.join(clean_data.keys())
     placeholders = ', '.join([f":{key}" for key in clean_data.keys()])
@@ -118,88 +207,271 @@ def add_gara(data: dict) -> bool:
 
     try:
         with get_db_cursor() as cursor:
-            if cursor is None: return False
             cursor.execute(sql, clean_data)
-            print(f"Gara '{clean_data.get('identificativo_gara', 'N/A')}' aggiunta con successo (ID: {cursor.lastrowid})."); return True
-    except sqlite3.IntegrityError:
-        # Errore specifico per violazione vincolo UNIQUE (CIG duplicato)
-        st.error(f"Errore: Esiste già una gara con CIG '{clean_data.get('identificativo_gara', 'N/A')}'.")
-        print(f"Errore Integrità (CIG Duplicato?): Gara '{clean_data.get('identificativo_gara', 'N/A')}'")
-        return False
+            # DEBUG: chiamata per ogni riga importata (il riepilogo lo scrive import_utils)
+            logger.debug("Gara '%s' aggiunta (ID: %s).", clean_data.get('identificativo_gara', 'N/A'), cursor.lastrowid)
+        refresh_snapshot(); return True # Dopo il commit
+    except sqlite3.IntegrityError as e:
+        # Violazione vincolo UNIQUE (CIG duplicato): caso atteso nelle importazioni, nessun traceback
+        raise DuplicateGaraError(f"Esiste già una gara con CIG '{clean_data.get('identificativo_gara', 'N/A')}'.") from e
     except sqlite3.Error as e:
-        # Altri errori SQL
-        st.error(f"Errore database durante l'inserimento: {e}")
-        print(f"Errore SQL add_gara: {e}"); traceback.print_exc(); return False
+        logger.exception("Errore SQL add_gara: %s", e)
+        raise DatabaseError(f"Errore database durante l'inserimento: {e}") from e
+
+# --- Versione Dati ---
+# Record per ID: cache LRU limitata, invalidata solo per gli ID modificati/eliminati
+_gara_cache = cache_utils.LRUCache(RECORD_CACHE_SIZE)
+# Ultima versione letta e chiave di controllo con cui è stata letta (connessione, PRAGMA data_version, total_changes)
+_version_state = {'conn': None, 'chiave': None, 'versione': None}
+_version_lock = threading.Lock()
+
+def get_data_version() -> tuple | None:
+    """
+    Ritorna (versione, uid) dei dati della tabella gare, o None se non disponibile.
+
+    Chiamata ad ogni rerun, costa pochi microsecondi: PRAGMA data_version cambia solo quando scrive
+    un'altra connessione (altri processi/repliche, worker), total_changes quando scrive questa.
+    Solo se uno dei due è cambiato si rilegge la tabella data_version e si invalidano i record
+    in cache modificati nel frattempo (registro gare_modifiche).
+    """
+    conn = init_connection()
+    try:
+        with _version_lock:
+            key = (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+            if _version_state['conn'] is conn and _version_state['chiave'] == key:
+                return _version_state['versione']
+            row = conn.execute("SELECT version, uid FROM data_version WHERE id = 1").fetchone()
+            version = (int(row[0]), str(row[1])) if row else None
+            _invalidate_changed_records(conn, _version_state['versione'], version)
+            _version_state.update(conn=conn, chiave=key, versione=version)
+            return version
+    except sqlite3.Error as e:
+        logger.warning("Versione dati non disponibile: %s", e); return None
+
+def _invalidate_changed_records(conn, old_version, new_version) -> None:
+    """Rimuove dalla cache dei record gli ID modificati/eliminati tra le due versioni (tutti se non determinabile)."""
+    if old_version == new_version: return
+    if old_version is None or new_version is None or old_version[1] != new_version[1]:
+        _gara_cache.clear(); return # Prima lettura o DB ricreato
+    count, oldest = conn.execute("SELECT COUNT(*), MIN(version) FROM gare_modifiche").fetchone()
+    if count >= CHANGE_LOG_SIZE and oldest > old_version[0] + 1:
+        _gara_cache.clear(); return # Registro potato oltre l'ultima versione vista
+    changed = [row[0] for row in conn.execute("SELECT gara_id FROM gare_modifiche WHERE version > ?", (old_version[0],))]
+    if changed:
+        _gara_cache.invalidate(*changed)
+        logger.debug("Invalidati %d record modificati (versione %s -> %s).", len(changed), old_version[0], new_version[0])
+
+# --- Snapshot Colonnare ---
+def _read_snapshot(data_version) -> pd.DataFrame | None:
+    """
+    Legge lo snapshot se corrisponde alla versione dati indicata. Il file viene letto e chiuso subito
+    (non memory-mapped: le colonne convertite senza copia lo terrebbero aperto e su Windows
+    _write_snapshot non potrebbe sostituirlo); quelle colonne sono in sola lettura, come deve
+    restare comunque il DataFrame condiviso in cache (i chiamanti lavorano su copie).
+    """
+    if pa is None or data_version is None or not os.path.exists(SNAPSHOT_PATH): return None
+    try:
+        with pa.OSFile(SNAPSHOT_PATH, 'rb') as source:
+            table = pa_ipc.open_file(source).read_all()
+        meta = table.schema.metadata or {}
+        if (meta.get(b'snapshot_format', b'').decode(), meta.get(b'data_version', b'').decode(), meta.get(b'db_uid', b'').decode()) \
+                != (SNAPSHOT_FORMAT, str(data_version[0]), data_version[1]):
+            return None # Snapshot di dati precedenti (o di un altro DB): si rilegge da SQLite
+        # Colonne in blocchi separati (niente consolidamento = niente copia extra) e buffer Arrow
+        # liberati man mano che vengono convertiti: il picco di memoria resta vicino a un solo DataFrame
+        return table.to_pandas(self_destruct=True, split_blocks=True)
+    except Exception as e:
+        logger.warning("Snapshot gare non leggibile (%s): lettura da SQLite.", e); return None
+
+def _write_snapshot(df: pd.DataFrame, data_version) -> None:
+    """Scrive lo snapshot su file temporaneo e lo sostituisce atomicamente."""
+    if pa is None or data_version is None: return
+    tmp_path = f"{SNAPSHOT_PATH}.tmp{os.getpid()}"
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'snapshot_format': SNAPSHOT_FORMAT.encode(),
+                                               b'data_version': str(data_version[0]).encode(), b'db_uid': data_version[1].encode()})
+        with pa.OSFile(tmp_path, 'wb') as sink, pa_ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        logger.info("Snapshot gare aggiornato (versione dati %s, %d righe).", data_version[0], len(df))
     except Exception as e:
-        # Errori generici
-        st.error(f"Errore imprevisto durante l'inserimento: {e}")
-        print(f"Errore generico add_gara: {e}"); traceback.print_exc(); return False
+        logger.warning("Scrittura snapshot gare fallita: %s", e)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def refresh_snapshot() -> None:
+    """
+    Riscrive lo snapshot alla versione dati corrente: chiamata a commit avvenuto da add_gara, update_gara,
+    delete_gara_by_id e a fine importazione (import_utils.import_staged), così i processi e le repliche
+    avviati dopo una scrittura lo trovano già valido. La lettura da SQLite è quella che farebbe comunque la
+    prossima get_all_gare di questo processo, che poi trova il DataFrame in cache. Gli errori sono solo registrati.
+    """
+    if pa is None: return
+    try: get_all_gare()
+    except DatabaseError as e: logger.warning("Aggiornamento snapshot gare fallito: %s", e)
 
-@st.cache_data(ttl=300) # Cache per 5 minuti
-def get_all_gare(_refresh_trigger=None) -> pd.DataFrame:
-    """Recupera tutte le gare dal database come DataFrame pandas."""
-    print(f"get_all_gare chiamato con trigger: {_refresh_trigger}") # Utile per debug cache
-    conn = init_connection();
-    if not conn: return pd.DataFrame(columns=EXPECTED_COLUMNS) # Ritorna DF vuoto se connessione fallisce
+def get_all_gare(include_text=False) -> pd.DataFrame:
+    """
+    Recupera tutte le gare come DataFrame pandas (DatabaseError se la lettura fallisce).
+    La cache è indicizzata per versione dei dati: dopo una scrittura (di qualunque sessione o processo)
+    la prima chiamata rilegge, finché i dati non cambiano si usa la copia in cache.
+    Il DataFrame è compatto (vedi TEXT_COLUMNS e seguenti): descrizione e note ci sono solo con
+    include_text=True (es. esportazione completa), altrimenti si aggiungono con add_text_columns.
+    """
+    # Versione letta PRIMA dei dati: una scrittura concorrente rende la copia vecchia, mai incoerente
+    data_version = get_data_version()
+    if data_version is None: df = _load_all_gare.__wrapped__(None) # Versione ignota: nessuna cache
+    else: df = _load_all_gare(data_version)
+    return add_text_columns(df) if include_text else df
+
+def _compact_types(df: pd.DataFrame) -> pd.DataFrame:
+    """Tipi della tabella in cache: date, categorie, float32/float64, interi con NaN (Int64)."""
+    for col in ['data_gara', 'data_inserimento']:
+        if col in df.columns: df[col] = pd.to_datetime(df[col], errors='coerce')
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns: df[col] = df[col].astype('category')
+    for col in FLOAT32_COLUMNS:
+        if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float32)
+    for col in FLOAT64_COLUMNS:
+        if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in INT_COLUMNS:
+        if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64') # Int64 supporta NaN
+    return df
+
+@cache_utils.cached('data', max_entries=2) # Versione corrente (e precedente, per i rerun in corso); nessuna scadenza
+@trace_utils.traced('db.get_all_gare') # Solo letture effettive (cache mancata)
+def _load_all_gare(data_version) -> pd.DataFrame:
+    """
+    Legge tutte le gare (senza TEXT_COLUMNS) alla versione dati indicata.
+    Se lo snapshot colonnare corrisponde alla versione viene letto quello (avvio di un processo
+    o di una replica senza rileggere SQLite); altrimenti si legge il DB e si riscrive lo snapshot.
+    """
+    logger.debug("Lettura gare per versione dati %s", data_version)
+    conn = init_connection()
+    df = _read_snapshot(data_version)
+    if df is not None:
+        trace_utils.count('db.letture_snapshot')
+        logger.info("Recuperate %d gare dallo snapshot (versione dati %s).", len(df), data_version[0],
+                    extra={'righe': len(df), 'origine': 'snapshot', 'memoria_mb': _memory_mb(df)}); return df
 
     try:
         # Ordina per data più recente prima, poi per ID decrescente come fallback
-        query = "SELECT * FROM gare ORDER BY data_gara DESC, id DESC"
-        df = pd.read_sql_query(query, conn)
+        columns = ', '.join(col for col in EXPECTED_COLUMNS if col not in TEXT_COLUMNS)
+        df = _compact_types(pd.read_sql_query(f"SELECT {columns} FROM gare ORDER BY data_gara DESC, id DESC", conn))
+        trace_utils.count('db.letture_sqlite')
+        logger.info("Recuperate %d gare dal database.", len(df), extra={'righe': len(df), 'origine': 'sqlite', 'memoria_mb': _memory_mb(df)})
+        _write_snapshot(df, data_version)
+        return df
+    except Exception as e:
+        # Errori durante la lettura o conversione
+        logger.exception("Errore in get_all_gare: %s", e)
+        raise DatabaseError(f"Errore durante il recupero delle gare: {e}") from e
 
-        # Conversioni di tipo post-lettura per coerenza
-        if 'data_gara' in df.columns: df['data_gara'] = pd.to_datetime(df['data_gara'], errors='coerce')
-        if 'data_inserimento' in df.columns: df['data_inserimento'] = pd.to_datetime(df['data_inserimento'], errors='coerce')
+def get_filter_options() -> dict:
+    """
+    Limiti e opzioni dei filtri della dashboard, calcolati in SQL e in cache per versione dei dati:
+    {'data_min', 'data_max' (Timestamp o None), 'importo_min', 'importo_max' (float o None),
+     'categorie', 'esiti' (liste ordinate)}. Solleva DatabaseError se la lettura fallisce.
+    """
+    data_version = get_data_version()
+    if data_version is None: return _load_filter_options.__wrapped__(None)
+    return _load_filter_options(data_version)
 
-        # Colonne numeriche (float)
-        float_cols = ['importo_base', 'mio_ribasso_percentuale', 'importo_offerto', 'soglia_anomalia_calcolata', 'ribasso_aggiudicatario_percentuale', 'importo_aggiudicazione']
-        for col in float_cols:
-             if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce')
+@cache_utils.cached('data', max_entries=2)
+@trace_utils.traced('db.filter_options')
+def _load_filter_options(data_version) -> dict:
+    """
+    Un estremo per sottoquery (ORDER BY ... LIMIT 1: SQLite scorre idx_data_gara e idx_importo_base e si
+    ferma al primo valore valido) e DISTINCT su idx_categoria e idx_esito: nessuna scansione della tabella.
+    Le colonne non hanno vincoli di tipo: contano solo le date 'AAAA-...' e gli importi numerici
+    (in SQLite il testo, anche vuoto, è ordinato dopo i numeri e vincerebbe il MAX).
+    """
+    conn = init_connection()
+    valid = {'data_gara': "data_gara GLOB '[0-9][0-9][0-9][0-9]-*'", 'importo_base': "typeof(importo_base) IN ('real', 'integer')"}
+    try:
+        bounds = conn.execute("SELECT " + ", ".join(f"(SELECT {col} FROM gare WHERE {valid[col]} ORDER BY {col} {order} LIMIT 1)"
+                                                     for col in ['data_gara', 'importo_base'] for order in ['ASC', 'DESC'])).fetchone()
+        options = {col: [row[0] for row in conn.execute(f"SELECT DISTINCT {col} FROM gare WHERE {col} IS NOT NULL AND {col} <> '' ORDER BY {col}")]
+                   for col in ['categoria_lavori', 'esito']}
+    except sqlite3.Error as e:
+        logger.exception("Errore in get_filter_options: %s", e)
+        raise DatabaseError(f"Errore durante il calcolo delle opzioni dei filtri: {e}") from e
+    data_min, data_max = (pd.to_datetime(value, errors='coerce') for value in bounds[:2])
+    importo_min, importo_max = (pd.to_numeric(value, errors='coerce') for value in bounds[2:])
+    return {'data_min': None if pd.isna(data_min) else data_min, 'data_max': None if pd.isna(data_max) else data_max,
+            'importo_min': None if pd.isna(importo_min) else float(importo_min), 'importo_max': None if pd.isna(importo_max) else float(importo_max),
+            'categorie': [str(value) for value in options['categoria_lavori']], 'esiti': [str(value) for value in options['esito']]}
 
-        # Colonne numeriche (integer, gestendo NaN)
-        int_cols = ['numero_concorrenti', 'posizione_in_graduatoria']
-        for col in int_cols:
-              if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64') # Int64 supporta NaN
+def _memory_mb(df: pd.DataFrame) -> float:
+    return round(df.memory_usage(index=True, deep=True).sum() / 2**20, 2)
 
-        print(f"Recuperate {len(df)} gare dal database."); return df
-    except Exception as e:
-        # Gestisce errori durante la lettura o conversione
-        st.error(f"Errore durante il recupero delle gare: {e}")
-        print(f"Errore in get_all_gare: {e}"); traceback.print_exc()
-        return pd.DataFrame(columns=EXPECTED_COLUMNS) # Ritorna DF vuoto in caso di errore
-
-@st.cache_data(ttl=60) # Cache più breve per dati specifici
-def get_gara_by_id(gara_id: int, _cache_key_modifier=None) -> dict | None:
-    """Recupera una singola gara per ID."""
-    print(f"get_gara_by_id chiamato per ID: {gara_id}, modifier: {_cache_key_modifier}")
+@trace_utils.traced('db.add_text_columns')
+def add_text_columns(df: pd.DataFrame, columns=None) -> pd.DataFrame:
+    """
+    Copia di df (con colonna 'id') con le colonne di testo lette dal DB per gli ID presenti,
+    nella posizione che hanno in EXPECTED_COLUMNS. Da usare sulle righe da mostrare o esportare.
+    """
+    columns = [col for col in (columns or TEXT_COLUMNS) if col not in df.columns]
+    if not columns or 'id' not in df.columns: return df.copy()
+    if df.empty:
+        texts = pd.DataFrame(columns=['id'] + columns)
+    else:
+        ids = df['id'].dropna().astype(np.int64).tolist()
+        try: # Un'unica query qualunque sia il numero di ID (json_each evita il limite dei parametri SQLite)
+            texts = pd.read_sql_query(f"SELECT id, {', '.join(columns)} FROM gare WHERE id IN (SELECT value FROM json_each(?))",
+                                      init_connection(), params=(json.dumps(ids),))
+        except Exception as e:
+            logger.exception("Errore lettura testi gare: %s", e)
+            raise DatabaseError(f"Errore durante il recupero di {', '.join(columns)}: {e}") from e
+    texts = texts.set_index('id')
+    result = df.copy()
+    for col in columns: result[col] = result['id'].map(texts[col])
+    order = [col for col in EXPECTED_COLUMNS if col in result.columns]
+    return result[order + [col for col in result.columns if col not in order]]
+
+@trace_utils.traced('db.get_gara_by_id')
+def get_gara_by_id(gara_id: int) -> dict | None:
+    """
+    Recupera una singola gara per ID (None se non esiste, DatabaseError se la lettura fallisce).
+    I record letti restano nella cache LRU finché update_gara/delete_gara_by_id non li invalidano:
+    il chiamante riceve sempre una copia.
+    """
     # Validazione input ID
     if not isinstance(gara_id, (int, np.integer)) or gara_id <= 0:
-        print(f"ID gara non valido fornito: {gara_id}"); return None
+        logger.warning("ID gara non valido fornito: %s", gara_id); return None
+
+    gara_id = int(gara_id)
+    get_data_version() # Invalida i record modificati da altri processi
+    cached_gara = _gara_cache.get(gara_id)
+    if cached_gara is not None:
+        trace_utils.count('db.record_cache_hit')
+        return dict(cached_gara)
+    trace_utils.count('db.record_cache_miss')
 
     try:
         with get_db_cursor() as cursor:
-            if cursor is None: return None
             # Usa parameterized query per sicurezza
-            cursor.execute("SELECT * FROM gare WHERE id = ?", (int(gara_id),))
+            cursor.execute("SELECT * FROM gare WHERE id = ?", (gara_id,))
             gara_data = cursor.fetchone() # fetchone ritorna una riga (Row object) o None
             if gara_data:
-                print(f"Recuperata gara con ID {gara_id}.");
-                return dict(gara_data) # Converti Row object in dict
+                logger.debug("Recuperata gara con ID %s.", gara_id)
+                gara_data = dict(gara_data) # Converti Row object in dict
+                _gara_cache.put(gara_id, gara_data)
+                return dict(gara_data)
             else:
-                print(f"Nessuna gara trovata con ID {gara_id}.");
+                logger.debug("Nessuna gara trovata con ID %s.", gara_id) # Non memorizzato: l'ID potrebbe essere creato dopo
                 return None
     except sqlite3.Error as e:
-        st.error(f"Errore database recuperando gara ID {gara_id}: {e}")
-        print(f"Errore SQL in get_gara_by_id: {e}"); return None
-    except Exception as e:
-        st.error(f"Errore imprevisto recuperando gara ID {gara_id}: {e}")
-        print(f"Errore generico in get_gara_by_id: {e}"); return None
+        logger.error("Errore SQL in get_gara_by_id: %s", e)
+        raise DatabaseError(f"Errore database recuperando gara ID {gara_id}: {e}") from e
 
+@trace_utils.traced('db.update_gara')
 def update_gara(gara_id: int, data: dict) -> bool:
-    """Aggiorna una gara esistente nel database."""
+    """Aggiorna una gara esistente nel database (False se nulla da aggiornare, DatabaseError se fallisce)."""
     # Validazione ID
     if not isinstance(gara_id, (int, np.integer)) or gara_id <= 0:
-         print(f"Errore update_gara: ID gara non valido ({gara_id})."); return False
+         logger.warning("update_gara: ID gara non valido (%s).", gara_id); return False
 
     # Colonne che possono essere aggiornate (escludi ID, CIG, data inserimento)
     allowed_to_update = [col for col in EXPECTED_COLUMNS if col not in ['id', 'identificativo_gara', 'data_inserimento']]
@@ -220,7 +492,7 @@ def update_gara(gara_id: int, data: dict) -> bool:
                  update_data[col] = value
 
     if not update_data:
-        print(f"Nessun dato valido fornito per aggiornare Gara ID {gara_id}."); return False # Nessun campo valido da aggiornare
+        logger.warning("Nessun dato valido fornito per aggiornare Gara ID %s.", gara_id); return False # Nessun campo valido da aggiornare
 
     # Costruisci la clausola SET dinamicamente
     set_clause = ', '.join([f"{key} = :{key}" for key in update_data.keys()])
@@ -231,72 +503,281 @@ def update_gara(gara_id: int, data: dict) -> bool:
 
     try:
         with get_db_cursor() as cursor:
-            if cursor is None: return False
             cursor.execute(sql, update_data)
-            if cursor.rowcount > 0:
-                print(f"Gara ID {gara_id} aggiornata con successo ({cursor.rowcount} riga/e modificata/e).")
-                # Invalida cache specifiche dopo modifica
-                get_gara_by_id.clear()
-                get_all_gare.clear() # Modifica potrebbe impattare la lista completa
-                return True
-            else:
-                # Nessuna riga modificata: o l'ID non esiste o i dati erano identici
-                print(f"Nessuna riga aggiornata per Gara ID {gara_id}. La gara esiste e i dati sono invariati, oppure l'ID non esiste.")
-                # Potremmo voler verificare se l'ID esiste per distinguere i casi
-                # gara_esiste = get_gara_by_id(gara_id) is not None
-                # print(f"La gara ID {gara_id} {'esiste' if gara_esiste else 'non esiste'}.")
-                return False # Consideriamo False se non ci sono state modifiche effettive
+            changed = cursor.rowcount
+        if changed > 0:
+            logger.info("Gara ID %s aggiornata con successo (%d riga/e modificata/e).", gara_id, changed)
+            # Invalida solo il record modificato (la lista completa segue la versione dati)
+            _gara_cache.invalidate(int(gara_id))
+            refresh_snapshot(); return True
+        else:
+            # Nessuna riga modificata: o l'ID non esiste o i dati erano identici
+            logger.info("Nessuna riga aggiornata per Gara ID %s: dati invariati oppure ID inesistente.", gara_id)
+            return False # Consideriamo False se non ci sono state modifiche effettive
     except sqlite3.Error as e:
-        st.error(f"Errore database durante l'aggiornamento Gara ID {gara_id}: {e}")
-        print(f"Errore SQL update_gara: {e}"); traceback.print_exc(); return False
-    except Exception as e:
-        st.error(f"Errore imprevisto durante l'aggiornamento Gara ID {gara_id}: {e}")
-        print(f"Errore generico update_gara: {e}"); traceback.print_exc(); return False
+        logger.exception("Errore SQL update_gara: %s", e)
+        raise DatabaseError(f"Errore database durante l'aggiornamento Gara ID {gara_id}: {e}") from e
 
 
+@trace_utils.traced('db.delete_gara_by_id')
 def delete_gara_by_id(gara_id: int) -> bool:
-    """Elimina una gara specifica dal database per ID."""
+    """Elimina una gara specifica dal database per ID (False se non trovata, DatabaseError se fallisce)."""
      # Validazione ID
     if not isinstance(gara_id, (int, np.integer)) or gara_id <= 0:
-        print(f"Errore delete_gara_by_id: ID gara non valido ({gara_id})."); return False
+        logger.warning("delete_gara_by_id: ID gara non valido (%s).", gara_id); return False
 
     sql = 'DELETE FROM gare WHERE id = ?'
     try:
         with get_db_cursor() as cursor:
-            if cursor is None: return False
             cursor.execute(sql, (int(gara_id),)) # Usa tupla per parametri posizionali
-            if cursor.rowcount > 0:
-                print(f"Gara ID {gara_id} eliminata con successo ({cursor.rowcount} riga/e).")
-                # Invalida cache dopo eliminazione
-                get_gara_by_id.clear() # Rimuovi eventuale cache per questo ID
-                get_all_gare.clear() # La lista completa è cambiata
-                return True
-            else:
-                print(f"Nessuna gara trovata con ID {gara_id} per l'eliminazione.");
-                return False # ID non trovato
+            changed = cursor.rowcount
+        if changed > 0:
+            logger.info("Gara ID %s eliminata con successo (%d riga/e).", gara_id, changed)
+            # Invalida il record eliminato (la lista completa segue la versione dati)
+            _gara_cache.invalidate(int(gara_id))
+            refresh_snapshot(); return True
+        else:
+            logger.info("Nessuna gara trovata con ID %s per l'eliminazione.", gara_id)
+            return False # ID non trovato
     except sqlite3.Error as e:
-        st.error(f"Errore database durante l'eliminazione Gara ID {gara_id}: {e}")
-        print(f"Errore SQL delete_gara_by_id: {e}"); traceback.print_exc(); return False
-    except Exception as e:
-        st.error(f"Errore imprevisto durante l'eliminazione Gara ID {gara_id}: {e}")
-        print(f"Errore generico delete_gara_by_id: {e}"); traceback.print_exc(); return False
+        logger.exception("Errore SQL delete_gara_by_id: %s", e)
+        raise DatabaseError(f"Errore database durante l'eliminazione Gara ID {gara_id}: {e}") from e
 
 def clear_all_cache():
-    """Pulisce tutte le cache dati DB conosciute definite con @st.cache_data."""
-    print("Tentativo pulizia cache Streamlit @st.cache_data...")
+    """
+    Pulisce tutte le cache dati DB (funzioni cachate e cache dei record per ID).
+    Non serve dopo le scritture (le cache seguono la versione dati): resta per benchmark e diagnostica.
+    """
+    for cached_func in [_load_all_gare, _load_filter_options]: # Aggiungi qui altre funzioni cachate se necessario
+        try:
+            cached_func.clear()
+        except Exception as e:
+            logger.warning("Errore pulizia cache %s: %s", cached_func.__name__, e)
+    _gara_cache.clear()
+    logger.info("Cache dati DB pulite.")
+
+def record_cache_stats() -> dict:
+    """Stato della cache dei record per ID: voci, hit, miss, evizioni."""
+    return _gara_cache.stats()
+
+# --- Staging Importazioni ---
+# Ogni file caricato va in una tabella di appoggio (staging_import_<data>_<id>) nello stesso DB:
+# validazione e deduplicazione sono UPDATE/JOIN su tutto l'insieme, l'anteprima si legge da lì e la
+# promozione è un solo INSERT ... SELECT. Le tabelle abbandonate si eliminano all'avvio (create_table).
+STAGING_PREFIX = "staging_import_"
+STAGING_PATTERN = re.compile(rf"{STAGING_PREFIX}(\d{{14}})_[0-9a-f]{{8}}") # Data di creazione nel nome
+STAGING_MAX_AGE_HOURS = 24
+STAGING_COLUMNS = [col for col in EXPECTED_COLUMNS if col not in ['id', 'data_inserimento']]
+# Stati di validazione di una riga in staging (solo 'valida' viene promossa)
+STAGING_STATES = ['valida', 'cig_mancante', 'duplicato_file', 'gia_presente']
+
+def _staging_table(name: str) -> str:
+    """Il nome finisce nel testo SQL: si accettano solo nomi generati da create_staging."""
+    if not STAGING_PATTERN.fullmatch(str(name)):
+        raise DatabaseError(f"Tabella di staging non valida: {name}")
+    return name
+
+def _insert_staging(cursor, name, rows, first_row) -> int:
+    before = cursor.connection.total_changes
+    cursor.executemany(f"INSERT INTO {name} (riga, {', '.join(STAGING_COLUMNS)}) VALUES (?{', ?' * len(STAGING_COLUMNS)})",
+                       ((n, *(row.get(col) for col in STAGING_COLUMNS)) for n, row in enumerate(rows, start=first_row)))
+    return cursor.connection.total_changes - before
+
+@trace_utils.traced('db.staging_crea')
+def create_staging(rows=()) -> str:
+    """
+    Crea una tabella di staging con le righe indicate (dizionari con le colonne di STAGING_COLUMNS,
+    nell'ordine del file) e ne ritorna il nome. Stessi tipi di 'gare', nessun vincolo.
+    """
+    name = f"{STAGING_PREFIX}{datetime.datetime.now():%Y%m%d%H%M%S}_{uuid.uuid4().hex[:8]}"
+    columns = ', '.join(STAGING_COLUMNS)
     try:
-        get_all_gare.clear()
-        print("- Cache get_all_gare pulita.")
-    except Exception as e:
-        print(f"- Errore pulizia cache get_all_gare: {e}")
+        with get_db_cursor() as cursor:
+            cursor.execute(f"CREATE TABLE {name} AS SELECT {columns} FROM gare WHERE 0")
+            cursor.execute(f"ALTER TABLE {name} ADD COLUMN riga INTEGER")
+            cursor.execute(f"ALTER TABLE {name} ADD COLUMN stato TEXT")
+            _insert_staging(cursor, name, rows, 1)
+            cursor.execute(f"CREATE INDEX {name}_cig ON {name} (identificativo_gara, riga)")
+        return name
+    except sqlite3.Error as e:
+        logger.exception("Errore creazione staging: %s", e)
+        drop_staging(name)
+        raise DatabaseError(f"Errore database durante la preparazione dell'importazione: {e}") from e
+
+@trace_utils.traced('db.staging_aggiungi')
+def append_staging(name: str, rows, first_row: int) -> int:
+    """
+    Aggiunge righe a una tabella di staging numerandole da first_row, in una transazione breve
+    (per caricamenti a lotti: il DB non resta bloccato in scrittura per tutta la lettura). Ritorna le righe scritte.
+    """
+    name = _staging_table(name)
+    try:
+        with get_db_cursor() as cursor: return _insert_staging(cursor, name, rows, int(first_row))
+    except sqlite3.Error as e:
+        logger.exception("Errore scrittura staging: %s", e)
+        raise DatabaseError(f"Errore database durante la preparazione dell'importazione: {e}") from e
+
+def _validate_staging(cursor, name, first_row=1, last_row=None) -> dict:
+    """Assegna lo stato alle righe dell'intervallo (set-based) e ritorna i conteggi per stato."""
+    rows = (int(first_row), int(last_row) if last_row is not None else 2**62)
+    # Il CIG ripetuto si valuta prima di quello già presente: con la promozione a blocchi la prima
+    # occorrenza può essere già entrata in 'gare' da un blocco precedente dello stesso file
+    cursor.execute(f"""
+        UPDATE {name} SET stato = CASE
+            WHEN identificativo_gara IS NULL OR trim(identificativo_gara) = '' THEN 'cig_mancante'
+            WHEN riga > (SELECT MIN(s.riga) FROM {name} s WHERE s.identificativo_gara = {name}.identificativo_gara) THEN 'duplicato_file'
+            WHEN EXISTS (SELECT 1 FROM gare g WHERE g.identificativo_gara = {name}.identificativo_gara) THEN 'gia_presente'
+            ELSE 'valida' END
+        WHERE riga BETWEEN ? AND ?""", rows)
+    counts = dict.fromkeys(STAGING_STATES, 0)
+    counts.update({row[0]: row[1] for row in cursor.execute(f"SELECT stato, COUNT(*) FROM {name} WHERE riga BETWEEN ? AND ? GROUP BY stato", rows)})
+    return counts
+
+@trace_utils.traced('db.staging_valida')
+def validate_staging(name: str) -> dict:
+    """Conteggi per stato della tabella di staging (rivalutati rispetto alle gare attuali)."""
+    name = _staging_table(name)
+    try:
+        with get_db_cursor() as cursor: return _validate_staging(cursor, name)
+    except sqlite3.Error as e:
+        logger.exception("Errore validazione staging: %s", e)
+        raise DatabaseError(f"Errore database durante la validazione dell'importazione: {e}") from e
+
+def get_staging_preview(name: str, limit=5) -> pd.DataFrame:
+    """Prime righe della tabella di staging, con stato di validazione."""
+    name = _staging_table(name)
     try:
-        get_gara_by_id.clear()
-        print("- Cache get_gara_by_id pulita.")
+        return pd.read_sql_query(f"SELECT riga, stato, {', '.join(STAGING_COLUMNS)} FROM {name} ORDER BY riga LIMIT ?",
+                                 init_connection(), params=(int(limit),))
     except Exception as e:
-        print(f"- Errore pulizia cache get_gara_by_id: {e}")
-    # Aggiungi qui altre funzioni cachate se necessario
-    print("Pulizia cache Streamlit completata.")
+        raise DatabaseError(f"Errore lettura anteprima importazione: {e}") from e
+
+def get_staging_skipped(name: str, first_row=1) -> list:
+    """(riga, CIG, stato) delle righe da first_row in poi che non sono state importate, nell'ordine del file."""
+    name = _staging_table(name)
+    try:
+        return [tuple(row) for row in init_connection().execute(
+            f"SELECT riga, identificativo_gara, stato FROM {name} WHERE stato IS NOT 'valida' AND riga >= ? ORDER BY riga", (int(first_row),))]
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore lettura righe scartate: {e}") from e
+
+@trace_utils.traced('db.staging_promuovi')
+def promote_staging(name: str, first_row=1, last_row=None, journal=None) -> dict:
+    """
+    Rivaluta e inserisce in 'gare' le righe valide dell'intervallo con un solo INSERT ... SELECT, nella
+    stessa transazione (nessun'altra scrittura può inserirsi tra controllo e inserimento). Se journal
+    ({'impronta', 'nome_file', 'righe_totali'} o una lista, uno per file con 'prima_riga' = riga di
+    staging della sua prima riga) è indicato, nella stessa transazione il registro importazioni avanza
+    fino a last_row: un'interruzione non lascia blocchi importati ma non registrati.
+    Lo snapshot non viene riscritto qui ma dal chiamante a fine importazione (refresh_snapshot), non a ogni blocco.
+    Ritorna i conteggi per stato dell'intervallo ('valida' = righe importate).
+    """
+    name = _staging_table(name)
+    columns = ', '.join(STAGING_COLUMNS)
+    try:
+        with get_db_cursor() as cursor:
+            counts = _validate_staging(cursor, name, first_row, last_row)
+            cursor.execute(f"INSERT INTO gare ({columns}) SELECT {columns} FROM {name} "
+                           "WHERE stato = 'valida' AND riga BETWEEN ? AND ? ORDER BY riga",
+                           (int(first_row), int(last_row) if last_row is not None else 2**62))
+            for entry in ([journal] if isinstance(journal, dict) else journal or []):
+                offset = entry.get('prima_riga', 1) - 1 # Righe di staging prima di quelle del file
+                low, high = max(int(first_row), offset + 1), offset + entry['righe_totali']
+                if last_row is not None: high = min(high, int(last_row))
+                if high < low and entry['righe_totali']: continue # Intervallo che non tocca questo file
+                file_counts = dict.fromkeys(STAGING_STATES, 0)
+                file_counts.update({row[0]: row[1] for row in cursor.execute(
+                    f"SELECT stato, COUNT(*) FROM {name} WHERE riga BETWEEN ? AND ? GROUP BY stato", (low, high))})
+                processed = high - offset
+                cursor.execute("""
+                    INSERT INTO import_journal (impronta, nome_file, righe_totali, righe_processate, importate, saltate, stato, aggiornato)
+                    VALUES (:impronta, :nome_file, :righe_totali, :righe_processate, :importate, :saltate, :stato, CURRENT_TIMESTAMP)
+                    ON CONFLICT (impronta) DO UPDATE SET righe_processate = excluded.righe_processate, stato = excluded.stato,
+                        importate = importate + excluded.importate, saltate = saltate + excluded.saltate, aggiornato = CURRENT_TIMESTAMP""",
+                    {**entry, 'righe_processate': processed, 'importate': file_counts['valida'],
+                     'saltate': sum(file_counts.values()) - file_counts['valida'],
+                     'stato': 'completato' if processed >= entry['righe_totali'] else 'in_corso'})
+        logger.info("Importate %d gare da %s (righe %s-%s).", counts['valida'], name, first_row, last_row or "fine", extra={'conteggi': counts})
+        return counts
+    except sqlite3.Error as e:
+        logger.exception("Errore promozione staging: %s", e)
+        raise DatabaseError(f"Errore database durante l'importazione: {e}") from e
+
+def drop_staging(name: str) -> None:
+    """Elimina la tabella di staging (nessun errore se non esiste più)."""
+    name = _staging_table(name)
+    try:
+        with get_db_cursor() as cursor: cursor.execute(f"DROP TABLE IF EXISTS {name}")
+    except sqlite3.Error as e:
+        logger.warning("Eliminazione staging %s fallita: %s", name, e)
 
-# --- Inizializzazione ---
-# Assicura che la tabella esista all'avvio dell'applicazione
-create_table()
\ No newline at end of file
+# --- Registro Importazioni ---
+# Una riga per file (impronta = SHA-256 del contenuto): righe già promosse, esito, stato
+# ('in_corso' | 'completato'). Permette di saltare i file già importati e di riprendere quelli interrotti.
+def get_import_journal(impronta: str) -> dict | None:
+    """Voce del registro importazioni per l'impronta indicata (None se il file non è mai stato importato)."""
+    try:
+        row = init_connection().execute("SELECT * FROM import_journal WHERE impronta = ?", (impronta,)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore lettura registro importazioni: {e}") from e
+
+def delete_import_journal(impronta: str) -> None:
+    """Dimentica un file (es. per reimportarlo da capo)."""
+    try:
+        with get_db_cursor() as cursor: cursor.execute("DELETE FROM import_journal WHERE impronta = ?", (impronta,))
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore aggiornamento registro importazioni: {e}") from e
+
+def _drop_stale_staging(cursor) -> None:
+    """Elimina le tabelle di staging più vecchie di STAGING_MAX_AGE_HOURS (caricamenti abbandonati)."""
+    limit = (datetime.datetime.now() - datetime.timedelta(hours=STAGING_MAX_AGE_HOURS)).strftime('%Y%m%d%H%M%S')
+    matches = [STAGING_PATTERN.fullmatch(row[0]) for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for match in matches:
+        if match and match.group(1) < limit:
+            name = match.group(0)
+            cursor.execute(f"DROP TABLE IF EXISTS {name}")
+            logger.info("Tabella di staging abbandonata eliminata: %s", name)
+
+# --- Profili di Mappatura Colonne ---
+# Mappatura intestazioni -> colonne confermata dall'utente, per firma delle intestazioni: i file
+# successivi con le stesse intestazioni la riusano senza ricalcolare le somiglianze.
+def _profile_from_row(row) -> dict:
+    profile = dict(row)
+    profile['intestazioni'], profile['mappatura'] = json.loads(profile['intestazioni']), json.loads(profile['mappatura'])
+    return profile
+
+def get_mapping_profile(firma: str) -> dict | None:
+    """Profilo salvato per la firma ({'firma', 'nome', 'intestazioni', 'mappatura', ...}) o None."""
+    try:
+        row = init_connection().execute("SELECT * FROM mapping_profiles WHERE firma = ?", (firma,)).fetchone()
+        return _profile_from_row(row) if row else None
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore lettura profili di mappatura: {e}") from e
+
+def list_mapping_profiles() -> list:
+    """Tutti i profili salvati, dal più recente."""
+    try:
+        return [_profile_from_row(row) for row in init_connection().execute(
+            "SELECT * FROM mapping_profiles ORDER BY COALESCE(aggiornato, creato) DESC")]
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore lettura profili di mappatura: {e}") from e
+
+def save_mapping_profile(firma: str, intestazioni: list, mappatura: dict, nome=None) -> None:
+    """Crea o sostituisce il profilo della firma."""
+    try:
+        with get_db_cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO mapping_profiles (firma, nome, intestazioni, mappatura) VALUES (?, ?, ?, ?)
+                ON CONFLICT (firma) DO UPDATE SET nome = excluded.nome, intestazioni = excluded.intestazioni,
+                    mappatura = excluded.mappatura, aggiornato = CURRENT_TIMESTAMP""",
+                (firma, nome, json.dumps(list(intestazioni), ensure_ascii=False), json.dumps(mappatura, ensure_ascii=False)))
+        logger.info("Profilo di mappatura salvato: %s (%d colonne).", nome or firma, len(mappatura))
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore salvataggio profilo di mappatura: {e}") from e
+
+def delete_mapping_profile(firma: str) -> None:
+    try:
+        with get_db_cursor() as cursor: cursor.execute("DELETE FROM mapping_profiles WHERE firma = ?", (firma,))
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Errore eliminazione profilo di mappatura: {e}") from e
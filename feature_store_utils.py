@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Feature store ML: feature ingegnerizzate per gara, persistite in SQLite e aggiornate in modo incrementale."""
+import os
+import sqlite3
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+import model_store_utils
+import trace_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
+
+# --- Costanti ---
+FEATURE_STORE_PATH = os.path.join(model_store_utils.MODEL_DIR, "feature_store.sqlite")
+FEATURES_TABLE = "ml_features"
+AGGREGATES_TABLE = "ml_aggregati" # Totali giornalieri per stazione appaltante / categoria
+# Da incrementare ad ogni modifica di engineer_features o dello schema: lo store viene ricostruito
+FEATURE_VERSION = 2
+TARGET_COLUMN = 'soglia_anomalia_calcolata'
+# Colonne grezze della tabella gare da cui dipendono le feature (il loro hash decide se ricalcolare una riga)
+RAW_COLUMNS = ['importo_base', 'categoria_lavori', 'stazione_appaltante', 'numero_concorrenti', 'data_gara', TARGET_COLUMN]
+# Feature di riga salvate nello store, più giorno e soglia che alimentano gli aggregati storici
+ROW_FEATURES = ['importo_base', 'categoria_lavori', 'numero_concorrenti', 'anno_gara', 'mese_gara', 'stazione_appaltante']
+STORED_COLUMNS = ROW_FEATURES + ['giorno', 'soglia']
+# Aggregati storici per gruppo (colonna -> prefisso feature): calcolati solo sulle gare con data
+# STRETTAMENTE precedente, quindi la soglia della gara stessa (o di gare dello stesso giorno) non entra mai.
+AGGREGATE_GROUPS = {'stazione_appaltante': 'sa', 'categoria_lavori': 'cat'}
+AGGREGATE_FEATURES = [f"{prefix}_{name}" for prefix in AGGREGATE_GROUPS.values() for name in ('soglia_media_passata', 'gare_passate')]
+NUMERIC_FEATURES = ['importo_base', 'numero_concorrenti', 'anno_gara', 'mese_gara'] + AGGREGATE_FEATURES
+CATEGORICAL_FEATURES = ['categoria_lavori', 'stazione_appaltante']
+FEATURE_COLUMNS = ROW_FEATURES + AGGREGATE_FEATURES
+
+@contextmanager
+def _connect(path=None):
+    """Connessione breve al feature store (usata sia dal server sia dai processi worker)."""
+    path = path or FEATURE_STORE_PATH
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, timeout=15.0)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != FEATURE_VERSION:
+            # Feature di una versione precedente: si ricalcola tutto al prossimo utilizzo
+            conn.execute(f"DROP TABLE IF EXISTS {FEATURES_TABLE}")
+            conn.execute(f"DROP TABLE IF EXISTS {AGGREGATES_TABLE}")
+            conn.execute(f"PRAGMA user_version = {FEATURE_VERSION}")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {FEATURES_TABLE} (
+                gara_id INTEGER PRIMARY KEY,
+                feature_version INTEGER NOT NULL,
+                row_hash INTEGER NOT NULL, -- Hash delle colonne grezze (RAW_COLUMNS) al momento del calcolo
+                importo_base REAL,
+                categoria_lavori TEXT,
+                numero_concorrenti REAL,
+                anno_gara REAL,
+                mese_gara REAL,
+                stazione_appaltante TEXT,
+                giorno INTEGER, -- Giorni dal 1970-01-01 (NULL se data mancante)
+                soglia REAL
+            )""")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {AGGREGATES_TABLE} (
+                gruppo TEXT NOT NULL, -- Colonna di raggruppamento (es. 'stazione_appaltante')
+                chiave TEXT NOT NULL,
+                giorno INTEGER NOT NULL,
+                somma_soglia REAL NOT NULL DEFAULT 0,
+                n_soglie INTEGER NOT NULL DEFAULT 0,
+                n_gare INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (gruppo, chiave, giorno)
+            )""")
+        yield conn; conn.commit()
+    finally:
+        conn.close()
+
+def engineer_features(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Calcola (in modo vettoriale) le feature di riga: valori numerici, anno/mese dalla data,
+    categoria e stazione appaltante come testo, più giorno e soglia per gli aggregati.
+    NaN lasciati invariati: imputazione ed encoding dipendono dal modello.
+    """
+    features = pd.DataFrame(index=df.index)
+    for col in ['importo_base', 'numero_concorrenti']:
+        features[col] = pd.to_numeric(df[col], errors='coerce').astype(float) if col in df.columns else np.nan
+    dates = pd.to_datetime(df['data_gara'], errors='coerce') if 'data_gara' in df.columns else pd.Series(pd.NaT, index=df.index)
+    features['anno_gara'] = dates.dt.year.astype(float)
+    features['mese_gara'] = dates.dt.month.astype(float)
+    # Testo come nell'encoding originale (astype(str)), NaN conservati per l'imputazione
+    for col in CATEGORICAL_FEATURES:
+        features[col] = df[col].astype(str).where(df[col].notna(), None) if col in df.columns else None
+    features['giorno'] = (dates.dt.normalize() - pd.Timestamp('1970-01-01')).dt.days.astype(float)
+    features['soglia'] = pd.to_numeric(df[TARGET_COLUMN], errors='coerce').astype(float) if TARGET_COLUMN in df.columns else np.nan
+    return features[STORED_COLUMNS]
+
+def _row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """Hash vettoriale delle colonne grezze per riga (int64, come lo salva SQLite)."""
+    raw = df.reindex(columns=RAW_COLUMNS)
+    return pd.util.hash_pandas_object(raw, index=False).to_numpy().view(np.int64)
+
+def _update_aggregates(conn, contributions: pd.DataFrame) -> None:
+    """
+    Applica ai totali giornalieri il contributo (colonna 'segno': +1 righe nuove, -1 righe rimosse o
+    da sostituire) di un insieme di gare, con un solo groupby per gruppo.
+    """
+    if contributions.empty: return
+    sign = contributions['segno']
+    for col in AGGREGATE_GROUPS:
+        valid = contributions[col].notna() & contributions['giorno'].notna()
+        if not valid.any(): continue
+        delta = pd.DataFrame({'chiave': contributions.loc[valid, col], 'giorno': contributions.loc[valid, 'giorno'].astype(np.int64),
+                              'somma_soglia': contributions.loc[valid, 'soglia'].fillna(0) * sign[valid],
+                              'n_soglie': contributions.loc[valid, 'soglia'].notna().astype(int) * sign[valid],
+                              'n_gare': sign[valid]}).groupby(['chiave', 'giorno'], as_index=False).sum()
+        conn.executemany(f"""INSERT INTO {AGGREGATES_TABLE} (gruppo, chiave, giorno, somma_soglia, n_soglie, n_gare) VALUES (?, ?, ?, ?, ?, ?)
+                             ON CONFLICT (gruppo, chiave, giorno) DO UPDATE SET somma_soglia = somma_soglia + excluded.somma_soglia,
+                             n_soglie = n_soglie + excluded.n_soglie, n_gare = n_gare + excluded.n_gare""",
+                         ((col, str(k), int(g), float(s), int(ns), int(n)) for k, g, s, ns, n in delta.itertuples(index=False, name=None)))
+    conn.execute(f"DELETE FROM {AGGREGATES_TABLE} WHERE n_gare <= 0")
+
+def _aggregate_features(conn, rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    Media soglia e numero gare dello stesso gruppo con data strettamente precedente, per ogni riga:
+    cumulata dei totali giornalieri + merge_asof (allow_exact_matches=False), senza cicli per riga.
+    """
+    result = pd.DataFrame(np.nan, index=rows.index, columns=AGGREGATE_FEATURES)
+    for col, prefix in AGGREGATE_GROUPS.items():
+        valid = rows[col].notna() & rows['giorno'].notna()
+        if not valid.any(): continue
+        daily = pd.read_sql_query(f"SELECT chiave, giorno, somma_soglia, n_soglie, n_gare FROM {AGGREGATES_TABLE} WHERE gruppo = ? ORDER BY giorno",
+                                  conn, params=(col,))
+        daily['giorno'] = daily['giorno'].astype(np.int64); daily['chiave'] = daily['chiave'].astype(object)
+        daily[['somma_soglia', 'n_soglie', 'n_gare']] = daily.groupby('chiave')[['somma_soglia', 'n_soglie', 'n_gare']].cumsum()
+        left = pd.DataFrame({'chiave': rows.loc[valid, col].astype(object), 'giorno': rows.loc[valid, 'giorno'].astype(np.int64),
+                             'pos': np.flatnonzero(valid.to_numpy())}).sort_values('giorno', kind='stable')
+        merged = pd.merge_asof(left, daily, on='giorno', by='chiave', allow_exact_matches=False)
+        pos = merged['pos'].to_numpy()
+        result.iloc[pos, result.columns.get_loc(f"{prefix}_soglia_media_passata")] = (merged['somma_soglia'] / merged['n_soglie'].where(merged['n_soglie'] > 0)).to_numpy()
+        result.iloc[pos, result.columns.get_loc(f"{prefix}_gare_passate")] = merged['n_gare'].fillna(0).to_numpy()
+    return result
+
+@trace_utils.traced('ml.feature_store')
+def get_features(df: pd.DataFrame, prune: bool = False, store_path=None) -> pd.DataFrame:
+    """
+    Feature ingegnerizzate per le righe di df (stesso indice), lette dal feature store.
+
+    Le righe con 'id' (gare del DB) vengono prese dal feature store se l'hash delle colonne grezze
+    coincide; quelle nuove o modificate vengono ricalcolate, salvate e i loro contributi applicati
+    (come differenza) ai totali giornalieri degli aggregati storici. Le righe senza id (es. input di
+    previsione) vengono solo calcolate e non entrano negli aggregati.
+
+    Args:
+        df (pd.DataFrame): Gare (in training l'intera tabella, anche le gare senza soglia).
+        prune (bool): Se True df è l'intera tabella gare: le gare nello store assenti da df sono
+                      state eliminate e vengono tolte anche dagli aggregati.
+    """
+    with _connect(store_path) as conn:
+        if 'id' not in df.columns or df['id'].isna().all():
+            rows = engineer_features(df)
+        else:
+            ids = df['id'].to_numpy()
+            hashes = _row_hashes(df)
+            # Lettura degli hash, differenze e scritture sotto lo stesso lock di scrittura: due processi
+            # (app e worker di addestramento) non possono applicare due volte il contributo della stessa gara
+            conn.execute("BEGIN IMMEDIATE")
+            stored_all = pd.read_sql_query(f"SELECT gara_id, row_hash, {', '.join(STORED_COLUMNS)} FROM {FEATURES_TABLE}",
+                                           conn, index_col='gara_id')
+            stored = stored_all.reindex(ids)
+            fresh = (stored['row_hash'].to_numpy() == hashes) & pd.notna(ids)
+
+            rows = stored[STORED_COLUMNS].astype({col: object for col in CATEGORICAL_FEATURES}).set_axis(df.index)
+            contributions = []
+            if (~fresh).any():
+                computed = engineer_features(df.loc[~fresh])
+                rows.loc[~fresh, STORED_COLUMNS] = computed
+                replaced = stored[~fresh & stored['row_hash'].notna().to_numpy()]
+                to_store = computed.assign(gara_id=ids[~fresh], row_hash=hashes[~fresh])[pd.notna(ids[~fresh])]
+                contributions += [replaced.assign(segno=-1), to_store.assign(segno=1)]
+                values = to_store[['gara_id', 'row_hash'] + STORED_COLUMNS].astype(object).where(to_store.notna(), None)
+                conn.executemany(f"INSERT OR REPLACE INTO {FEATURES_TABLE} (gara_id, row_hash, {', '.join(STORED_COLUMNS)}, feature_version) "
+                                 f"VALUES ({', '.join('?' * (len(STORED_COLUMNS) + 2))}, {FEATURE_VERSION})",
+                                 values.itertuples(index=False, name=None))
+            removed = stored_all[~stored_all.index.isin(ids)] if prune else stored_all.iloc[:0]
+            if not removed.empty:
+                contributions.append(removed.assign(segno=-1))
+                conn.executemany(f"DELETE FROM {FEATURES_TABLE} WHERE gara_id = ?", ((int(i),) for i in removed.index))
+            if contributions:
+                _update_aggregates(conn, pd.concat(contributions, ignore_index=True))
+            logger.info("Feature store: %d righe lette, %d calcolate e salvate, %d rimosse.", int(fresh.sum()), int((~fresh).sum()), len(removed))
+
+        features = pd.concat([rows[ROW_FEATURES], _aggregate_features(conn, rows)], axis=1)
+    for col in NUMERIC_FEATURES: features[col] = features[col].astype(float)
+    for col in CATEGORICAL_FEATURES: features[col] = features[col].astype(object)
+    return features[FEATURE_COLUMNS]
+
+def sync(df: pd.DataFrame, store_path=None) -> None:
+    """Allinea il feature store all'intera tabella gare (nuove, modificate ed eliminate)."""
+    get_features(df, prune=True, store_path=store_path)
+
+def clear_store(store_path=None) -> None:
+    """Svuota il feature store (le feature verranno ricalcolate al prossimo utilizzo)."""
+    with _connect(store_path) as conn:
+        conn.execute(f"DELETE FROM {FEATURES_TABLE}")
+        conn.execute(f"DELETE FROM {AGGREGATES_TABLE}")
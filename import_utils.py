@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+"""Lettura, pulizia e importazione nel DB di file CSV/Excel di gare (senza dipendenze dall'interfaccia)."""
+import io
+import os
+import re
+import time
+import hashlib
+import zipfile
+import difflib
+import unicodedata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import datetime
+import traceback
+import pandas as pd
+import numpy as np
+
+import db_utils
+import cache_utils
+import trace_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
+
+# --- Costanti ---
+DATE_FORMAT_STR = "%Y-%m-%d" # Formato date nel DB
+SUPPORTED_EXTENSIONS = ('.csv', '.xls', '.xlsx')
+# Combinazioni provate in lettura dei CSV (None = separatore rilevato automaticamente)
+CSV_ENCODINGS = ['utf-8', 'latin1', 'iso-8859-1', 'cp1252']
+CSV_SEPARATORS = [None, ';', ',']
+CSV_DECIMALS = [',', '.']
+# Intestazioni comuni (in minuscolo) -> colonne del DB
+COLUMN_MAPPING = {
+    # Mappature CIG (fondamentale)
+    'cig': 'identificativo_gara', 'id gara': 'identificativo_gara',
+    # Mappature Descrizione
+    'oggetto gara': 'descrizione', 'oggetto': 'descrizione', 'descrizione gara': 'descrizione',
+    # Mappature Data
+    'data scadenza': 'data_gara', 'data': 'data_gara', 'data pubblicazione': 'data_gara',
+    # Mappature Importo Base
+    'importo a base d\'asta': 'importo_base', 'importo': 'importo_base', 'base asta': 'importo_base', 'importo base': 'importo_base',
+    # Mappature Categoria
+    'categoria': 'categoria_lavori', 'cat.': 'categoria_lavori', 'categoria prevalente': 'categoria_lavori',
+    # Mappature Stazione Appaltante
+    'stazione appaltante': 'stazione_appaltante', 'sa': 'stazione_appaltante', 'ente': 'stazione_appaltante',
+    # Mappature Ribasso Offerto (%)
+    'nostro ribasso (%)': 'mio_ribasso_percentuale', 'ribasso offerto %': 'mio_ribasso_percentuale', 'tuo ribasso %': 'mio_ribasso_percentuale', 'mio ribasso %': 'mio_ribasso_percentuale',
+    # Mappature Importo Offerto (€) - Calcolato se non presente
+    'nostra offerta': 'importo_offerto', 'importo offerto': 'importo_offerto',
+    # Mappature Soglia Anomalia (%)
+    'soglia anomalia (%)': 'soglia_anomalia_calcolata', 'soglia %': 'soglia_anomalia_calcolata', 'soglia di anomalia %': 'soglia_anomalia_calcolata',
+    # Mappature Ribasso Aggiudicatario (%)
+    'ribasso aggiudicatario (%)': 'ribasso_aggiudicatario_percentuale', 'ribasso agg. %': 'ribasso_aggiudicatario_percentuale', 'ribasso aggiudicazione %': 'ribasso_aggiudicatario_percentuale',
+    # Mappature Importo Aggiudicazione (€) - Calcolato se non presente
+    'importo aggiudicazione': 'importo_aggiudicazione', 'importo agg.': 'importo_aggiudicazione', 'importo aggiudicato': 'importo_aggiudicazione',
+    # Mappature Numero Concorrenti
+    'num concorrenti': 'numero_concorrenti', 'num. offerte': 'numero_concorrenti', 'numero offerte': 'numero_concorrenti',
+    # Mappature Posizione Graduatoria
+    'posizione graduatoria': 'posizione_in_graduatoria', 'posizione': 'posizione_in_graduatoria', 'ns posizione': 'posizione_in_graduatoria',
+    # Mappature Esito
+    'esito gara': 'esito', 'esito': 'esito', 'stato': 'esito',
+    # Mappature Note
+    'annotazioni': 'note', 'note': 'note'
+}
+# Colonne target che devono essere numeriche nel DB
+NUMERIC_COLUMNS = ['importo_base', 'mio_ribasso_percentuale', 'importo_offerto',
+                   'soglia_anomalia_calcolata', 'ribasso_aggiudicatario_percentuale',
+                   'importo_aggiudicazione', 'numero_concorrenti', 'posizione_in_graduatoria']
+# Importi in euro (al più due decimali): '250.000' scritto come testo è 250000, non 250.0
+AMOUNT_COLUMNS = ['importo_base', 'importo_offerto', 'importo_aggiudicazione']
+
+def print_report(level, message):
+    """Report di default: messaggi su stdout (livelli 'info', 'success', 'warning', 'error')."""
+    prefix = {'warning': "ATTENZIONE: ", 'error': "ERRORE: "}.get(level, "")
+    print(f"{prefix}{message}")
+
+# --- Mappatura Intestazioni ---
+# Le intestazioni non presenti in COLUMN_MAPPING vengono associate per somiglianza: token normalizzati
+# (minuscole, senza accenti né punteggiatura, '%' -> 'percentuale'), confrontati con il nome della colonna
+# e con le sue intestazioni note. Una mappatura confermata si salva come profilo (db_utils) per la
+# firma delle intestazioni e ai caricamenti successivi si applica senza ricalcolo.
+MAPPING_MIN_SCORE = 0.6 # Somiglianza minima (0-1) per proporre un'associazione
+MAPPING_AMBIGUITY_MARGIN = 0.1 # Seconda scelta entro questo scarto: associazione segnalata come incerta
+MAPPING_STOPWORDS = {'a', 'al', 'd', 'da', 'del', 'della', 'dei', 'di', 'e', 'il', 'in', 'la', 'lo', 'n', 'nr', 'num', 'numero', 'per'}
+MAPPING_SYNONYMS = {'nostro': 'mio', 'nostra': 'mio', 'ns': 'mio', 'tuo': 'mio', 'mia': 'mio', 'perc': 'percentuale', 'id': 'identificativo'}
+MAPPING_TARGETS = [col for col in db_utils.EXPECTED_COLUMNS if col not in ['id', 'data_inserimento']]
+
+def normalize_header(header) -> tuple:
+    """'Ribasso agg. (%)' -> ('ribasso', 'agg', 'percentuale')."""
+    text = str(header).lower().replace('%', ' percentuale ').replace('€', ' euro ').replace('_', ' ')
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+    return tuple(MAPPING_SYNONYMS.get(token, token) for token in re.findall(r'[a-z0-9]+', text) if token not in MAPPING_STOPWORDS)
+
+def _target_aliases() -> dict:
+    aliases = {col: {normalize_header(col)} for col in MAPPING_TARGETS}
+    for header, col in COLUMN_MAPPING.items(): aliases[col].add(normalize_header(header))
+    return {col: [alias for alias in forms if alias] for col, forms in aliases.items()}
+
+_TARGET_ALIASES = _target_aliases()
+
+def _token_similarity(a, b) -> float:
+    if a == b: return 1.0
+    if min(len(a), len(b)) >= 3 and (a.startswith(b) or b.startswith(a)): return 0.9 # Abbreviazioni: 'agg' / 'aggiudicatario'
+    ratio = difflib.SequenceMatcher(None, a, b).ratio()
+    return ratio if ratio >= 0.8 else 0.0 # Refusi ('aggiudicazone'), non parole diverse
+
+def header_similarity(tokens, alias) -> float:
+    """Somiglianza 0-1 tra due intestazioni normalizzate (coefficiente di Dice con corrispondenze approssimate)."""
+    if not tokens or not alias: return 0.0
+    matched = sum(max(_token_similarity(t, u) for u in alias) for t in tokens) + sum(max(_token_similarity(u, t) for t in tokens) for u in alias)
+    return matched / (len(tokens) + len(alias))
+
+def header_signature(headers) -> str:
+    """Firma di un insieme di intestazioni (indipendente dall'ordine delle colonne)."""
+    keys = sorted(str(h).strip().lower() for h in headers)
+    return hashlib.sha256("\x1f".join(keys).encode('utf-8')).hexdigest()[:16]
+
+def suggest_mapping(headers) -> dict:
+    """
+    Mappatura proposta per le intestazioni (minuscole): COLUMN_MAPPING o nome esatto della colonna,
+    poi la somiglianza più alta, con ogni colonna assegnata al massimo una volta.
+    Ritorna {'mappatura': {intestazione: colonna}, 'punteggi': {intestazione: 0-1}, 'incerte': [...], 'ignorate': [...]}.
+    """
+    keys = list(dict.fromkeys(str(h).strip().lower() for h in headers))
+    candidates = [] # (punteggio, posizione intestazione, posizione colonna, intestazione, colonna)
+    for i, key in enumerate(keys):
+        exact = COLUMN_MAPPING.get(key) or (key if key in MAPPING_TARGETS else None)
+        if exact:
+            candidates.append((1.0, i, MAPPING_TARGETS.index(exact), key, exact)); continue
+        tokens = normalize_header(key)
+        for j, col in enumerate(MAPPING_TARGETS):
+            score = max(header_similarity(tokens, alias) for alias in _TARGET_ALIASES[col])
+            if score >= MAPPING_MIN_SCORE: candidates.append((score, i, j, key, col))
+    candidates.sort(key=lambda c: (-c[0], c[1], c[2])) # A parità: intestazione e colonna che vengono prima
+    mapping, scores, uncertain = {}, {}, []
+    for score, _, _, key, col in candidates:
+        if key in mapping or col in mapping.values(): continue
+        mapping[key], scores[key] = col, round(score, 2)
+        if score < 1.0 and any(c[3] == key and c[4] != col and c[0] >= score - MAPPING_AMBIGUITY_MARGIN for c in candidates):
+            uncertain.append(key)
+    return {'mappatura': {key: mapping[key] for key in keys if key in mapping}, 'punteggi': scores,
+            'incerte': uncertain, 'ignorate': [key for key in keys if key not in mapping]}
+
+def load_mapping_profiles() -> dict:
+    """Profili salvati per firma ({} se il DB non è leggibile): letti nel processo principale e passati ai worker."""
+    try: return {profile['firma']: profile for profile in db_utils.list_mapping_profiles()}
+    except db_utils.DatabaseError as e:
+        logger.warning("Profili di mappatura non disponibili: %s", e); return {}
+
+def resolve_mapping(headers, profiles=None) -> dict:
+    """
+    Mappatura da usare per le intestazioni: il profilo salvato per la loro firma se esiste
+    ('origine': 'profilo'), altrimenti quella proposta da suggest_mapping ('origine': 'automatica').
+    profiles (da load_mapping_profiles) evita di leggere il DB, come serve nei processi worker.
+    Ritorna il dict di suggest_mapping con 'firma', 'intestazioni' e 'origine'.
+    """
+    keys = list(dict.fromkeys(str(h).strip().lower() for h in headers))
+    signature = header_signature(keys)
+    if profiles is not None: profile = profiles.get(signature)
+    else:
+        try: profile = db_utils.get_mapping_profile(signature)
+        except db_utils.DatabaseError as e:
+            logger.warning("Profili di mappatura non disponibili: %s", e); profile = None
+    if profile:
+        mapping = {key: col for key, col in profile['mappatura'].items() if key in keys and col in MAPPING_TARGETS}
+        return {'firma': signature, 'intestazioni': keys, 'origine': 'profilo', 'nome_profilo': profile['nome'], 'mappatura': mapping,
+                'punteggi': {}, 'incerte': [], 'ignorate': [key for key in keys if key not in mapping]}
+    return {'firma': signature, 'intestazioni': keys, 'origine': 'automatica', **suggest_mapping(keys)}
+
+def save_mapping_profile(headers, mapping: dict, name=None) -> str:
+    """Salva la mappatura confermata (intestazione -> colonna) per la firma delle intestazioni; ritorna la firma."""
+    keys = list(dict.fromkeys(str(h).strip().lower() for h in headers))
+    mapping = {key: col for key, col in mapping.items() if key in keys and col in MAPPING_TARGETS}
+    if len(set(mapping.values())) < len(mapping):
+        raise ValueError("Ogni colonna del database può essere associata a una sola intestazione.")
+    signature = header_signature(keys)
+    db_utils.save_mapping_profile(signature, keys, mapping, nome=name)
+    return signature
+
+# --- Lettura ---
+@trace_utils.traced('import.lettura')
+def read_file(source, file_name, report=print_report) -> pd.DataFrame | None:
+    """
+    Legge un file CSV (provando encoding, separatori e decimali comuni) o Excel.
+    source è un oggetto file binario posizionabile (file aperto, BytesIO, UploadedFile di Streamlit).
+    """
+    df = None
+    if file_name.lower().endswith('.csv'):
+        for enc in CSV_ENCODINGS:
+            for sep in CSV_SEPARATORS:
+                for dec in CSV_DECIMALS:
+                    try:
+                        source.seek(0) # Torna all'inizio del file
+                        df_temp = pd.read_csv(source, sep=sep, engine='python', encoding=enc, decimal=dec)
+                    except Exception:
+                        continue # Prova prossima combinazione
+                    # Più di una colonna è un buon segno che separatore ed encoding sono corretti
+                    if df_temp is not None and df_temp.shape[1] > 1:
+                        report('info', f"Letto CSV con successo: sep='{sep if sep else 'auto'}', encoding='{enc}', decimal='{dec}'")
+                        return df_temp
+        report('error', "Lettura CSV fallita con tutte le combinazioni comuni. Verifica formato, encoding, separatore e decimale del file.")
+        return None
+    elif file_name.lower().endswith(('.xls', '.xlsx')):
+        try:
+            source.seek(0)
+            df = pd.read_excel(source, engine='openpyxl')
+            report('success', "File Excel caricato con successo.")
+            return df
+        except Exception as e_excel:
+            report('error', f"Errore durante la lettura del file Excel: {e_excel}")
+            report('error', traceback.format_exc())
+            return None
+    report('error', "Formato file non supportato. Caricare un file .csv, .xls o .xlsx.")
+    return None
+
+# --- Pulizia ---
+@trace_utils.traced('import.pulizia')
+def clean_data(df, report=print_report, on_mapping=None, profiles=None) -> pd.DataFrame | None:
+    """
+    Mappa le intestazioni sulle colonne del DB (profilo salvato o somiglianza, vedi resolve_mapping),
+    converte numeri/date e calcola gli importi mancanti. on_mapping(info) riceve la mappatura usata,
+    anche se poi la pulizia fallisce (es. per correggerla e salvarla come profilo).
+    """
+    if df is None or df.empty:
+        report('error', "Il file non contiene righe."); return None
+    report('info', f"Colonne originali: {df.columns.tolist()}")
+    headers = df.columns.astype(str).str.lower().str.strip().tolist() # Pulisci nomi colonne originali
+    info = resolve_mapping(headers, profiles)
+    if on_mapping: on_mapping(info)
+    mapping = info['mappatura']
+    # Solo le colonne associate (prima occorrenza se l'intestazione è ripetuta), già con il nome del DB
+    df = df.iloc[:, [headers.index(key) for key in mapping]].copy()
+    df.columns = list(mapping.values())
+    if info['origine'] == 'profilo':
+        report('info', f"Colonne associate con il profilo salvato '{info['nome_profilo'] or info['firma']}'.")
+    else:
+        fuzzy = [f"'{key}' -> {col} ({info['punteggi'][key]:.0%})" for key, col in mapping.items() if info['punteggi'][key] < 1.0]
+        if fuzzy: report('info', f"Colonne associate per somiglianza: {', '.join(fuzzy)}")
+        if info['incerte']: report('warning', f"Associazioni incerte, da verificare: {', '.join(info['incerte'])}")
+    if info['ignorate']: report('warning', f"Colonne non associate (ignorate): {', '.join(info['ignorate'])}")
+    report('info', f"Colonne dopo mappatura: {df.columns.tolist()}")
+
+    # --- Conversione Tipi Numerici ---
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns:
+            original = df[col]
+            # Converti a stringa, pulisci simboli (€, %), spazi
+            cleaned_series = original.astype(str).str.replace('€', '', regex=False)\
+                                .str.replace('%', '', regex=False)\
+                                .str.replace(r'\s+', '', regex=True)\
+                                .str.strip()
+            # Gestisci separatore migliaia e decimale: il separatore più a destra è il decimale
+            # ("1.234,56" italiano, "1,234.56" inglese). Senza virgola più punti sono separatori delle
+            # migliaia ("1.234.567"); un solo punto è il decimale ("12.5"), tranne negli importi scritti
+            # come testo con tre cifre dopo il punto ("250.000"). I numeri già letti come tali (Excel) restano invariati.
+            last_comma, last_dot = cleaned_series.str.rfind(','), cleaned_series.str.rfind('.')
+            standardized_series = cleaned_series.copy()
+            grouping = (last_comma < 0) & (cleaned_series.str.count(r'\.') > 1)
+            if col in AMOUNT_COLUMNS:
+                grouping |= (last_comma < 0) & cleaned_series.str.fullmatch(r'[-+]?\d{1,3}\.\d{3}') & original.map(lambda v: isinstance(v, str))
+            standardized_series[grouping] = cleaned_series[grouping].str.replace('.', '', regex=False)
+            italian = last_comma > last_dot
+            standardized_series[italian] = cleaned_series[italian].str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+            english = (last_dot > last_comma) & (last_comma >= 0)
+            standardized_series[english] = cleaned_series[english].str.replace(',', '', regex=False)
+            df[col] = pd.to_numeric(standardized_series, errors='coerce')
+
+            # Warning se la conversione fallisce per valori non vuoti
+            failed = original[df[col].isna() & original.notna() & (original.astype(str).str.strip() != '')]
+            if not failed.empty:
+                report('warning', f"Conversione numerica fallita per alcuni valori in '{col}'. Esempi non convertiti: {failed.unique()[:5]}")
+
+    # --- Conversione Data ---
+    if 'data_gara' in df.columns:
+        original = df['data_gara']
+        # Prova il formato DD/MM/YYYY prima (comune in Italia), poi i formati riconosciuti da pandas
+        df['data_gara'] = pd.to_datetime(original, errors='coerce', dayfirst=True)
+        mask_failed = df['data_gara'].isna() & original.notna()
+        if mask_failed.any():
+            df.loc[mask_failed, 'data_gara'] = pd.to_datetime(original[mask_failed], errors='coerce')
+        failed_dates = original[df['data_gara'].isna() & original.notna() & (original != '')]
+        if not failed_dates.empty:
+            report('warning', f"Conversione data fallita per alcuni valori in 'data_gara'. Esempi non convertiti: {failed_dates.unique()[:5]}")
+
+    # --- Calcoli Derivati (se mancano colonne) ---
+    if 'importo_offerto' not in df.columns and ('importo_base' in df.columns and 'mio_ribasso_percentuale' in df.columns):
+        mask = df['importo_base'].notna() & df['mio_ribasso_percentuale'].notna()
+        df.loc[mask, 'importo_offerto'] = df.loc[mask, 'importo_base'] * (1 - df.loc[mask, 'mio_ribasso_percentuale'] / 100)
+        report('info', "Colonna 'importo_offerto' calcolata da importo base e ribasso.")
+    if 'importo_aggiudicazione' not in df.columns and ('importo_base' in df.columns and 'ribasso_aggiudicatario_percentuale' in df.columns):
+        mask = df['importo_base'].notna() & df['ribasso_aggiudicatario_percentuale'].notna()
+        df.loc[mask, 'importo_aggiudicazione'] = df.loc[mask, 'importo_base'] * (1 - df.loc[mask, 'ribasso_aggiudicatario_percentuale'] / 100)
+        report('info', "Colonna 'importo_aggiudicazione' calcolata da importo base e ribasso aggiudicatario.")
+
+    # --- Selezione Colonne Finali e Validazione CIG ---
+    # Solo le colonne presenti E attese dal DB (escludendo quelle auto-generate)
+    final_cols = [col for col in db_utils.EXPECTED_COLUMNS if col in df.columns and col not in ['id', 'data_inserimento']]
+    if not final_cols:
+        report('error', "Nessuna colonna mappata corrisponde alle colonne attese dal database."); return None
+    df_final = df[final_cols].copy()
+
+    if 'identificativo_gara' not in df_final.columns:
+        report('error', "Colonna 'identificativo_gara' (CIG) MANCANTE dopo la mappatura. Impossibile importare."); return None
+    missing_id_count = df_final['identificativo_gara'].astype(str).str.strip().replace('', np.nan).isna().sum()
+    if missing_id_count:
+        report('warning', f"{missing_id_count} righe non hanno un 'identificativo_gara' (CIG) valido e saranno saltate durante l'importazione.")
+    return df_final
+
+def load_file(source, file_name, report=print_report, on_mapping=None, profiles=None) -> pd.DataFrame | None:
+    """Legge e pulisce un file; ritorna il DataFrame pronto per import_dataframe o None se fallisce."""
+    try:
+        report('info', f"Lettura file: {file_name}")
+        df = read_file(source, file_name, report)
+        return clean_data(df, report, on_mapping, profiles) if df is not None else None
+    except Exception as e:
+        report('error', f"Errore imprevisto durante il caricamento/processamento del file: {e}")
+        report('error', traceback.format_exc())
+        return None
+
+def load_path(path, profiles=None) -> dict:
+    """
+    Legge e pulisce un file da disco raccogliendo i messaggi invece di stamparli.
+    Pensata per l'esecuzione in un processo worker, con i profiles di load_mapping_profiles letti dal
+    processo principale (il worker non apre il DB): ritorna {'path', 'df', 'messages', 'seconds', 'mappatura'}.
+    """
+    messages, mapping = [], {}
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        df = load_file(f, os.path.basename(path), report=lambda level, message: messages.append((level, message)), on_mapping=mapping.update, profiles=profiles)
+    return {'path': path, 'df': df, 'messages': messages, 'seconds': time.perf_counter() - start, 'mappatura': mapping or None}
+
+def load_bytes(name, data: bytes, fingerprint=None, profiles=None) -> dict:
+    """Come load_path, per un file in memoria (es. caricato dall'utente): ritorna anche righe e impronta."""
+    messages, mapping = [], {}
+    start = time.perf_counter()
+    df = load_file(io.BytesIO(data), name, report=lambda level, message: messages.append((level, message)), on_mapping=mapping.update, profiles=profiles)
+    return {'path': name, 'df': df, 'messages': messages, 'seconds': time.perf_counter() - start,
+            'righe': 0 if df is None else len(df), 'impronta': fingerprint, 'mappatura': mapping or None}
+
+# --- Più File e Archivi ZIP ---
+PARSE_WORKERS = max(1, min(4, os.cpu_count() or 1)) # Processi per lettura e pulizia (Excel/openpyxl è CPU-bound)
+MAX_ARCHIVE_BYTES = 512 * 2**20 # Dimensione massima decompressa accettata per archivio ZIP
+
+def expand_archives(files, report=print_report) -> list:
+    """
+    [(nome, contenuto)] -> [(nome, contenuto)] dei file supportati, con gli archivi ZIP sostituiti dai
+    file che contengono ("archivio.zip/gennaio.csv"). Membri non supportati o nascosti vengono ignorati.
+    """
+    expanded = []
+    for name, data in files:
+        if not name.lower().endswith('.zip'):
+            expanded.append((name, data)); continue
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                members = [info for info in archive.infolist() if not info.is_dir()
+                           and not any(part.startswith(('.', '__MACOSX')) for part in info.filename.split('/'))]
+                if sum(info.file_size for info in members) > MAX_ARCHIVE_BYTES:
+                    report('error', f"{name}: contenuto decompresso oltre {MAX_ARCHIVE_BYTES // 2**20} MB, archivio ignorato."); continue
+                for info in members:
+                    if info.filename.lower().endswith(SUPPORTED_EXTENSIONS):
+                        expanded.append((f"{name}/{info.filename}", archive.read(info)))
+                    else:
+                        report('warning', f"{name}: '{info.filename}' ignorato (formato non supportato).")
+        except zipfile.BadZipFile as e:
+            report('error', f"{name}: archivio ZIP non valido ({e}).")
+    return expanded
+
+@cache_utils.cached('resource')
+def get_parse_executor():
+    """Pool di processi per la lettura dei file, condiviso da tutte le sessioni ('spawn' come in job_utils)."""
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@trace_utils.traced('import.lettura_parallela')
+def load_many(files, fingerprints=None) -> list:
+    """
+    Legge e pulisce più file [(nome, contenuto)] in parallelo sul pool di processi (in linea se è uno solo).
+    Ritorna i risultati di load_bytes nell'ordine dei file; un file che fa fallire il worker diventa un errore nel suo report.
+    """
+    fingerprints = fingerprints or [None] * len(files)
+    profiles = load_mapping_profiles() # Letti qui: i worker non importano lo stato del DB né vi accedono
+    if len(files) <= 1 or PARSE_WORKERS == 1:
+        return [load_bytes(name, data, fp, profiles) for (name, data), fp in zip(files, fingerprints)]
+    executor = get_parse_executor()
+    futures = [executor.submit(load_bytes, name, data, fp, profiles) for (name, data), fp in zip(files, fingerprints)]
+    results = []
+    for (name, _), fp, future in zip(files, fingerprints, futures):
+        try:
+            results.append(future.result())
+        except Exception as e: # Es. worker terminato: il pool non è più utilizzabile
+            if isinstance(e, BrokenProcessPool): get_parse_executor.clear()
+            results.append({'path': name, 'df': None, 'messages': [('error', f"Lettura fallita nel processo worker: {e}")],
+                            'seconds': 0.0, 'righe': 0, 'impronta': fp, 'mappatura': None})
+    return results
+
+def stage_loaded(loaded) -> dict:
+    """
+    Unisce i DataFrame letti da load_many (nell'ordine dei file) in un'unica tabella di staging:
+    i CIG ripetuti tra file diversi risultano 'duplicato_file' (vale la prima occorrenza).
+    Ritorna il dict di stage_dataframe con 'file': [{'nome', 'impronta', 'righe', 'prima_riga'}].
+    """
+    frames, files, next_row = [], [], 1
+    for item in loaded:
+        if item['df'] is None: continue
+        frames.append(item['df'])
+        files.append({'nome': item['path'], 'impronta': item.get('impronta'), 'righe': len(item['df']), 'prima_riga': next_row})
+        next_row += len(item['df'])
+    if not frames: return None
+    staged = stage_dataframe(pd.concat(frames, ignore_index=True, sort=False) if len(frames) > 1 else frames[0])
+    staged['file'] = files
+    return staged
+
+# --- Importazione ---
+# Il DataFrame pulito passa da una tabella di staging nel DB (db_utils): validazione, CIG ripetuti
+# nel file e CIG già presenti si calcolano in SQL sull'intero file, poi un solo INSERT ... SELECT.
+STAGING_CHUNK_ROWS = 5000 # Righe convertite in dizionari per volta durante la scrittura in staging
+IMPORT_CHUNK_ROWS = 5000 # Righe promosse per transazione nelle importazioni registrate (punto di ripresa)
+FINGERPRINT_BLOCK = 1 << 20
+STATE_LABELS = {'valida': "da importare", 'cig_mancante': "senza CIG", 'duplicato_file': "CIG ripetuto nel file",
+                'gia_presente': "CIG già nel database"}
+
+def prepare_record(record: dict) -> dict:
+    """Riga del DataFrame pulito -> dizionario per il DB (solo colonne DB, niente NaN né stringhe vuote)."""
+    clean = {k: v for k, v in record.items() if k in db_utils.EXPECTED_COLUMNS and pd.notna(v) and not (isinstance(v, str) and not v.strip())}
+    if 'data_gara' in clean and isinstance(clean['data_gara'], (datetime.datetime, pd.Timestamp)):
+        clean['data_gara'] = clean['data_gara'].strftime(DATE_FORMAT_STR)
+    if clean.get('posizione_in_graduatoria') == 0: clean['posizione_in_graduatoria'] = None # 0 = non in graduatoria
+    return clean
+
+def _iter_records(df):
+    """Record preparati a blocchi, senza materializzare tutto il file come lista di dizionari."""
+    for start in range(0, len(df), STAGING_CHUNK_ROWS):
+        for record in df.iloc[start:start + STAGING_CHUNK_ROWS].to_dict('records'):
+            yield prepare_record(record)
+
+@trace_utils.traced('import.staging')
+def stage_dataframe(df) -> dict:
+    """
+    Scrive il DataFrame pulito in una tabella di staging e ne valida le righe in SQL.
+    Ritorna {'tabella', 'righe', 'conteggi'} (conteggi per stato, vedi STATE_LABELS): da qui in poi
+    il DataFrame non serve più. Solleva db_utils.DatabaseError se la scrittura fallisce.
+    """
+    name = db_utils.create_staging(_iter_records(df))
+    try:
+        counts = db_utils.validate_staging(name)
+    except db_utils.DatabaseError:
+        db_utils.drop_staging(name); raise
+    trace_utils.count('import.righe_staging', len(df))
+    return {'tabella': name, 'righe': len(df), 'conteggi': counts}
+
+def describe_counts(counts: dict) -> str:
+    """Conteggi per stato in forma leggibile ("120 da importare, 3 CIG già nel database")."""
+    return ", ".join(f"{counts[state]} {label}" for state, label in STATE_LABELS.items() if counts.get(state))
+
+def file_fingerprint(source) -> str:
+    """Impronta SHA-256 del contenuto di un file (percorso o file binario aperto, di cui si ripristina la posizione)."""
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(FINGERPRINT_BLOCK), b''): digest.update(block)
+    else:
+        position = source.tell()
+        source.seek(0)
+        for block in iter(lambda: source.read(FINGERPRINT_BLOCK), b''): digest.update(block)
+        source.seek(position)
+    return digest.hexdigest()
+
+def import_status(fingerprint) -> dict | None:
+    """Voce del registro importazioni del file (None se mai importato, né in parte né del tutto)."""
+    return db_utils.get_import_journal(fingerprint)
+
+@trace_utils.traced('import.inserimento')
+def import_staged(staged: dict, fingerprint=None, file_name=None) -> dict:
+    """
+    Importa le righe valide della tabella di staging (dict di stage_dataframe o stage_loaded) e la elimina.
+    Senza impronta, o per più file insieme: tutte o nessuna, in una transazione. Con l'impronta del file: a blocchi di
+    IMPORT_CHUNK_ROWS righe, ognuno registrato nel registro importazioni nella sua transazione;
+    se lo stesso file era stato interrotto si riparte dal primo blocco non registrato.
+    Ritorna {'importate', 'saltate', 'cig_saltati', 'ultimo_errore', 'conteggi', 'ripresa_da'}
+    (conteggi e CIG delle sole righe processate in questa chiamata; ripresa_da = righe già fatte prima).
+    """
+    name, total = staged['tabella'], staged['righe']
+    journal, start = None, 0
+    counts, error = dict.fromkeys(db_utils.STAGING_STATES, 0), None
+    try:
+        with log_utils.aggregate(logger, "Importazione completata", tabella=name) as events:
+            try:
+                if staged.get('file'): # Più file (stage_loaded): una transazione, una voce di registro per file
+                    entries = [{'impronta': f['impronta'], 'nome_file': f['nome'], 'righe_totali': f['righe'], 'prima_riga': f['prima_riga']}
+                               for f in staged['file'] if f['impronta']]
+                    for entry in entries: # Niente ripresa per i lotti (tutto o niente): si riparte da capo
+                        if db_utils.get_import_journal(entry['impronta']): db_utils.delete_import_journal(entry['impronta'])
+                    counts = db_utils.promote_staging(name, journal=entries)
+                else:
+                    if fingerprint:
+                        previous = db_utils.get_import_journal(fingerprint)
+                        if previous and previous['stato'] == 'in_corso' and previous['righe_totali'] == total:
+                            start = previous['righe_processate']
+                            logger.info("Ripresa importazione di %s dalla riga %d di %d.", file_name or fingerprint[:12], start + 1, total)
+                        elif previous:
+                            db_utils.delete_import_journal(fingerprint) # Già completato (reimportazione forzata) o file diverso
+                        journal = {'impronta': fingerprint, 'nome_file': file_name, 'righe_totali': total}
+                    chunk = IMPORT_CHUNK_ROWS if journal else None
+                    first_row = start + 1
+                    while True: # Almeno un passaggio: registra anche i file senza righe
+                        last_row = first_row + chunk - 1 if chunk else None
+                        for state, n in db_utils.promote_staging(name, first_row, last_row, journal=journal).items(): counts[state] += n
+                        if last_row is None or last_row >= total: break
+                        first_row = last_row + 1
+                skipped = db_utils.get_staging_skipped(name, start + 1)
+            except db_utils.DatabaseError as e:
+                events.add('errori', example=str(e))
+                error, skipped = str(e), []
+            events.add('importate', n=counts['valida'])
+            for _, cig, state in skipped: events.add(state, example=cig)
+    finally:
+        db_utils.drop_staging(name)
+    if counts['valida']: db_utils.refresh_snapshot() # Una volta sola, non per blocco
+    skipped_cigs = ["(CIG Mancante)" if state == 'cig_mancante' else str(cig) for _, cig, state in skipped]
+    if error is None and counts['gia_presente']:
+        error = f"{counts['gia_presente']} righe con CIG già presente nel database (es. '{next(cig for _, cig, state in skipped if state == 'gia_presente')}')."
+    trace_utils.count('import.righe_importate', counts['valida']); trace_utils.count('import.righe_saltate', len(skipped))
+    return {'importate': counts['valida'], 'saltate': len(skipped), 'cig_saltati': skipped_cigs, 'ultimo_errore': error,
+            'conteggi': counts if sum(counts.values()) else {}, 'ripresa_da': start}
+
+def import_dataframe(df, fingerprint=None, file_name=None) -> dict:
+    """
+    Inserisce nel DB le righe di un DataFrame pulito (via staging), saltando quelle senza CIG,
+    con CIG ripetuto nel file o già presente. Con l'impronta del file l'importazione è registrata
+    e riprendibile (vedi import_staged). Ritorna come import_staged.
+    """
+    try:
+        staged = stage_dataframe(df)
+    except db_utils.DatabaseError as e:
+        return {'importate': 0, 'saltate': 0, 'cig_saltati': [], 'ultimo_errore': str(e), 'conteggi': {}, 'ripresa_da': 0}
+    return import_staged(staged, fingerprint=fingerprint, file_name=file_name)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Esecuzione in background dei job ML (addestramento) su un pool di processi."""
+import sqlite3
+import json
+import os
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+import ml_utils
+import cache_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
+
+# --- Costanti ---
+JOBS_TABLE = "ml_jobs"
+TIPO_ADDESTRAMENTO = "addestramento"
+TIPO_RICERCA = "ricerca_modello"
+STATO_IN_CODA = "in_coda"
+STATO_IN_CORSO = "in_corso"
+STATO_ANNULLAMENTO = "annullamento_richiesto"
+STATO_COMPLETATO = "completato"
+STATO_FALLITO = "fallito"
+STATO_ANNULLATO = "annullato"
+STATI_ATTIVI = (STATO_IN_CODA, STATO_IN_CORSO, STATO_ANNULLAMENTO)
+STATI_FINALI = (STATO_COMPLETATO, STATO_FALLITO, STATO_ANNULLATO)
+
+# Future dei job sottomessi da QUESTO processo server (id job -> Future)
+_futures = {}
+
+# --- Accesso DB (connessioni brevi, usabili anche dai processi worker) ---
+@contextmanager
+def _connect(db_path):
+    """Connessione dedicata e breve: commit all'uscita, sempre chiusa."""
+    conn = sqlite3.connect(db_path, timeout=15.0)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn; conn.commit()
+    finally:
+        conn.close()
+
+def _create_jobs_table(db_path):
+    """Crea la tabella dei job se non esiste."""
+    with _connect(db_path) as conn:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tipo TEXT NOT NULL,
+                stato TEXT NOT NULL,
+                progresso REAL DEFAULT 0,
+                messaggio TEXT,
+                risultato TEXT, -- JSON con metriche e importanza feature
+                errore TEXT,
+                pid_server INTEGER, -- Processo server che ha sottomesso il job
+                creato_il TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                aggiornato_il TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+            )""")
+
+def _update_job(db_path, job_id, **fields):
+    """Aggiorna i campi di un job e ritorna lo stato corrente (dopo l'aggiornamento)."""
+    with _connect(db_path) as conn:
+        if fields:
+            set_clause = ', '.join([f"{key} = :{key}" for key in fields.keys()])
+            conn.execute(f"UPDATE {JOBS_TABLE} SET {set_clause}, aggiornato_il = CURRENT_TIMESTAMP WHERE id = :id", {**fields, 'id': job_id})
+        row = conn.execute(f"SELECT stato FROM {JOBS_TABLE} WHERE id = ?", (job_id,)).fetchone()
+    return row['stato'] if row else None
+
+def _pid_alive(pid):
+    if not pid: return False
+    try: os.kill(int(pid), 0); return True
+    except OSError: return False
+
+def _mark_orphan_jobs(db_path):
+    """Marca come falliti i job attivi il cui processo server non esiste più (es. riavvio)."""
+    with _connect(db_path) as conn:
+        rows = conn.execute(f"SELECT id, pid_server FROM {JOBS_TABLE} WHERE stato IN ({', '.join('?' * len(STATI_ATTIVI))})", STATI_ATTIVI).fetchall()
+        for row in rows:
+            if not _pid_alive(row['pid_server']):
+                conn.execute(f"UPDATE {JOBS_TABLE} SET stato = ?, errore = ?, aggiornato_il = CURRENT_TIMESTAMP WHERE id = ?",
+                             (STATO_FALLITO, "Job interrotto dal riavvio del server.", row['id']))
+                logger.warning("Job ML %s orfano marcato come fallito.", row['id'])
+
+# --- Worker (eseguito nel processo del pool) ---
+def _serialize_results(results):
+    """Rende JSON-serializzabile il dizionario ritornato da ml_utils.train_model."""
+    serializable = {k: v for k, v in results.items() if k != 'feature_importances'}
+    if 'feature_importances' in results and results['feature_importances'] is not None:
+        serializable['feature_importances'] = {str(k): float(v) for k, v in results['feature_importances'].items()}
+    return json.dumps(serializable, default=float)
+
+def _run_job(db_path, job_id, start_message, task):
+    """Esegue task(progress_callback) aggiornando progresso, stato e risultato nella tabella job."""
+    if _update_job(db_path, job_id) == STATO_ANNULLAMENTO:
+        _update_job(db_path, job_id, stato=STATO_ANNULLATO, messaggio="Annullato prima dell'avvio."); return
+
+    def progress(fraction, message):
+        stato = _update_job(db_path, job_id, progresso=float(fraction), messaggio=message)
+        if stato == STATO_ANNULLAMENTO: raise ml_utils.TrainingCancelled()
+
+    _update_job(db_path, job_id, stato=STATO_IN_CORSO, messaggio=start_message)
+    try:
+        results = task(progress)
+    except ml_utils.TrainingCancelled:
+        _update_job(db_path, job_id, stato=STATO_ANNULLATO, messaggio="Job annullato dall'utente."); return
+    except ml_utils.MLError as e: # Errore previsto (es. dati insufficienti): basta il messaggio
+        _update_job(db_path, job_id, stato=STATO_FALLITO, errore=str(e)); return
+    except Exception as e:
+        logger.exception("Job %s fallito: %s", job_id, e)
+        _update_job(db_path, job_id, stato=STATO_FALLITO, errore=f"{e}\n{traceback.format_exc()}"); return
+    _update_job(db_path, job_id, stato=STATO_COMPLETATO, progresso=1.0, messaggio="Completato.", risultato=_serialize_results(results))
+
+def _run_training_job(db_path, job_id, df, incremental=False, model_config=None):
+    """Corpo del job di addestramento (eseguito nel processo worker)."""
+    _run_job(db_path, job_id, "Avvio aggiornamento incrementale..." if incremental else "Avvio addestramento...",
+             lambda progress: ml_utils.train_model(df, progress_callback=progress, incremental=incremental, model_config=model_config))
+
+def _run_search_job(db_path, job_id, df):
+    """Corpo del job di selezione modello (cross-validation temporale in parallelo)."""
+    _run_job(db_path, job_id, "Avvio selezione modello...",
+             lambda progress: ml_utils.search_models(df, progress_callback=progress))
+
+# --- API lato server ---
+@cache_utils.cached('resource')
+def get_executor(db_path):
+    """Pool di processi condiviso da tutte le sessioni (un job alla volta, il fit usa già tutti i core)."""
+    _create_jobs_table(db_path)
+    _mark_orphan_jobs(db_path)
+    # 'spawn' evita di duplicare con fork i thread del server Streamlit
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+def _submit(db_path, tipo, fn, *args) -> int:
+    """Registra un job in coda e lo sottomette al pool; ritorna l'ID del job."""
+    executor = get_executor(db_path)
+    db_path = os.path.abspath(db_path) # Il worker non dipende dalla cwd del server
+    with _connect(db_path) as conn:
+        cursor = conn.execute(f"INSERT INTO {JOBS_TABLE} (tipo, stato, messaggio, pid_server) VALUES (?, ?, ?, ?)",
+                              (tipo, STATO_IN_CODA, "In attesa di un worker libero...", os.getpid()))
+        job_id = cursor.lastrowid
+    _futures[job_id] = executor.submit(fn, db_path, job_id, *args)
+    _futures[job_id].add_done_callback(lambda fut: _on_future_done(db_path, job_id, fut))
+    logger.info("Job '%s' %s sottomesso.", tipo, job_id)
+    return job_id
+
+def submit_training_job(db_path, df, incremental=False, model_config=None) -> int:
+    """Sottomette un addestramento (completo o incrementale) in background e ritorna l'ID del job."""
+    return _submit(db_path, TIPO_ADDESTRAMENTO, _run_training_job, df, incremental, model_config)
+
+def submit_search_job(db_path, df) -> int:
+    """Sottomette una selezione modello (CV temporale + ricerca iperparametri) in background."""
+    return _submit(db_path, TIPO_RICERCA, _run_search_job, df)
+
+def _on_future_done(db_path, job_id, future):
+    """Registra crash del worker (es. processo terminato) che il job non ha potuto salvare."""
+    _futures.pop(job_id, None)
+    if future.cancelled():
+        _update_job(db_path, job_id, stato=STATO_ANNULLATO, messaggio="Annullato prima dell'avvio."); return
+    error = future.exception()
+    if error is not None:
+        _update_job(db_path, job_id, stato=STATO_FALLITO, errore=f"Errore del worker: {error}")
+
+def cancel_job(db_path, job_id) -> bool:
+    """Richiede l'annullamento di un job: immediato se in coda, cooperativo se in corso."""
+    future = _futures.get(job_id)
+    if future is not None and future.cancel():
+        return True # _on_future_done segna il job come annullato
+    stato = _update_job(db_path, job_id)
+    if stato in STATI_ATTIVI:
+        _update_job(db_path, job_id, stato=STATO_ANNULLAMENTO, messaggio="Annullamento richiesto...")
+        return True
+    return False
+
+def get_job(db_path, job_id) -> dict | None:
+    """Ritorna il job come dizionario (risultato JSON già decodificato)."""
+    with _connect(db_path) as conn:
+        row = conn.execute(f"SELECT * FROM {JOBS_TABLE} WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_job(row)
+
+def get_latest_job(db_path, tipo=TIPO_ADDESTRAMENTO, stati=None) -> dict | None:
+    """Ritorna il job più recente del tipo indicato (opzionalmente filtrato per stato)."""
+    sql = f"SELECT * FROM {JOBS_TABLE} WHERE tipo = ?"
+    params = [tipo]
+    if stati:
+        sql += f" AND stato IN ({', '.join('?' * len(stati))})"; params.extend(stati)
+    sql += " ORDER BY id DESC LIMIT 1"
+    with _connect(db_path) as conn:
+        row = conn.execute(sql, params).fetchone()
+    return _row_to_job(row)
+
+def _row_to_job(row) -> dict | None:
+    if row is None: return None
+    job = dict(row)
+    if job.get('risultato'):
+        job['risultato'] = json.loads(job['risultato'])
+        if 'feature_importances' in job['risultato']:
+            job['risultato']['feature_importances'] = pd.Series(job['risultato']['feature_importances']).sort_values(ascending=False)
+    return job
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Log strutturato dei moduli core (logger 'analisigare.<modulo>' della libreria standard logging).
+
+Configurazione da variabili d'ambiente (lette alla prima get_logger, valgono anche nei processi worker):
+    ANALISIGARE_LOG_LEVEL   DEBUG | INFO (default) | WARNING | ERROR
+    ANALISIGARE_LOG_FORMAT  testo (default) | json  -> una riga JSON per messaggio (ts, livello, logger, messaggio, campi extra)
+
+Nei cicli per riga (importazione, preprocessing) i messaggi per elemento sono DEBUG: con il livello di
+default non vengono nemmeno formattati. Per le operazioni massive si usano aggregate() (un solo
+messaggio di riepilogo con conteggi ed esempi) e rate_limited() (al più un messaggio per intervallo).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import datetime
+from contextlib import contextmanager
+
+ROOT_LOGGER = "analisigare"
+LEVEL_ENV = "ANALISIGARE_LOG_LEVEL"
+FORMAT_ENV = "ANALISIGARE_LOG_FORMAT"
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+MAX_EXAMPLES = 5 # Esempi riportati da aggregate() per ogni chiave
+
+# Attributi standard di LogRecord: tutto il resto viene da extra={...} ed è un campo strutturato
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+_configured = False
+_config_lock = threading.Lock()
+_rate_state = {} # chiave -> (ultimo invio, messaggi soppressi)
+_rate_lock = threading.Lock()
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record: campi fissi più i campi passati con extra={...}."""
+    def format(self, record):
+        entry = {'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'livello': record.levelname, 'logger': record.name, 'messaggio': record.getMessage()}
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info: entry['eccezione'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Formato leggibile; i campi extra vengono aggiunti in coda come chiave=valore."""
+    def format(self, record):
+        text = super().format(record)
+        extra = {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+        if extra:
+            first_line, sep, rest = text.partition("\n")
+            text = first_line + " " + " ".join(f"{k}={v}" for k, v in extra.items()) + sep + rest
+        return text
+
+def configure(level=None, fmt=None, stream=None, force=False):
+    """Installa l'handler sul logger radice dell'app (idempotente salvo force=True)."""
+    global _configured
+    with _config_lock:
+        if _configured and not force: return
+        root = logging.getLogger(ROOT_LOGGER)
+        for handler in list(root.handlers): root.removeHandler(handler)
+        handler = logging.StreamHandler(stream or sys.stderr)
+        fmt = (fmt or os.environ.get(FORMAT_ENV, "testo")).lower()
+        handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+        root.addHandler(handler)
+        root.setLevel((level or os.environ.get(LEVEL_ENV, "INFO")).upper())
+        root.propagate = False # Niente doppioni se il processo ospite configura il logger radice
+        _configured = True
+
+def get_logger(name) -> logging.Logger:
+    """Logger del modulo ('db_utils' -> 'analisigare.db_utils'), configurato alla prima richiesta."""
+    if not _configured: configure()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+class _Aggregate:
+    """Conteggi per chiave (con qualche esempio) raccolti durante un'operazione massiva."""
+    def __init__(self):
+        self.counts, self.examples = {}, {}
+
+    def add(self, key, example=None, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+        if example is not None:
+            examples = self.examples.setdefault(key, [])
+            if len(examples) < MAX_EXAMPLES: examples.append(example)
+
+@contextmanager
+def aggregate(logger, message, level=logging.INFO, **fields):
+    """
+    Raccoglie eventi per chiave e all'uscita scrive UN messaggio con conteggi, esempi e durata:
+        with log_utils.aggregate(logger, "Importazione gare") as agg:
+            for ...: agg.add('duplicati', example=cig)
+    """
+    agg = _Aggregate()
+    start = time.perf_counter()
+    try:
+        yield agg
+    finally:
+        if logger.isEnabledFor(level):
+            summary = ", ".join(f"{key}: {count}" for key, count in agg.counts.items()) or "nessun evento"
+            logger.log(level, f"{message} - {summary}",
+                       extra={**fields, 'conteggi': agg.counts, 'esempi': agg.examples, 'durata_ms': round((time.perf_counter() - start) * 1000, 1)})
+
+def rate_limited(logger, key, interval, level, message, *args, **kwargs):
+    """Scrive il messaggio al più una volta ogni interval secondi per chiave, riportando quanti ne sono stati soppressi."""
+    if not logger.isEnabledFor(level): return
+    now = time.monotonic()
+    with _rate_lock:
+        last, suppressed = _rate_state.get(key, (None, 0))
+        if last is not None and now - last < interval:
+            _rate_state[key] = (last, suppressed + 1); return
+        _rate_state[key] = (now, 0)
+    if suppressed:
+        message = f"{message} (+{suppressed} messaggi simili soppressi)"
+    logger.log(level, message, *args, **kwargs)
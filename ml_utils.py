@@ -1,27 +1,90 @@
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_absolute_error, r2_score
-from sklearn.preprocessing import LabelEncoder
-import joblib
+# scikit-learn e joblib sono importati nelle funzioni che li usano: caricare ml_utils (all'avvio
+# dell'app) non deve costare l'import di sklearn/scipy finché non si addestra o si prevede.
+import copy
+import itertools
+import logging
+import json
 import os
 import numpy as np
-import streamlit as st
-import traceback
 import datetime
+import math
+
+import model_store_utils
+import feature_store_utils
+import cache_utils
+import trace_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
 
 # --- Costanti ---
-MODEL_DIR = "ml_model"
-MODEL_PATH = os.path.join(MODEL_DIR, "random_forest_soglia_model.joblib")
-COLUMNS_PATH = os.path.join(MODEL_DIR, "model_columns.joblib")
-LABEL_ENCODERS_PATH = os.path.join(MODEL_DIR, "label_encoders.joblib")
-os.makedirs(MODEL_DIR, exist_ok=True) # Crea la directory se non esiste
+MODEL_DIR = model_store_utils.MODEL_DIR # Creata al primo salvataggio (nessun effetto collaterale all'import)
+N_ESTIMATORS = 100 # Numero alberi del RandomForest
+TREE_BATCH_SIZE = 10 # Alberi addestrati per passo (permette progresso e annullamento)
+TARGET_COLUMN = 'soglia_anomalia_calcolata'
+RAW_FEATURE_COLUMNS = feature_store_utils.RAW_COLUMNS
+# Aggiornamento incrementale (warm_start): alberi aggiunti al modello attivo ad ogni aggiornamento.
+# Oltre MAX_TREES alberi si torna a un riaddestramento completo per non far crescere il modello all'infinito.
+INCREMENTAL_TREES = 20
+MAX_TREES = 300
+# Nuove gare con soglia nota (rispetto al modello attivo) che fanno partire l'aggiornamento automatico
+AUTO_RETRAIN_THRESHOLD = 20
+
+# --- Configurazioni Modello ---
+# Una configurazione è {'model': nome, 'params': {...}}; DEFAULT_MODEL_CONFIG è il modello storico.
+DEFAULT_MODEL_CONFIG = {'model': 'random_forest',
+                        'params': {'n_estimators': N_ESTIMATORS, 'max_depth': 10, 'min_samples_split': 5, 'min_samples_leaf': 3}}
+# Spazio di ricerca per la selezione del modello (griglia per tipo di modello)
+SEARCH_SPACE = {
+    'random_forest': {'n_estimators': [N_ESTIMATORS], 'max_depth': [6, 10, None], 'min_samples_leaf': [1, 3, 5]},
+    'hist_gradient_boosting': {'learning_rate': [0.05, 0.1], 'max_leaf_nodes': [15, 31], 'l2_regularization': [0.0, 1.0]},
+    # Regressione quantile sulla mediana: robusta alle soglie anomale/outlier
+    'quantile_gradient_boosting': {'learning_rate': [0.05, 0.1], 'max_leaf_nodes': [15, 31]},
+}
+CV_SPLITS = 5
+CV_CACHE_DIR = os.path.join(MODEL_DIR, "cv_cache") # Risultati per (configurazione, fold) già valutati
+CV_CACHE_BYTES_LIMIT = '200M' # Oltre questa dimensione le voci meno recenti della cache vengono rimosse
+_cv_memory = None
+# Intervalli di previsione: livello di default (alpha=0.1 -> intervallo al 90%) e metodi disponibili.
+# 'conformal': quantile dei residui assoluti su gare non viste in training (split conformal, copertura garantita).
+# 'alberi': quantili delle previsioni dei singoli alberi del RandomForest (dispersione del modello).
+INTERVAL_ALPHA = 0.1
+INTERVAL_METHODS = ('conformal', 'alberi')
+MAX_CALIBRATION_RESIDUALS = 2000 # Residui conservati nei metadati (i più recenti)
+CALIBRATION_FRACTION = 0.2 # Quota delle gare nuove tenuta fuori dagli alberi aggiunti negli aggiornamenti incrementali
+
+class TrainingCancelled(Exception):
+    """Sollevata dalla callback di progresso per interrompere l'addestramento."""
+
+class MLError(Exception):
+    """Addestramento, selezione o previsione non possibili (messaggio leggibile dall'utente)."""
+
+def _report_progress(progress_callback, fraction, message):
+    """Notifica il progresso (0-1) alla callback, se presente."""
+    if progress_callback is not None:
+        progress_callback(fraction, message)
+
+def build_estimator(config, n_jobs=-1):
+    """Istanzia il regressore sklearn descritto da una configurazione {'model', 'params'}."""
+    from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
+    params = dict(config.get('params') or {})
+    if config['model'] == 'random_forest':
+        return RandomForestRegressor(random_state=42, n_jobs=n_jobs, **params)
+    if config['model'] == 'hist_gradient_boosting':
+        return HistGradientBoostingRegressor(random_state=42, **params)
+    if config['model'] == 'quantile_gradient_boosting':
+        return HistGradientBoostingRegressor(loss='quantile', quantile=0.5, random_state=42, **params)
+    raise ValueError(f"Tipo di modello sconosciuto: {config['model']}")
 
 # --- Funzioni ---
-def preprocess_data(df, fit_encoders=False, saved_encoders=None, saved_columns=None):
+@trace_utils.traced('ml.preprocess_data')
+def preprocess_data(df, fit_encoders=False, saved_encoders=None, saved_columns=None, with_target=None, fill_values=None):
     """
     Preprocessa i dati per il modello ML.
-    Gestisce: selezione feature, conversione date, imputazione NaN, encoding categorico.
+    Le feature (anno/mese dalla data, valori numerici, categoria, stazione appaltante e aggregati
+    storici per stazione/categoria) vengono lette dal feature store (calcolate solo per gare nuove o
+    modificate); qui restano imputazione NaN ed encoding categorico, entrambi vettoriali.
 
     Args:
         df (pd.DataFrame): DataFrame di input.
@@ -29,270 +92,515 @@ def preprocess_data(df, fit_encoders=False, saved_encoders=None, saved_columns=N
                              Se False, usa encoders salvati per trasformare.
         saved_encoders (dict): Dizionario di LabelEncoder salvati (usato se fit_encoders=False).
         saved_columns (list): Lista di colonne attese dal modello (usato se fit_encoders=False).
+        with_target (bool): Se True estrae il target (scartando le righe senza) anche con encoder
+                            salvati, come serve all'aggiornamento incrementale. Default: fit_encoders.
+        fill_values (dict): Valori di imputazione per le feature numeriche salvati con il modello.
+                            Se None: mediane dei dati forniti (in training vengono calcolate qui).
 
     Returns:
         tuple: (X, y, encoders, columns)
-               X: DataFrame delle feature processate.
-               y: Series del target (o None se non presente/fit_encoders=False).
+               X: DataFrame delle feature processate (X.attrs['fill_values'] = imputazione usata).
+               y: Series del target (o None se non presente/with_target=False).
                encoders: Dizionario degli encoder (solo se fit_encoders=True).
                columns: Lista delle colonne di X (solo se fit_encoders=True).
-               Restituisce (None, None, None, None) in caso di errore grave.
+               Restituisce (None, None, None, None) se nessuna riga ha il target richiesto.
+
+    Raises:
+        MLError: in caso di errore grave durante il preprocessing.
     """
-    print(f"Inizio preprocessing ML (fit_encoders={fit_encoders})...")
-    target = 'soglia_anomalia_calcolata'
-    # Feature iniziali considerate dal modello
-    initial_features = ['importo_base', 'categoria_lavori', 'numero_concorrenti', 'data_gara']
+    target = TARGET_COLUMN
+    if with_target is None: with_target = fit_encoders
 
     try:
-        # Seleziona solo le colonne rilevanti presenti nel DataFrame
-        cols_to_keep = [f for f in initial_features if f in df.columns]
-        if target in df.columns:
-            cols_to_keep.append(target)
-        df_proc = df[list(set(cols_to_keep))].copy() # Usa set per evitare duplicati
-        print(f"Colonne iniziali selezionate: {df_proc.columns.tolist()}")
+        # Feature sull'intera tabella: anche le gare senza soglia contano negli aggregati storici.
+        # In training df è l'intera tabella gare, quindi lo store viene allineato anche alle eliminazioni.
+        features = feature_store_utils.get_features(df, prune=with_target)
 
         # Gestione Target (solo se presente e in modalità training)
-        if target in df_proc.columns and fit_encoders:
-            initial_rows = len(df_proc)
-            df_proc.dropna(subset=[target], inplace=True)
-            print(f"Rimosse {initial_rows - len(df_proc)} righe per target NaN.")
-            if df_proc.empty:
-                print("Nessun dato valido rimasto dopo rimozione target NaN."); return None, None, None, None
-            y = df_proc[target]
+        if target in df.columns and with_target:
+            labelled = df[target].notna()
+            if not labelled.any():
+                logger.warning("Nessun dato valido rimasto dopo rimozione target NaN."); return None, None, None, None
+            y = df.loc[labelled, target].astype(float)
+            features = features[labelled]
         else:
             y = None # Non c'è target o non siamo in training
 
-        # Feature Engineering: Data -> Anno/Mese
-        if 'data_gara' in df_proc.columns:
-            df_proc['data_gara'] = pd.to_datetime(df_proc['data_gara'], errors='coerce')
-            # Crea features solo se ci sono date valide
-            if df_proc['data_gara'].notna().any():
-                df_proc['anno_gara'] = df_proc['data_gara'].dt.year
-                df_proc['mese_gara'] = df_proc['data_gara'].dt.month
-                print("Create features 'anno_gara' e 'mese_gara'.")
-            # Rimuovi colonna data originale dopo aver estratto le features
-            df_proc.drop('data_gara', axis=1, inplace=True, errors='ignore')
-
-        # Imputazione NaN per Feature Numeriche
-        numeric_features = list(df_proc.select_dtypes(include=np.number).columns)
-        if target in numeric_features: # Non imputare il target
-            numeric_features.remove(target)
-        for col in numeric_features:
-            if df_proc[col].isnull().any():
-                # Usa mediana per robustezza agli outlier, fallback a 0 se mediana è NaN
-                median_val = df_proc[col].median()
-                fill_value = median_val if pd.notna(median_val) else 0
-                df_proc[col].fillna(fill_value, inplace=True)
-                print(f"Imputati NaN in '{col}' numerica con {fill_value}.")
-
-        # Encoding Feature Categoriche e Imputazione NaN
-        categorical_features = list(df_proc.select_dtypes(include=['object', 'category']).columns)
-        encoders = {}
-        if saved_encoders: # Carica encoder se forniti (modalità predizione)
-            encoders = saved_encoders
-
-        for col in categorical_features:
-            # Imputa NaN con una categoria specifica 'Sconosciuto'
-            if df_proc[col].isnull().any():
-                df_proc[col].fillna('Sconosciuto', inplace=True)
-                print(f"Imputati NaN in '{col}' categorica con 'Sconosciuto'.")
-            # Assicura tipo stringa per LabelEncoder
-            df_proc[col] = df_proc[col].astype(str)
-
-            if fit_encoders: # Modalità Training: Adatta e salva encoder
-                le = LabelEncoder()
-                df_proc[col] = le.fit_transform(df_proc[col])
-                encoders[col] = le # Salva l'encoder addestrato
-                print(f"Label Encoding (fit) applicato a '{col}'. Classi: {le.classes_[:5]}...") # Mostra alcune classi
-            else: # Modalità Predizione: Usa encoder salvato
-                if col in encoders:
-                    le = encoders[col]
-                    # Trasforma usando l'encoder salvato. Gestisci classi non viste in training.
-                    df_proc[col] = df_proc[col].apply(lambda x: le.transform([x])[0] if x in le.classes_ else -1) # Assegna -1 a classi sconosciute
-                    print(f"Label Encoding (transform) applicato a '{col}'.")
-                else:
-                    # Se manca un encoder per una colonna attesa, non possiamo usarla
-                    print(f"Attenzione: Encoder per '{col}' non trovato durante la trasformazione. Colonna rimossa.")
-                    df_proc.drop(col, axis=1, inplace=True, errors='ignore')
-
-        # Seleziona le feature finali (tutte le colonne tranne il target)
-        final_features_processed = [col for col in df_proc.columns if col != target]
-        X = df_proc[final_features_processed]
-        print(f"Features finali nel DataFrame processato: {X.columns.tolist()}")
-
-        # Allineamento Colonne (solo in modalità Predizione)
-        if not fit_encoders and saved_columns:
-            print(f"Colonne attese dal modello salvato: {saved_columns}")
-            missing_cols = set(saved_columns) - set(X.columns)
-            for c in missing_cols:
-                print(f"Aggiunta colonna mancante '{c}' con valore 0.")
-                X[c] = 0 # Aggiungi colonne mancanti con 0 (o altra logica se necessario)
-            # Riordina e seleziona colonne per matchare quelle del training
-            extra_cols = set(X.columns) - set(saved_columns)
-            if extra_cols:
-                print(f"Rimozione colonne extra non presenti nel training: {list(extra_cols)}")
-                X.drop(columns=list(extra_cols), inplace=True, errors='ignore')
-
-            try:
-                 X = X[saved_columns] # Assicura ordine corretto
-                 print(f"Colonne allineate all'ordine del modello: {X.columns.tolist()}")
-            except KeyError as e:
-                 print(f"Errore critico durante l'allineamento delle colonne: {e}. Colonne disponibili: {X.columns.tolist()}")
-                 st.error(f"Errore nell'allineamento delle colonne del modello: {e}. Verifica i dati di input.")
-                 return None, None, None, None
-
-        print("Preprocessing ML completato con successo.")
+        # Imputazione NaN per Feature Numeriche (mediana, fallback a 0)
+        if fill_values is None:
+            medians = features[feature_store_utils.NUMERIC_FEATURES].median()
+            fill_values = {col: float(medians[col]) if pd.notna(medians[col]) else 0.0 for col in feature_store_utils.NUMERIC_FEATURES}
+        X = features[feature_store_utils.NUMERIC_FEATURES].fillna(fill_values)
+
+        # Encoding Feature Categoriche ('Sconosciuto' per i NaN, -1 per classi non viste in training)
+        encoders = {} if fit_encoders else dict(saved_encoders or {})
+        for col in feature_store_utils.CATEGORICAL_FEATURES:
+            values = features[col].fillna('Sconosciuto').astype(str).to_numpy()
+            if fit_encoders:
+                from sklearn.preprocessing import LabelEncoder
+                encoders[col] = LabelEncoder().fit(values)
+            if col in encoders:
+                X[col] = pd.Index(encoders[col].classes_).get_indexer(values)
+            else:
+                log_utils.rate_limited(logger, f"encoder_mancante:{col}", 60, logging.WARNING,
+                                       "Encoder per '%s' non trovato durante la trasformazione. Colonna rimossa.", col)
+
+        # Allineamento Colonne all'ordine del modello (colonne mancanti a 0)
+        columns = list(saved_columns) if not fit_encoders and saved_columns else [c for c in feature_store_utils.FEATURE_COLUMNS if c in X.columns]
+        missing_cols = [c for c in columns if c not in X.columns]
+        if missing_cols: logger.debug("Aggiunte colonne mancanti con valore 0: %s", missing_cols)
+        X = X.reindex(columns=columns, fill_value=0)
+        X.attrs['fill_values'] = fill_values
+
+        # DEBUG: eseguito ad ogni previsione, anche per una sola gara
+        logger.debug("Preprocessing ML completato: %d righe, feature %s (fit_encoders=%s).", len(X), columns, fit_encoders)
         # Restituisci X, y (se applicabile), encoders (se fit), colonne finali (se fit)
-        return X, y, (encoders if fit_encoders else None), (X.columns.tolist() if fit_encoders else None)
+        return X, y, (encoders if fit_encoders else None), (columns if fit_encoders else None)
 
     except Exception as e:
-        print(f"Errore grave durante preprocess_data: {e}")
-        st.error(f"Errore durante il preprocessing dei dati ML: {e}")
-        traceback.print_exc();
-        return None, None, None, None
-
-def train_model(df):
+        logger.exception("Errore grave durante preprocess_data: %s", e)
+        raise MLError(f"Errore durante il preprocessing dei dati ML: {e}") from e
+
+def _fit_trees(model, X_train, y_train, n_trees_target, progress_callback, progress_start=0.1, progress_span=0.8):
+    """Aggiunge alberi al RandomForest (warm_start) a blocchi fino a n_trees_target, riportando il progresso."""
+    n_initial = len(getattr(model, 'estimators_', []))
+    model.set_params(warm_start=True, n_estimators=min(n_initial + TREE_BATCH_SIZE, n_trees_target))
+    while True:
+        model.fit(X_train, y_train)
+        n_fitted = len(model.estimators_)
+        done = (n_fitted - n_initial) / max(n_trees_target - n_initial, 1)
+        _report_progress(progress_callback, progress_start + progress_span * done, f"Addestrati {n_fitted}/{n_trees_target} alberi...")
+        if n_fitted >= n_trees_target: break
+        model.set_params(n_estimators=min(n_fitted + TREE_BATCH_SIZE, n_trees_target))
+    model.set_params(warm_start=False)
+    return model
+
+def _calibration_residuals(residuals):
+    """Residui assoluti fuori campione da salvare nei metadati (gli ultimi MAX_CALIBRATION_RESIDUALS)."""
+    return [round(float(r), 6) for r in list(residuals)[-MAX_CALIBRATION_RESIDUALS:]]
+
+def _finalize_training(model, df, X, y, trained_columns, encoders, mae, r2, extra_metadata, progress_callback):
+    """Calcola importanza feature, salva la versione e ritorna il dizionario risultati."""
+    # *** Estrai e restituisci feature importances ***
+    # I modelli a gradient boosting non espongono feature_importances_: serie vuota
+    feature_importances = pd.Series(getattr(model, 'feature_importances_', []), index=trained_columns if hasattr(model, 'feature_importances_') else None, dtype=float).sort_values(ascending=False)
+
+    # Salvataggio modello, colonne e encoder in un'unica versione dell'archivio
+    _report_progress(progress_callback, 0.95, "Salvataggio modello...")
+    metadata = {
+        "model_type": type(model).__name__,
+        "params": {k: v for k, v in model.get_params().items() if isinstance(v, (int, float, str, bool, type(None)))},
+        "metrics": {"mae": float(mae), "r2": float(r2)},
+        "n_samples": len(X),
+        "n_labelled": len(y), # Gare con soglia nota usate (per la politica di riaddestramento)
+        "max_gara_id": int(df.loc[X.index, 'id'].max()) if 'id' in df.columns else None,
+        "data_fingerprint": model_store_utils.data_fingerprint(pd.concat([X, y], axis=1)),
+        "feature_importances": {k: float(v) for k, v in feature_importances.items()},
+        "feature_version": feature_store_utils.FEATURE_VERSION,
+        "fill_values": X.attrs.get('fill_values'), # Imputazione dei NaN da riusare in previsione
+        # Classi degli encoder in chiaro: l'interfaccia le mostra senza caricare il modello
+        "encoder_classes": {col: [str(c) for c in le.classes_] for col, le in (encoders or {}).items()},
+        **extra_metadata,
+    }
+    version_id = model_store_utils.save_model(model, trained_columns, encoders, metadata)
+    _report_progress(progress_callback, 1.0, "Addestramento completato.")
+
+    return {
+        "mae": mae,
+        "r2": r2,
+        "n_samples": len(X), # Numero campioni usati DOPO preprocessing
+        "feature_importances": feature_importances, # Serie pandas con importanza feature
+        "version_id": version_id,
+        "training_mode": metadata.get("training_mode"),
+        }
+
+def _train_incremental(df, base_model, columns, encoders, base_metadata, progress_callback):
+    """Aggiunge INCREMENTAL_TREES alberi al modello attivo usando i dati correnti (warm_start)."""
+    from sklearn.metrics import mean_absolute_error, r2_score
+    _report_progress(progress_callback, 0.0, "Preprocessing incrementale (feature store)...")
+    # Encoder e imputazione del modello attivo: le feature restano coerenti con i suoi alberi
+    X, y, _, _ = preprocess_data(df, fit_encoders=False, saved_encoders=encoders, saved_columns=columns,
+                                 with_target=True, fill_values=base_metadata.get('fill_values'))
+    if X is None or X.empty:
+        raise MLError("Aggiornamento incrementale fallito: nessuna gara con soglia nota.")
+
+    # Valutazione prequenziale: il modello PRECEDENTE predice le gare arrivate dopo il suo addestramento
+    # (mai viste dai suoi alberi), prima di essere aggiornato con esse.
+    ids = df.loc[X.index, 'id']
+    new_mask = (ids > base_metadata['max_gara_id']).to_numpy()
+    if new_mask.sum() < 2:
+        raise MLError("Aggiornamento incrementale non valutabile: servono almeno 2 gare nuove con soglia nota utilizzabili.")
+    y_pred_new = base_model.predict(X[new_mask])
+    mae = mean_absolute_error(y[new_mask], y_pred_new)
+    r2 = r2_score(y[new_mask], y_pred_new)
+    logger.info("Valutazione prequenziale su %d nuove gare - MAE: %.4f%%, R2: %.4f", int(new_mask.sum()), mae, r2)
+
+    # Gare di calibrazione: quelle del modello di partenza più una quota delle nuove, escluse dagli alberi
+    # aggiunti; i residui si ricalcolano con il modello aggiornato, quindi restano fuori campione
+    new_ids = ids[new_mask]
+    calibration_ids = set(base_metadata['calibration_ids']) | set(
+        new_ids.sample(n=max(1, round(len(new_ids) * CALIBRATION_FRACTION)), random_state=42).astype(int))
+    calibration_mask = ids.isin(calibration_ids).to_numpy()
+
+    model = copy.deepcopy(base_model) # Non modificare il modello in cache (eventualmente memory-mapped)
+    model.set_params(n_jobs=-1)
+    n_trees_target = len(model.estimators_) + INCREMENTAL_TREES
+    _report_progress(progress_callback, 0.1, f"Aggiunta di {INCREMENTAL_TREES} alberi al modello {base_metadata['version_id']}...")
+    _fit_trees(model, X[~calibration_mask], y[~calibration_mask], n_trees_target, progress_callback)
+    residuals = pd.Series(np.abs(y[calibration_mask].to_numpy() - model.predict(X[calibration_mask])),
+                          index=ids[calibration_mask].to_numpy()).sort_index() # In ordine di ID: le più recenti in coda
+    return _finalize_training(model, df, X, y, list(columns), encoders, mae, r2,
+                              {"training_mode": "incrementale", "base_version": base_metadata['version_id'],
+                               "model_config": base_metadata.get('model_config', DEFAULT_MODEL_CONFIG),
+                               "evaluation": "prequenziale",
+                               "calibration_ids": sorted(int(i) for i in ids[calibration_mask]),
+                               "calibration_residuals": _calibration_residuals(residuals.to_numpy())},
+                              progress_callback)
+
+@trace_utils.traced('ml.train_model')
+def train_model(df, progress_callback=None, incremental=False, model_config=None):
     """
     Addestra un modello RandomForestRegressor sui dati forniti.
     Salva il modello, le colonne e gli encoder.
 
     Args:
         df (pd.DataFrame): DataFrame contenente i dati storici.
+        progress_callback (callable): Opzionale, chiamata come callback(frazione, messaggio)
+                                      ad ogni fase. Può sollevare TrainingCancelled per
+                                      interrompere l'addestramento tra un blocco di alberi e l'altro.
+        incremental (bool): Se True aggiunge alberi al modello attivo (warm_start) invece di
+                            ricostruirlo; ripiega sul riaddestramento completo se non possibile.
+        model_config (dict): Configurazione {'model', 'params'} (es. la migliore di search_models).
+                             Default: configurazione del modello attivo in caso di ripiego, altrimenti
+                             DEFAULT_MODEL_CONFIG.
 
     Returns:
         dict: Dizionario con metriche ('mae', 'r2'), numero campioni ('n_samples'),
               e importanza feature ('feature_importances') se l'addestramento ha successo.
-              None altrimenti.
+
+    Raises:
+        MLError: dati insufficienti o errore durante addestramento/salvataggio.
+        TrainingCancelled: se sollevata dalla progress_callback.
     """
     if df.empty:
-        st.error("Impossibile addestrare: DataFrame di input vuoto."); return None
-
-    print("Avvio processo di addestramento modello...")
-    with st.spinner("Preprocessing dati per addestramento..."):
-        X, y, encoders, trained_columns = preprocess_data(df, fit_encoders=True)
+        raise MLError("Impossibile addestrare: DataFrame di input vuoto.")
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import mean_absolute_error, r2_score
+
+    if incremental:
+        base_model, base_columns, base_encoders, base_metadata = model_store_utils.load_model()
+        if base_metadata and model_config is None: model_config = base_metadata.get('model_config')
+        if not isinstance(base_model, RandomForestRegressor):
+            logger.info("Aggiornamento incrementale non possibile (nessun RandomForest attivo): addestramento completo.")
+        elif base_metadata.get('feature_version', 1) != feature_store_utils.FEATURE_VERSION:
+            logger.info("Il modello attivo usa una versione precedente delle feature: addestramento completo.")
+        elif len(base_model.estimators_) + INCREMENTAL_TREES > MAX_TREES:
+            logger.info("Il modello attivo ha già %d alberi: addestramento completo.", len(base_model.estimators_))
+        elif not base_metadata.get('calibration_ids'):
+            logger.info("Il modello attivo non registra le gare di calibrazione: addestramento completo.")
+        elif count_new_labelled(df, base_metadata) == 0 and base_metadata.get('max_gara_id') is not None:
+            raise MLError("Nessuna nuova gara con soglia nota dall'ultimo addestramento: il modello attivo è già aggiornato.")
+        elif 'id' not in df.columns or base_metadata.get('max_gara_id') is None or _count_new_ids(df, base_metadata) < 2:
+            # Senza almeno due gare nuove con soglia la valutazione prequenziale non è possibile: niente versioni senza metriche
+            logger.info("Gare nuove con soglia insufficienti per valutare l'aggiornamento incrementale: addestramento completo.")
+        else:
+            logger.info("Avvio aggiornamento incrementale del modello...")
+            try:
+                return _train_incremental(df, base_model, base_columns, base_encoders, base_metadata, progress_callback)
+            except TrainingCancelled:
+                logger.info("Addestramento annullato su richiesta.")
+                raise
+            except MLError:
+                raise
+            except Exception as e:
+                logger.exception("Errore durante l'aggiornamento incrementale: %s", e)
+                raise MLError(f"Errore critico durante l'aggiornamento incrementale del modello: {e}") from e
+
+    logger.info("Avvio processo di addestramento modello...")
+    _report_progress(progress_callback, 0.0, "Preprocessing dati per addestramento...")
+    X, y, encoders, trained_columns = preprocess_data(df, fit_encoders=True)
 
     if X is None or y is None or X.empty or y.empty:
-        st.error("Addestramento fallito: Dati insufficienti o errore durante il preprocessing."); return None
+        raise MLError("Addestramento fallito: Dati insufficienti (nessuna gara con soglia nota).")
     if not trained_columns:
-        st.error("Addestramento fallito: Nessuna feature valida identificata dopo il preprocessing."); return None
+        raise MLError("Addestramento fallito: Nessuna feature valida identificata dopo il preprocessing.")
     if not encoders:
-         print("Attenzione: Nessun encoder categorico addestrato (potrebbe essere normale se non ci sono feature categoriche).")
-
-    print(f"Dati pronti per l'addestramento. Numero campioni: {len(X)}, Numero feature: {len(trained_columns)}")
-    with st.spinner("Addestramento modello RandomForest..."):
-        try:
-            # Suddivisione dati in set di training e test
-            X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-            print(f"Dimensioni set - Training: {X_train.shape}, Test: {X_test.shape}")
-
-            # Inizializzazione e addestramento modello
-            # Parametri possono essere ottimizzati (es. con GridSearchCV)
-            rf_model = RandomForestRegressor(n_estimators=100, # Numero alberi
-                                             random_state=42,
-                                             n_jobs=-1, # Usa tutti i core CPU
-                                             max_depth=10, # Limita profondità alberi per evitare overfitting
-                                             min_samples_split=5, # Min campioni per splittare nodo
-                                             min_samples_leaf=3) # Min campioni in nodo foglia
-
-            rf_model.fit(X_train, y_train)
-
-            # Valutazione sul Test Set
-            y_pred = rf_model.predict(X_test)
-            mae = mean_absolute_error(y_test, y_pred)
-            r2 = r2_score(y_test, y_pred)
-            print(f"Valutazione Modello su Test Set - MAE: {mae:.4f}%, R2: {r2:.4f}")
-
-            # Salvataggio modello, colonne e encoder
-            joblib.dump(rf_model, MODEL_PATH)
-            joblib.dump(trained_columns, COLUMNS_PATH)
-            joblib.dump(encoders, LABEL_ENCODERS_PATH)
-            print(f"Modello, colonne e encoder salvati con successo nella directory: {MODEL_DIR}")
-
-            # *** Estrai e restituisci feature importances ***
-            feature_importances = pd.Series(rf_model.feature_importances_, index=trained_columns).sort_values(ascending=False)
-            print("Importanza delle feature calcolata.")
-
-            return {
-                "mae": mae,
-                "r2": r2,
-                "n_samples": len(X), # Numero campioni usati DOPO preprocessing
-                "feature_importances": feature_importances # Serie pandas con importanza feature
-                }
-        except Exception as e:
-            st.error(f"Errore critico durante l'addestramento o salvataggio del modello: {e}")
-            print(traceback.format_exc());
-            return None
+         logger.warning("Nessun encoder categorico addestrato (potrebbe essere normale se non ci sono feature categoriche).")
+
+    logger.info("Dati pronti per l'addestramento. Numero campioni: %d, Numero feature: %d", len(X), len(trained_columns))
+    model_config = model_config or DEFAULT_MODEL_CONFIG
+    _report_progress(progress_callback, 0.1, f"Addestramento modello {model_config['model']}...")
+    try:
+        # Suddivisione dati in set di training e test
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        logger.debug("Dimensioni set - Training: %s, Test: %s", X_train.shape, X_test.shape)
+
+        # Inizializzazione e addestramento modello (parametri scelti con search_models)
+        model = build_estimator(model_config, n_jobs=-1) # Usa tutti i core CPU
+        if isinstance(model, RandomForestRegressor):
+            # warm_start: gli alberi vengono aggiunti a blocchi per riportare il progresso
+            # e controllare l'annullamento; il risultato finale è identico a un fit unico.
+            _fit_trees(model, X_train, y_train, model.n_estimators, progress_callback)
+        else:
+            model.fit(X_train, y_train)
+
+        # Valutazione sul Test Set
+        y_pred = model.predict(X_test)
+        mae = mean_absolute_error(y_test, y_pred)
+        r2 = r2_score(y_test, y_pred)
+        logger.info("Valutazione modello su test set - MAE: %.4f%%, R2: %.4f", mae, r2, extra={'mae': float(mae), 'r2': float(r2), 'campioni': len(X)})
+
+        return _finalize_training(model, df, X, y, trained_columns, encoders, mae, r2,
+                                  {"training_mode": "completo", "evaluation": "holdout 20%", "model_config": model_config,
+                                   "calibration_ids": sorted(int(i) for i in df.loc[X_test.index, 'id']) if 'id' in df.columns else None,
+                                   "calibration_residuals": _calibration_residuals(np.abs(y_test.to_numpy() - y_pred))},
+                                  progress_callback)
+    except TrainingCancelled:
+        logger.info("Addestramento annullato su richiesta.")
+        raise
+    except Exception as e:
+        logger.exception("Errore durante l'addestramento: %s", e)
+        raise MLError(f"Errore critico durante l'addestramento o salvataggio del modello: {e}") from e
+
+def _count_new_ids(df, metadata) -> int:
+    """Gare con soglia nota e ID successivo all'ultimo visto dal modello (quelle della valutazione prequenziale)."""
+    return int((df[TARGET_COLUMN].notna() & (df['id'] > metadata['max_gara_id'])).sum()) if TARGET_COLUMN in df.columns else 0
+
+def count_new_labelled(df, metadata) -> int:
+    """Gare con soglia nota non ancora viste dal modello descritto da metadata (nuovi ID o soglie aggiunte)."""
+    if metadata is None or TARGET_COLUMN not in df.columns or 'id' not in df.columns: return 0
+    labelled = df[TARGET_COLUMN].notna()
+    max_id = metadata.get('max_gara_id')
+    if max_id is None: return 0 # Modello senza informazioni sui dati di training (es. formato precedente)
+    new_ids = int((labelled & (df['id'] > max_id)).sum())
+    # Gare già presenti a cui è stata aggiunta una soglia dopo l'addestramento
+    labelled_old = int((labelled & (df['id'] <= max_id)).sum())
+    return new_ids + max(0, labelled_old - int(metadata.get('n_labelled') or 0))
+
+# --- Selezione Modello (CV temporale + ricerca iperparametri) ---
+def candidate_configs(search_space=None) -> list:
+    """Espande lo spazio di ricerca in una lista di configurazioni {'model', 'params'}."""
+    search_space = search_space or SEARCH_SPACE
+    # Stesso ordine di sklearn.model_selection.ParameterGrid (chiavi ordinate), senza importare sklearn
+    return [{'model': name, 'params': dict(zip(sorted(grid), values))}
+            for name, grid in search_space.items() for values in itertools.product(*(grid[key] for key in sorted(grid)))]
+
+def _evaluate_fold(config, X_train, y_train, X_test, y_test):
+    """Addestra una configurazione su un fold e ritorna le metriche (funzione cachata su disco)."""
+    from sklearn.metrics import mean_absolute_error, r2_score
+    model = build_estimator(config, n_jobs=1) # Il parallelismo è tra fold/configurazioni
+    model.fit(X_train, y_train)
+    y_pred = model.predict(X_test)
+    return {'mae': float(mean_absolute_error(y_test, y_pred)), 'r2': float(r2_score(y_test, y_pred))}
+
+def _cached_evaluate_fold():
+    """_evaluate_fold memoizzata con joblib.Memory: chiave = configurazione + contenuto del fold."""
+    global _cv_memory
+    if _cv_memory is None:
+        import joblib
+        _cv_memory = joblib.Memory(CV_CACHE_DIR, verbose=0)
+    return _cv_memory.cache(_evaluate_fold)
+
+@trace_utils.traced('ml.search_models')
+def search_models(df, candidates=None, n_splits=CV_SPLITS, n_jobs=-1, progress_callback=None):
+    """
+    Selezione del modello con cross-validation temporale: ogni fold addestra sulle gare passate
+    e valuta sulle successive (ordinate per data_gara). Le coppie (configurazione, fold) sono
+    valutate in parallelo con joblib su tutti i core; quelle già calcolate sugli stessi dati
+    vengono lette dalla cache su disco, quindi una ricerca ripetuta valuta solo le configurazioni nuove.
 
+    Args:
+        df (pd.DataFrame): Dati storici (come per train_model).
+        candidates (list): Configurazioni da valutare (default: candidate_configs()).
+        n_splits (int): Numero di fold temporali.
+        n_jobs (int): Processi joblib (-1 = tutti i core).
+        progress_callback (callable): Come in train_model (può sollevare TrainingCancelled).
+
+    Returns:
+        dict: 'results' (lista per configurazione, ordinata per MAE medio), 'best' (configurazione migliore),
+              'n_evaluated'/'n_cached' (fold calcolati / letti dalla cache).
+              Solleva MLError se i dati non bastano.
+    """
+    from sklearn.model_selection import TimeSeriesSplit
+    from joblib import Parallel, delayed
+    candidates = candidates or candidate_configs()
+    _report_progress(progress_callback, 0.0, "Preprocessing dati per la selezione del modello...")
+    X, y, _, _ = preprocess_data(df, fit_encoders=True)
+    if X is None or y is None or 'data_gara' not in df.columns:
+        raise MLError("Selezione modello fallita: dati insufficienti (nessuna gara con soglia nota o data_gara mancante).")
+
+    # Ordine temporale: le righe senza data non possono essere collocate e restano fuori dalla CV
+    dates = pd.to_datetime(df.loc[X.index, 'data_gara'], errors='coerce')
+    order = dates[dates.notna()].sort_values(kind='stable').index
+    X_sorted, y_sorted = X.loc[order].to_numpy(dtype=float), y.loc[order].to_numpy(dtype=float)
+    if len(X_sorted) < (n_splits + 1) * 5:
+        raise MLError(f"Selezione modello: servono almeno {(n_splits + 1) * 5} gare datate con soglia nota (trovate {len(X_sorted)}).")
+
+    folds = list(TimeSeriesSplit(n_splits=n_splits).split(X_sorted))
+    tasks = [(ci, fi, config, X_sorted[tr], y_sorted[tr], X_sorted[te], y_sorted[te])
+             for ci, config in enumerate(candidates) for fi, (tr, te) in enumerate(folds)]
+    evaluate = _cached_evaluate_fold()
+    n_cached = sum(evaluate.check_call_in_cache(*task[2:]) for task in tasks)
+    logger.info("Selezione modello: %d configurazioni x %d fold, %d valutazioni già in cache.", len(candidates), len(folds), n_cached)
+
+    scores = {}
+    results_iter = Parallel(n_jobs=n_jobs, return_as='generator')(delayed(evaluate)(*task[2:]) for task in tasks)
+    for done, (task, score) in enumerate(zip(tasks, results_iter), start=1):
+        scores.setdefault(task[0], []).append(score)
+        _report_progress(progress_callback, 0.05 + 0.9 * done / len(tasks), f"Valutati {done}/{len(tasks)} fold...")
+
+    results = []
+    for ci, config in enumerate(candidates):
+        maes = np.array([s['mae'] for s in scores[ci]]); r2s = np.array([s['r2'] for s in scores[ci]])
+        results.append({'model': config['model'], 'params': json.dumps(config['params'], sort_keys=True, default=str),
+                        'mae_mean': float(maes.mean()), 'mae_std': float(maes.std()), 'r2_mean': float(r2s.mean()),
+                        'n_folds': len(maes), 'config': config})
+    results.sort(key=lambda r: r['mae_mean'])
+    _cv_memory.reduce_size(bytes_limit=CV_CACHE_BYTES_LIMIT)
+    logger.info("Miglior configurazione: %s %s (MAE medio %.4f%%)", results[0]['model'], results[0]['params'], results[0]['mae_mean'])
+    _report_progress(progress_callback, 1.0, "Selezione modello completata.")
+    return {'results': results, 'best': results[0]['config'], 'n_splits': len(folds),
+            'n_evaluated': len(tasks) - n_cached, 'n_cached': n_cached, 'n_samples': len(X_sorted)}
+
+@trace_utils.traced('ml.load_model')
 def load_model_and_dependencies():
-    """Carica il modello, la lista delle colonne e gli encoder salvati."""
-    if not all(os.path.exists(p) for p in [MODEL_PATH, COLUMNS_PATH, LABEL_ENCODERS_PATH]):
-        print("File del modello o delle dipendenze non trovati.")
-        # Non mostrare errore qui, verrà gestito nel chiamante (es. predict_soglia)
-        return None, None, None
+    """Carica il modello, la lista delle colonne e gli encoder della versione attiva (MLError se illeggibile)."""
     try:
-        model = joblib.load(MODEL_PATH)
-        columns = joblib.load(COLUMNS_PATH)
-        encoders = joblib.load(LABEL_ENCODERS_PATH)
-        print("Modello, colonne e encoder caricati da disco.")
+        model, columns, encoders, _ = model_store_utils.load_model()
+        if model is None:
+            logger.info("Nessun modello attivo nell'archivio.")
+            # Non mostrare errore qui, verrà gestito nel chiamante (es. predict_soglia)
+            return None, None, None
         return model, columns, encoders
     except Exception as e:
-        print(f"Errore durante il caricamento del modello o delle dipendenze: {e}")
-        st.error(f"Errore nel caricamento del modello ML salvato: {e}")
-        traceback.print_exc();
-        return None, None, None
+        logger.exception("Errore durante il caricamento del modello o delle dipendenze: %s", e)
+        raise MLError(f"Errore nel caricamento del modello ML salvato: {e}") from e
 
-def predict_soglia(input_data_dict):
+def conformal_quantile(residuals, alpha=INTERVAL_ALPHA):
     """
-    Esegue una previsione della soglia usando il modello salvato.
+    Semi-ampiezza dell'intervallo split-conformal: quantile ceil((n+1)(1-alpha))/n dei residui
+    assoluti di calibrazione. Ritorna inf se i residui sono troppo pochi per il livello richiesto.
+    """
+    residuals = np.sort(np.asarray(residuals, dtype=float))
+    k = math.ceil((len(residuals) + 1) * (1 - alpha))
+    return float(residuals[k - 1]) if 0 < k <= len(residuals) else float('inf')
+
+@cache_utils.cached('resource', max_entries=3)
+def _leaf_values(version_id):
+    """
+    Valori delle foglie di tutti gli alberi della versione in un'unica matrice (n_alberi x max_nodi),
+    riempita con NaN oltre i nodi di ciascun albero. Calcolata una volta per versione (immutabile).
+    """
+    model, _, _, _ = model_store_utils.load_model(version_id)
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    values = np.full((len(trees), max(tree.node_count for tree in trees)), np.nan)
+    for i, tree in enumerate(trees):
+        values[i, :tree.node_count] = tree.value[:, 0, 0]
+    return values
+
+def tree_predictions(model, X, leaf_values):
+    """
+    Previsioni di ogni albero per ogni riga (n_righe x n_alberi) senza ciclare sugli alberi in Python:
+    model.apply trova le foglie di tutti gli alberi in una chiamata, poi un indicizzazione vettoriale
+    legge i valori dalla matrice di _leaf_values. La media per riga coincide con model.predict.
+    """
+    leaves = model.apply(X)
+    return leaf_values[np.arange(leaves.shape[1]), leaves]
+
+@trace_utils.traced('ml.predict_soglia_batch')
+def predict_soglia_batch(df, alpha=INTERVAL_ALPHA, method='conformal'):
+    """
+    Previsione della soglia con intervallo per più gare in un'unica passata sul modello attivo.
 
     Args:
-        input_data_dict (dict): Dizionario contenente i valori delle feature
-                                per la gara di cui prevedere la soglia.
-                                Es: {'importo_base': ..., 'data_gara': 'YYYY-MM-DD', ...}
+        df (pd.DataFrame): Gare da prevedere (colonne come in RAW_FEATURE_COLUMNS).
+        alpha (float): 1 - livello di copertura dell'intervallo (0.1 -> intervallo al 90%).
+        method (str): 'conformal' (residui di calibrazione salvati in addestramento) o 'alberi'
+                      (quantili alpha/2 e 1-alpha/2 delle previsioni dei singoli alberi).
+                      Se il metodo non è disponibile per il modello attivo si usa l'altro.
 
     Returns:
-        float: Valore previsto della soglia (in percentuale).
-               None se la previsione fallisce o il modello non è pronto.
+        pd.DataFrame: Stesso indice di df, colonne 'soglia_prevista', 'soglia_min', 'soglia_max'
+                      (bordi NaN se nessun metodo è applicabile) e attributo attrs['method'] con il
+                      metodo usato.
+
+    Raises:
+        MLError: modello non addestrato, dati non validi o errore durante la previsione.
     """
-    print(f"Avvio previsione soglia ML per input: {input_data_dict}")
-    # Carica modello e dipendenze necessarie
-    model, saved_columns, saved_encoders = load_model_and_dependencies()
+    logger.debug("Avvio previsione soglia ML (%s, alpha=%s) per %d gare.", method, alpha, len(df))
+    model, saved_columns, saved_encoders, metadata = model_store_utils.load_model()
 
     if model is None or saved_columns is None or saved_encoders is None:
-        st.error("Impossibile eseguire la previsione: Modello ML non caricato o incompleto.")
-        return None
-
-    # Converti il dizionario di input in DataFrame (con una sola riga)
-    input_df = pd.DataFrame([input_data_dict])
+        raise MLError("Impossibile eseguire la previsione: Modello ML non caricato o incompleto.")
 
     # Preprocessa i dati di input usando gli encoder e le colonne salvate
     # Utilizza fit_encoders=False per applicare le trasformazioni salvate
-    with st.spinner("Preprocessing dati per previsione..."):
-        X_pred, _, _, _ = preprocess_data(input_df,
-                                          fit_encoders=False,
-                                          saved_encoders=saved_encoders,
-                                          saved_columns=saved_columns)
+    X_pred, _, _, _ = preprocess_data(df,
+                                      fit_encoders=False,
+                                      saved_encoders=saved_encoders,
+                                      saved_columns=saved_columns,
+                                      fill_values=metadata.get('fill_values'))
 
     if X_pred is None or X_pred.empty:
-        st.error("Previsione fallita: Errore durante il preprocessing dei dati di input.")
-        return None
+        raise MLError("Previsione fallita: nessuna gara valida nei dati di input.")
+
+    from sklearn.ensemble import RandomForestRegressor # Già caricato dal modello: import gratuito
+    residuals = metadata.get('calibration_residuals') or []
+    is_forest = isinstance(model, RandomForestRegressor)
+    if method == 'alberi' and not is_forest: method = 'conformal'
+    elif method == 'conformal' and not residuals and is_forest: method = 'alberi' # Modelli senza residui salvati
 
     # Esegui la previsione
     try:
-        with st.spinner("Esecuzione previsione ML..."):
+        if is_forest:
+            # Un'unica lettura di tutti gli alberi: la media dà la stima puntuale, i quantili l'intervallo
+            per_tree = tree_predictions(model, X_pred, _leaf_values(metadata['version_id']))
+            prediction = per_tree.mean(axis=1)
+        else:
             prediction = model.predict(X_pred)
-            predicted_value = prediction[0] # predict ritorna un array
-            print(f"Previsione ML eseguita con successo. Risultato: {predicted_value:.4f}%")
-            return predicted_value
+
+        if method == 'alberi':
+            lower, upper = np.quantile(per_tree, [alpha / 2, 1 - alpha / 2], axis=1)
+        elif residuals:
+            half_width = conformal_quantile(residuals, alpha)
+            lower, upper = prediction - half_width, prediction + half_width
+        else:
+            lower = upper = np.full(len(prediction), np.nan)
+        result = pd.DataFrame({'soglia_prevista': prediction, 'soglia_min': lower, 'soglia_max': upper}, index=X_pred.index)
+        result.attrs['method'] = method if residuals or method == 'alberi' else None
+        logger.debug("Previsione ML eseguita su %d gare (intervallo: %s).", len(result), result.attrs['method'])
+        return result
     except Exception as e:
-        st.error(f"Errore durante l'esecuzione della previsione ML: {e}")
-        print(f"Errore durante model.predict(): {e}")
-        print("Dati passati al modello (prime 5 righe se multiple):")
-        try:
-            print(X_pred.head().to_markdown())
-            print("Tipi di dati:")
-            print(X_pred.dtypes)
-        except Exception as dump_err:
-             print(f"Impossibile stampare i dati di input: {dump_err}")
-        traceback.print_exc();
-        return None
\ No newline at end of file
+        logger.exception("Errore durante model.predict(): %s", e,
+                         extra={'righe_input': len(X_pred), 'tipi_input': {c: str(t) for c, t in X_pred.dtypes.items()},
+                                'esempio_input': X_pred.head().to_dict('records')})
+        raise MLError(f"Errore durante l'esecuzione della previsione ML: {e}") from e
+
+def predict_soglia_interval(input_data_dict, alpha=INTERVAL_ALPHA, method='conformal'):
+    """
+    Previsione della soglia per una gara con intervallo di confidenza.
+
+    Returns:
+        dict: 'prediction', 'lower', 'upper' (in percentuale), 'method' e 'alpha'.
+              Solleva MLError come predict_soglia_batch.
+    """
+    result = predict_soglia_batch(pd.DataFrame([input_data_dict]), alpha=alpha, method=method)
+    row = result.iloc[0]
+    return {'prediction': float(row['soglia_prevista']), 'lower': float(row['soglia_min']),
+            'upper': float(row['soglia_max']), 'method': result.attrs.get('method'), 'alpha': alpha}
+
+def predict_soglia(input_data_dict):
+    """
+    Esegue una previsione della soglia usando il modello salvato.
+
+    Args:
+        input_data_dict (dict): Dizionario contenente i valori delle feature
+                                per la gara di cui prevedere la soglia.
+                                Es: {'importo_base': ..., 'data_gara': 'YYYY-MM-DD', ...}
+
+    Returns:
+        float: Valore previsto della soglia (in percentuale).
+               Solleva MLError come predict_soglia_batch.
+    """
+    return predict_soglia_interval(input_data_dict)['prediction']
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Archivio versionato dei modelli ML: un artefatto atomico per versione + metadati."""
+import os
+import json
+import datetime
+import hashlib
+import pandas as pd
+
+import cache_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
+
+# --- Costanti ---
+MODEL_DIR = "ml_model"
+VERSIONS_DIR = os.path.join(MODEL_DIR, "versions")
+REGISTRY_PATH = os.path.join(MODEL_DIR, "registry.json") # {'active': id versione, 'pinned': bool}
+# Compressione joblib dell'artefatto: 0 = non compresso, permette il caricamento memory-mapped
+# (gli array degli alberi restano su disco e vengono letti a richiesta). 1-9 = file più piccoli.
+MODEL_COMPRESS = 0
+# File del formato precedente (tre joblib sovrascritti ad ogni addestramento), importati una volta
+LEGACY_MODEL_PATH = os.path.join(MODEL_DIR, "random_forest_soglia_model.joblib")
+LEGACY_COLUMNS_PATH = os.path.join(MODEL_DIR, "model_columns.joblib")
+LEGACY_LABEL_ENCODERS_PATH = os.path.join(MODEL_DIR, "label_encoders.joblib")
+
+# --- Utility ---
+def _atomic_write_json(path, data):
+    """Scrive JSON su file temporaneo e lo rinomina: chi legge vede il vecchio o il nuovo, mai metà."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+def _artifact_path(version_id): return os.path.join(VERSIONS_DIR, f"{version_id}.joblib")
+def _metadata_path(version_id): return os.path.join(VERSIONS_DIR, f"{version_id}.json")
+
+def data_fingerprint(df: pd.DataFrame) -> str:
+    """Impronta SHA-256 dei dati di training (contenuto e ordine colonne, indipendente dall'indice)."""
+    hasher = hashlib.sha256()
+    hasher.update(','.join(map(str, df.columns)).encode('utf-8'))
+    hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return hasher.hexdigest()
+
+def _read_registry() -> dict:
+    try:
+        with open(REGISTRY_PATH, encoding='utf-8') as f: return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError): return {'active': None, 'pinned': False}
+
+# --- Salvataggio ---
+def save_model(model, columns, encoders, metadata: dict, activate: bool = True) -> str:
+    """
+    Salva modello, colonne ed encoder come UN unico artefatto versionato.
+
+    Args:
+        model: Modello sklearn addestrato.
+        columns (list): Feature attese dal modello, nell'ordine di training.
+        encoders (dict): LabelEncoder per colonna categorica.
+        metadata (dict): Metriche, impronta dati, ecc. (aggiunti versione, data e compressione).
+        activate (bool): Se True rende attiva la nuova versione, salvo che un'altra sia bloccata (pin).
+
+    Returns:
+        str: ID della nuova versione.
+    """
+    import joblib # Import differito: l'avvio dell'app consulta solo registro e metadati JSON
+    os.makedirs(VERSIONS_DIR, exist_ok=True)
+    trained_at = datetime.datetime.now()
+    fingerprint = metadata.get('data_fingerprint') or ''
+    version_id = f"v{trained_at.strftime('%Y%m%d_%H%M%S')}_{fingerprint[:8] or 'nodata'}"
+    suffix = 1
+    while os.path.exists(_artifact_path(version_id)): # Due addestramenti nello stesso secondo
+        version_id = f"{version_id.rsplit('-', 1)[0]}-{suffix}"; suffix += 1
+
+    metadata = {**metadata, 'version_id': version_id, 'trained_at': trained_at.isoformat(timespec='seconds'),
+                'features': list(columns), 'compress': MODEL_COMPRESS}
+    artifact = {'model': model, 'columns': list(columns), 'encoders': encoders, 'metadata': metadata}
+
+    # Artefatto: scrittura su file temporaneo + rename atomico (nessun set incoerente in caso di crash)
+    tmp_path = f"{_artifact_path(version_id)}.tmp{os.getpid()}"
+    try:
+        joblib.dump(artifact, tmp_path, compress=MODEL_COMPRESS)
+        os.replace(tmp_path, _artifact_path(version_id))
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    # Metadati anche in chiaro accanto all'artefatto: list_models non deve caricare i modelli
+    _atomic_write_json(_metadata_path(version_id), metadata)
+    logger.info("Modello salvato come versione %s.", version_id)
+
+    registry = _read_registry()
+    if activate and not (registry.get('pinned') and registry.get('active')):
+        _atomic_write_json(REGISTRY_PATH, {'active': version_id, 'pinned': False})
+        logger.info("Versione %s attivata.", version_id)
+    else:
+        logger.info("Versione %s salvata ma non attivata (versione bloccata: %s).", version_id, registry.get('active'))
+    return version_id
+
+def _import_legacy_model():
+    """Converte i tre file joblib del vecchio formato in una versione dell'archivio (una sola volta)."""
+    if not all(os.path.exists(p) for p in [LEGACY_MODEL_PATH, LEGACY_COLUMNS_PATH, LEGACY_LABEL_ENCODERS_PATH]): return
+    if os.path.isdir(VERSIONS_DIR) and any(f.endswith('.joblib') for f in os.listdir(VERSIONS_DIR)): return
+    import joblib
+    try:
+        model = joblib.load(LEGACY_MODEL_PATH)
+        columns = joblib.load(LEGACY_COLUMNS_PATH)
+        encoders = joblib.load(LEGACY_LABEL_ENCODERS_PATH)
+        save_model(model, columns, encoders, {'origine': 'legacy', 'data_fingerprint': ''})
+        logger.info("Modello nel vecchio formato importato nell'archivio versionato.")
+    except Exception as e:
+        logger.exception("Import del modello nel vecchio formato fallito: %s", e)
+
+# --- Consultazione ---
+def list_models() -> list:
+    """Ritorna i metadati di tutte le versioni, dalla più recente, con flag 'active'."""
+    _import_legacy_model()
+    if not os.path.isdir(VERSIONS_DIR): return []
+    registry = _read_registry()
+    models = []
+    for file_name in os.listdir(VERSIONS_DIR):
+        if not file_name.endswith('.joblib'): continue
+        version_id = file_name[:-len('.joblib')]
+        try:
+            with open(_metadata_path(version_id), encoding='utf-8') as f: metadata = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Crash tra artefatto e metadati: l'artefatto contiene comunque i metadati
+            import joblib
+            metadata = joblib.load(_artifact_path(version_id), mmap_mode='r')['metadata']
+            _atomic_write_json(_metadata_path(version_id), metadata)
+        metadata['active'] = version_id == registry.get('active')
+        models.append(metadata)
+    return sorted(models, key=lambda m: (m.get('trained_at', ''), m['version_id']), reverse=True)
+
+def get_active_version() -> str | None:
+    """ID della versione attiva (None se nessun modello è disponibile)."""
+    _import_legacy_model()
+    version_id = _read_registry().get('active')
+    return version_id if version_id and os.path.exists(_artifact_path(version_id)) else None
+
+def is_pinned() -> bool:
+    return bool(_read_registry().get('pinned'))
+
+def get_metadata(version_id: str | None = None) -> dict | None:
+    """Metadati di una versione (default: attiva) senza caricare il modello."""
+    version_id = version_id or get_active_version()
+    if version_id is None: return None
+    return next((m for m in list_models() if m['version_id'] == version_id), None)
+
+# --- Pin / Rollback ---
+def pin_version(version_id: str) -> bool:
+    """Attiva la versione indicata e la blocca: i nuovi addestramenti non la sostituiscono."""
+    if not os.path.exists(_artifact_path(version_id)):
+        logger.warning("Versione %s non trovata.", version_id); return False
+    _atomic_write_json(REGISTRY_PATH, {'active': version_id, 'pinned': True})
+    logger.info("Versione %s attivata e bloccata.", version_id); return True
+
+def unpin() -> None:
+    """Sblocca la versione attiva: il prossimo addestramento diventerà attivo."""
+    registry = _read_registry()
+    _atomic_write_json(REGISTRY_PATH, {'active': registry.get('active'), 'pinned': False})
+
+def rollback() -> str | None:
+    """Torna alla versione precedente a quella attiva (in ordine di addestramento) e la blocca."""
+    models = list_models()
+    ids = [m['version_id'] for m in models]
+    active = get_active_version()
+    if active not in ids or ids.index(active) + 1 >= len(ids):
+        logger.warning("Nessuna versione precedente disponibile per il rollback."); return None
+    previous = ids[ids.index(active) + 1]
+    pin_version(previous)
+    return previous
+
+# --- Caricamento ---
+@cache_utils.cached('resource', max_entries=3)
+def _load_artifact(version_id: str) -> dict:
+    """Carica (una volta per processo) l'artefatto di una versione; le versioni sono immutabili."""
+    import joblib
+    path = _artifact_path(version_id)
+    try:
+        with open(_metadata_path(version_id), encoding='utf-8') as f: compress = json.load(f).get('compress', 0)
+    except (FileNotFoundError, json.JSONDecodeError): compress = 1 # Sconosciuto: niente mmap
+    # memory-map possibile solo per artefatti non compressi
+    artifact = joblib.load(path, mmap_mode='r' if not compress else None)
+    logger.info("Artefatto modello %s caricato da disco%s.", version_id, ' (memory-mapped)' if not compress else '')
+    return artifact
+
+def load_model(version_id: str | None = None):
+    """Ritorna (model, columns, encoders, metadata) della versione richiesta (default: attiva)."""
+    version_id = version_id or get_active_version()
+    if version_id is None:
+        logger.debug("Nessuna versione di modello disponibile."); return None, None, None, None
+    artifact = _load_artifact(version_id)
+    return artifact['model'], artifact['columns'], artifact['encoders'], artifact['metadata']
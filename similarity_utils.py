@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Ricerca delle gare storiche più simili a un nuovo bando (k-nearest neighbour su indice BallTree)."""
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+# scikit-learn e joblib importati nelle funzioni: caricati solo alla prima ricerca
+
+import model_store_utils
+import cache_utils
+import trace_utils
+import log_utils
+
+logger = log_utils.get_logger(__name__)
+
+# --- Costanti ---
+INDEX_PATH = os.path.join(model_store_utils.MODEL_DIR, "similarity_index.joblib")
+TARGET_COLUMN = 'soglia_anomalia_calcolata'
+# Colonne che determinano la posizione di una gara nell'indice (il loro hash rileva le modifiche)
+INDEX_COLUMNS = ['importo_base', 'categoria_lavori', 'stazione_appaltante', 'numero_concorrenti', 'data_gara', 'descrizione', TARGET_COLUMN]
+# Peso di ogni componente nella distanza (a parità di peso, una deviazione standard vale
+# quanto una categoria diversa)
+WEIGHTS = {'importo_base': 1.0, 'numero_concorrenti': 0.5, 'data_gara': 0.5, 'categoria_lavori': 1.0, 'stazione_appaltante': 0.7}
+# Descrizione: TF-IDF ridotto con SVD, usato per riordinare i candidati quando il bando ha una descrizione
+TEXT_WEIGHT = 1.0
+TEXT_COMPONENTS = 16
+MIN_TEXT_ROWS = 20 # Sotto questo numero di descrizioni il testo non viene usato
+CANDIDATE_FACTOR = 5 # Candidati strutturali per vicino richiesto, riordinati poi con il testo
+# Gare nuove/modificate/eliminate (rispetto all'indice principale) oltre le quali l'indice viene
+# ricostruito; sotto la soglia finiscono in un buffer cercato per forza bruta.
+REBUILD_FRACTION = 0.1
+
+# --- Trasformazione Feature ---
+def _numeric(df, col, log=False):
+    values = pd.to_numeric(df[col], errors='coerce').astype(float) if col in df.columns else pd.Series(np.nan, index=df.index)
+    return np.log1p(values.clip(lower=0)) if log else values
+
+def _days(df):
+    dates = pd.to_datetime(df['data_gara'], errors='coerce') if 'data_gara' in df.columns else pd.Series(pd.NaT, index=df.index)
+    return (dates - pd.Timestamp('1970-01-01')).dt.days.astype(float)
+
+def _texts(df):
+    return df['descrizione'].fillna('').astype(str) if 'descrizione' in df.columns else pd.Series('', index=df.index)
+
+def _fit_transformers(df):
+    """Statistiche di scala, vocabolari categorici e modello testuale calcolati sulle gare indicizzate."""
+    transformers = {'scale': {}, 'categories': {}, 'text': None}
+    for col, series in [('importo_base', _numeric(df, 'importo_base', log=True)),
+                        ('numero_concorrenti', _numeric(df, 'numero_concorrenti', log=True)),
+                        ('data_gara', _days(df))]:
+        mean, std = series.mean(), series.std()
+        transformers['scale'][col] = (float(mean) if pd.notna(mean) else 0.0, float(std) if pd.notna(std) and std > 0 else 1.0)
+    for col in ['categoria_lavori', 'stazione_appaltante']:
+        transformers['categories'][col] = pd.Index(sorted(df[col].dropna().astype(str).unique()) if col in df.columns else [], dtype=object)
+
+    texts = _texts(df)
+    if (texts.str.strip() != '').sum() >= MIN_TEXT_ROWS:
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.decomposition import TruncatedSVD
+        try:
+            vectorizer = TfidfVectorizer(max_features=5000, ngram_range=(1, 2), sublinear_tf=True)
+            tfidf = vectorizer.fit_transform(texts)
+            n_components = min(TEXT_COMPONENTS, tfidf.shape[1] - 1)
+            if n_components >= 1:
+                transformers['text'] = (vectorizer, TruncatedSVD(n_components=n_components, random_state=42).fit(tfidf))
+        except ValueError as e: # Es. vocabolario vuoto (solo stop word / numeri)
+            logger.warning("Indice similarità: descrizioni non utilizzabili (%s).", e)
+    return transformers
+
+def _transform(df, transformers):
+    """Ritorna (matrice strutturale, matrice testo o None) per le righe di df."""
+    parts = []
+    for col, series in [('importo_base', _numeric(df, 'importo_base', log=True)),
+                        ('numero_concorrenti', _numeric(df, 'numero_concorrenti', log=True)),
+                        ('data_gara', _days(df))]:
+        mean, std = transformers['scale'][col]
+        parts.append((((series - mean) / std).fillna(0.0) * WEIGHTS[col]).to_numpy()[:, None]) # NaN -> valore medio
+    for col, categories in transformers['categories'].items():
+        one_hot = np.zeros((len(df), len(categories)))
+        if col in df.columns and len(categories):
+            codes = categories.get_indexer(df[col].astype(str).where(df[col].notna(), None))
+            known = codes >= 0
+            # Due categorie diverse distano esattamente WEIGHTS[col]; una sconosciuta dista WEIGHTS[col]/sqrt(2) da tutte
+            one_hot[np.flatnonzero(known), codes[known]] = WEIGHTS[col] / np.sqrt(2)
+        parts.append(one_hot)
+    structural = np.hstack(parts)
+
+    text = None
+    if transformers['text'] is not None:
+        from sklearn.preprocessing import normalize
+        vectorizer, svd = transformers['text']
+        text = normalize(svd.transform(vectorizer.transform(_texts(df)))) * TEXT_WEIGHT
+    return structural, text
+
+def _row_hashes(df):
+    return pd.util.hash_pandas_object(df.reindex(columns=INDEX_COLUMNS), index=False).to_numpy()
+
+# --- Indice ---
+def build_index(df):
+    """Costruisce l'indice principale (BallTree) sulle gare con soglia nota."""
+    from sklearn.neighbors import BallTree
+    start = time.perf_counter()
+    df_hist = df[df[TARGET_COLUMN].notna()] if TARGET_COLUMN in df.columns else df.iloc[:0]
+    transformers = _fit_transformers(df_hist)
+    structural, text = _transform(df_hist, transformers)
+    index = {'tree': BallTree(structural) if len(df_hist) else None, 'transformers': transformers,
+             'ids': df_hist['id'].to_numpy(), 'hashes': _row_hashes(df_hist), 'text': text}
+    _reset_buffer(index, np.ones(len(df_hist), dtype=bool))
+    logger.info("Indice similarità costruito su %d gare in %.2fs.", len(df_hist), time.perf_counter() - start)
+    return index
+
+def _reset_buffer(index, valid):
+    index.update({'valid': valid, 'buffer_ids': np.array([], dtype=np.int64),
+                  'buffer_structural': np.empty((0, index['tree'].data.shape[1] if index['tree'] is not None else 0)),
+                  'buffer_text': None})
+
+def update_index(index, df):
+    """
+    Allinea l'indice alle gare correnti senza ricostruirlo: le gare dell'indice principale eliminate o
+    modificate vengono escluse (maschera 'valid'), quelle nuove o modificate vanno nel buffer.
+    Ricostruisce l'indice se le differenze superano REBUILD_FRACTION delle gare indicizzate.
+    """
+    if index['tree'] is None or len(index['ids']) == 0: # Indice vuoto (nessuna soglia nota): niente da confrontare
+        return build_index(df)
+    df_hist = df[df[TARGET_COLUMN].notna()] if TARGET_COLUMN in df.columns else df.iloc[:0]
+    hashes = _row_hashes(df_hist)
+    main_pos = pd.Series(np.arange(len(index['ids'])), index=index['ids']).reindex(df_hist['id'].to_numpy())
+    found = main_pos.notna().to_numpy()
+    pos = main_pos.fillna(0).astype(int).to_numpy()
+    unchanged = found & (index['hashes'][pos] == hashes)
+
+    valid = np.zeros(len(index['ids']), dtype=bool)
+    valid[pos[unchanged]] = True
+    n_changes = int((~valid).sum() + (~unchanged).sum())
+    if n_changes > REBUILD_FRACTION * len(index['ids']):
+        logger.info("Indice similarità: %d differenze, ricostruzione completa.", n_changes)
+        return build_index(df)
+
+    index = dict(index) # Copia: le ricerche in corso continuano a usare la versione precedente
+    _reset_buffer(index, valid)
+    if (~unchanged).any():
+        index['buffer_ids'] = df_hist['id'].to_numpy()[~unchanged]
+        index['buffer_structural'], index['buffer_text'] = _transform(df_hist[~unchanged], index['transformers'])
+    return index
+
+@cache_utils.cached('resource')
+def _index_holder():
+    """Indice condiviso da tutte le sessioni del server (con lock per gli aggiornamenti)."""
+    holder = {'index': None, 'data_hash': None, 'lock': threading.Lock()}
+    if os.path.exists(INDEX_PATH):
+        import joblib
+        try: holder['index'] = joblib.load(INDEX_PATH)
+        except Exception as e: logger.warning("Indice similarità su disco non leggibile (%s): verrà ricostruito.", e)
+    return holder
+
+def get_index(df):
+    """Indice aggiornato ai dati di df; salvato su disco ad ogni ricostruzione completa."""
+    holder = _index_holder()
+    data_hash = int(_row_hashes(df).sum()) ^ len(df) if not df.empty else 0
+    with holder['lock']:
+        if holder['data_hash'] == data_hash and holder['index'] is not None:
+            return holder['index']
+        previous = holder['index']
+        index = update_index(previous, df) if previous is not None else build_index(df)
+        if previous is None or index['tree'] is not previous['tree']: # Salva solo le ricostruzioni complete
+            import joblib
+            tmp_path = f"{INDEX_PATH}.tmp{os.getpid()}"
+            os.makedirs(os.path.dirname(INDEX_PATH) or '.', exist_ok=True)
+            joblib.dump(index, tmp_path); os.replace(tmp_path, INDEX_PATH)
+        holder['index'], holder['data_hash'] = index, data_hash
+        return index
+
+# --- Ricerca ---
+@trace_utils.traced('similarita.find_similar')
+def find_similar(df, gara: dict, k: int = 10) -> pd.DataFrame:
+    """
+    Le k gare storiche (con soglia nota) più simili a un nuovo bando.
+
+    Args:
+        df (pd.DataFrame): Tabella gare corrente (come da db_utils.get_all_gare).
+        gara (dict): Dati del bando: importo_base, data_gara, categoria_lavori, stazione_appaltante,
+                     numero_concorrenti e, facoltativa, descrizione.
+        k (int): Numero di gare simili da restituire.
+
+    Returns:
+        pd.DataFrame: Righe di df delle gare simili, dalla più vicina, con colonna 'distanza'.
+                      attrs['elapsed_ms'] = durata della ricerca (indice già pronto).
+    """
+    index = get_index(df)
+    start = time.perf_counter()
+    if index['tree'] is None: return df.iloc[:0].assign(distanza=pd.Series(dtype=float))
+    query = pd.DataFrame([gara])
+    q_structural, q_text = _transform(query, index['transformers'])
+    use_text = q_text is not None and bool(str(gara.get('descrizione') or '').strip())
+
+    # Indice principale: si chiedono abbastanza candidati da coprire quelli esclusi e il riordino testuale
+    n_excluded = int((~index['valid']).sum())
+    n_candidates = min(len(index['ids']), k * (CANDIDATE_FACTOR if use_text else 1) + n_excluded)
+    dist, ind = index['tree'].query(q_structural, k=n_candidates)
+    keep = index['valid'][ind[0]]
+    ind, dist = ind[0][keep], dist[0][keep]
+    candidates = [(index['ids'][ind], dist, index['text'][ind] if use_text else None)]
+    # Buffer (gare nuove/modificate dall'ultima ricostruzione): forza bruta
+    if len(index['buffer_ids']):
+        buffer_dist = np.linalg.norm(index['buffer_structural'] - q_structural, axis=1)
+        candidates.append((index['buffer_ids'], buffer_dist, index['buffer_text'] if use_text else None))
+
+    ids = np.concatenate([c[0] for c in candidates])
+    distances = np.concatenate([c[1] for c in candidates])
+    if use_text: # Distanza combinata struttura + testo
+        texts = np.vstack([c[2] for c in candidates])
+        distances = np.sqrt(distances ** 2 + np.sum((texts - q_text) ** 2, axis=1))
+    order = np.argsort(distances, kind='stable')[:k]
+
+    result = df.set_index('id', drop=False).loc[ids[order]].assign(distanza=distances[order]).reset_index(drop=True)
+    result.attrs['elapsed_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+def soglia_distribution(similar: pd.DataFrame) -> dict:
+    """Statistiche della soglia sulle gare simili (media pesata con l'inverso della distanza)."""
+    soglie = similar[TARGET_COLUMN].astype(float)
+    weights = 1.0 / (similar['distanza'].to_numpy() + 1e-6)
+    return {'n': len(soglie), 'media': float(soglie.mean()), 'media_pesata': float(np.average(soglie, weights=weights)),
+            'mediana': float(soglie.median()), 'p10': float(soglie.quantile(0.1)), 'p90': float(soglie.quantile(0.9)),
+            'min': float(soglie.min()), 'max': float(soglie.max())}
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""Configurazione comune dei test: moduli dell'app importabili dalla radice del repository."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """db_utils su un DB (e snapshot) temporaneo, con connessione e cache svuotate prima e dopo il test."""
+    import cache_utils
+    import db_utils
+    monkeypatch.setattr(db_utils, 'DB_FILENAME', str(tmp_path / "gare_test.db"))
+    monkeypatch.setattr(db_utils, 'SNAPSHOT_PATH', str(tmp_path / "gare_test.arrow"))
+    cache_utils.clear_all(); db_utils.clear_all_cache()
+    yield db_utils
+    db_utils.init_connection().close()
+    cache_utils.clear_all(); db_utils.clear_all_cache()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+import anac_utils
+
+RECORDS = [{'cig': f'Z{i:09d}', 'oggetto_lotto': 'Lavori {"a": [1, 2]} ' * (i % 3), 'importo_lotto': 1000.5 * i} for i in range(25)]
+
+@pytest.mark.parametrize('chunk_chars', [1, 3, 7, 64, anac_utils.READ_CHUNK_CHARS])
+@pytest.mark.parametrize('dump', [
+    '\n'.join(json.dumps(r) for r in RECORDS),             # JSON Lines senza a capo finale
+    '\n'.join(json.dumps(r) for r in RECORDS) + '\n\n',    # ... con righe vuote in fondo
+    json.dumps(RECORDS),                                    # Array compatto
+    '[\n' + ',\n'.join(json.dumps(r, indent=2) for r in RECORDS) + '\n]\n', # Array indentato
+])
+def test_iter_json_across_chunk_boundaries(dump, chunk_chars):
+    assert list(anac_utils.iter_json(io.StringIO(dump), chunk_chars)) == RECORDS
+
+@pytest.mark.parametrize('chunk_chars', [1, 7, anac_utils.READ_CHUNK_CHARS])
+def test_iter_json_single_record(chunk_chars):
+    assert list(anac_utils.iter_json(io.StringIO(json.dumps(RECORDS[1])), chunk_chars)) == [RECORDS[1]]
+    assert list(anac_utils.iter_json(io.StringIO('[]'), chunk_chars)) == []
+
+@pytest.mark.parametrize('dump', ['[{"cig": "A"}, {"cig": ', '{"cig": "A"}\n{"cig": '])
+def test_iter_json_truncated_dump(dump):
+    with pytest.raises(anac_utils.AnacError):
+        list(anac_utils.iter_json(io.StringIO(dump), 4))
+
+@pytest.mark.parametrize('value, expected', [
+    ('1234.56', 1234.56), ('1.234,56', 1234.56), ('1,234.56', 1234.56), ('1.234.567', 1234567.0),
+    ('1.234.567,8', 1234567.8), ('1.234', 1.234), ('15,3 %', 15.3), ('€ 250.000,00', 250000.0),
+    (42, 42), ('', None), ('n.d.', None), ('nan', None), (None, None),
+])
+def test_to_number(value, expected):
+    assert anac_utils._to_number(value) == expected
+
+def test_map_record_filters_and_mapping():
+    record = {'cig': ' Z1 ', 'id_categoria': 'og1', 'sezione_regionale': 'SEZIONE REGIONALE LOMBARDIA',
+              'importo_lotto': '1.234.567,50', 'data_pubblicazione': '15/03/2024', 'numero_offerte_ammesse': '12'}
+    row = anac_utils.map_record(record, categorie={'OG1'}, regioni={'LOMBARDIA'})
+    assert row['identificativo_gara'] == 'Z1' and row['importo_base'] == 1234567.5
+    assert row['data_gara'] == '2024-03-15' and row['numero_concorrenti'] == 12
+    assert anac_utils.map_record(record, categorie={'OG3'}) is None
+    assert anac_utils.map_record(record, regioni={'VENETO'}) is None
+    assert anac_utils.map_record({'cig': 'Z2'}, categorie={'OG1'}) is None # Campo mancante con filtro attivo
+
+def test_stream_import_gzip_in_batches(temp_db, tmp_path, monkeypatch):
+    import gzip
+    monkeypatch.setattr(anac_utils, 'STAGING_BATCH_ROWS', 4)
+    records = [{'cig': f'Z{i}', 'id_categoria': 'OG1' if i % 2 else 'OS3', 'regione': 'Lombardia', 'importo_lotto': '1000.5'} for i in range(20)]
+    records.append(dict(records[1])) # CIG ripetuto nel dump
+    path = tmp_path / "cig.jsonl.gz"
+    with gzip.open(path, 'wt', encoding='utf-8') as f: f.write('\n'.join(json.dumps(r) for r in records))
+    result = anac_utils.stream_import(str(path), categorie=['og1'])
+    assert (result['lette'], result['corrispondenti'], result['importate']) == (21, 11, 10)
+    assert sorted(temp_db.get_all_gare()['identificativo_gara']) == sorted(f'Z{i}' for i in range(1, 20, 2))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+def test_filter_options_ignore_malformed_values(temp_db):
+    gare = [('Z1', '2023-05-02', 1000.0, 'OG1', 'Vinta'), ('Z2', '2024-02-10 00:00:00', 50, 'OS3', ''),
+            ('Z3', '', '', '', None), ('Z4', 'n.d.', 'da definire', None, 'Persa'), ('Z5', None, None, 'OG1', None)]
+    with temp_db.get_db_cursor() as cursor:
+        cursor.executemany("INSERT INTO gare (identificativo_gara, data_gara, importo_base, categoria_lavori, esito) VALUES (?, ?, ?, ?, ?)", gare)
+    options = temp_db.get_filter_options()
+    assert (options['data_min'], options['data_max']) == (pd.Timestamp('2023-05-02'), pd.Timestamp('2024-02-10'))
+    assert (options['importo_min'], options['importo_max']) == (50.0, 1000.0)
+    assert (options['categorie'], options['esiti']) == (['OG1', 'OS3'], ['Persa', 'Vinta'])
+
+def test_filter_options_empty_table(temp_db):
+    options = temp_db.get_filter_options()
+    assert [options[key] for key in ['data_min', 'data_max', 'importo_min', 'importo_max', 'categorie', 'esiti']] == [None, None, None, None, [], []]
+
+def test_ml_target_keeps_full_precision(temp_db):
+    temp_db.add_gara({'identificativo_gara': 'Z1', 'soglia_anomalia_calcolata': 12.3456789, 'mio_ribasso_percentuale': 11.5})
+    for _ in range(2): # Da SQLite, poi dallo snapshot
+        df = temp_db.get_all_gare()
+        assert df['soglia_anomalia_calcolata'].dtype == 'float64' and df['soglia_anomalia_calcolata'].iloc[0] == 12.3456789
+        assert df['mio_ribasso_percentuale'].dtype == 'float32'
+        temp_db.clear_all_cache()
+
+def test_writes_refresh_snapshot(temp_db):
+    import import_utils
+    def snapshot():
+        return temp_db._read_snapshot(temp_db.get_data_version())
+    temp_db.add_gara({'identificativo_gara': 'Z1', 'importo_base': 1000.0})
+    assert snapshot()['identificativo_gara'].tolist() == ['Z1']
+    gara_id = int(snapshot()['id'].iloc[0])
+    temp_db.update_gara(gara_id, {'importo_base': 2000.0})
+    assert snapshot()['importo_base'].tolist() == [2000.0]
+    import_utils.import_dataframe(pd.DataFrame({'identificativo_gara': ['Z2', 'Z3'], 'importo_base': [1.0, 2.0]}))
+    assert sorted(snapshot()['identificativo_gara']) == ['Z1', 'Z2', 'Z3']
+    temp_db.delete_gara_by_id(gara_id)
+    assert sorted(snapshot()['identificativo_gara']) == ['Z2', 'Z3']
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_store_utils as fs
+
+def _gare(n=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'importo_base': rng.uniform(1e5, 1e6, n).round(2),
+        'categoria_lavori': rng.choice(['OG1', 'OG3', 'OS3'], n),
+        'stazione_appaltante': rng.choice(['Comune A', 'Comune B'], n),
+        'numero_concorrenti': rng.integers(2, 40, n).astype(float),
+        'data_gara': pd.to_datetime('2024-01-01') + pd.to_timedelta(rng.integers(0, 60, n), unit='D'),
+        'soglia_anomalia_calcolata': rng.uniform(10, 30, n).round(4),
+    })
+
+def _aggregates(path):
+    with fs._connect(str(path)) as conn:
+        return pd.read_sql_query(f"SELECT * FROM {fs.AGGREGATES_TABLE} ORDER BY gruppo, chiave, giorno", conn)
+
+def test_incremental_sync_matches_rebuild(tmp_path):
+    df = _gare()
+    fs.sync(df, store_path=str(tmp_path / "a.sqlite"))
+    changed = df.copy()
+    changed.loc[0, 'soglia_anomalia_calcolata'] = 99.0
+    changed.loc[1, 'data_gara'] = pd.Timestamp('2024-06-01')
+    changed.loc[2, 'stazione_appaltante'] = 'Comune C'
+    changed = pd.concat([changed.drop(index=5), _gare(3, seed=1).assign(id=[101, 102, 103])], ignore_index=True)
+    fs.sync(changed, store_path=str(tmp_path / "a.sqlite")) # Differenze applicate ai totali
+    fs.sync(changed, store_path=str(tmp_path / "b.sqlite")) # Ricostruzione da zero
+    pd.testing.assert_frame_equal(_aggregates(tmp_path / "a.sqlite"), _aggregates(tmp_path / "b.sqlite"))
+    pd.testing.assert_frame_equal(fs.get_features(changed, store_path=str(tmp_path / "a.sqlite")),
+                                  fs.get_features(changed, store_path=str(tmp_path / "b.sqlite")))
+
+def test_aggregates_use_only_strictly_past_gare(tmp_path):
+    df = pd.DataFrame({'id': [1, 2, 3], 'importo_base': [1e5] * 3, 'categoria_lavori': ['OG1'] * 3,
+                       'stazione_appaltante': ['Comune A'] * 3, 'numero_concorrenti': [5.0] * 3,
+                       'data_gara': pd.to_datetime(['2024-01-01', '2024-01-02', '2024-01-02']),
+                       'soglia_anomalia_calcolata': [10.0, 20.0, 30.0]})
+    features = fs.get_features(df, store_path=str(tmp_path / "s.sqlite"))
+    assert features['sa_gare_passate'].tolist() == [0, 1, 1] # Lo stesso giorno non conta
+    assert np.isnan(features.loc[0, 'sa_soglia_media_passata'])
+    assert features.loc[1:, 'sa_soglia_media_passata'].tolist() == [10.0, 10.0]
+
+def test_concurrent_syncs_count_each_gara_once(tmp_path):
+    path, df = str(tmp_path / "s.sqlite"), _gare(200)
+    fs.sync(df.iloc[:100], store_path=path)
+    threads = [threading.Thread(target=fs.sync, args=(df,), kwargs={'store_path': path}) for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    totals = _aggregates(path).groupby('gruppo')['n_gare'].sum()
+    assert (totals == len(df)).all()
+
+def test_unchanged_rows_are_read_from_store(tmp_path):
+    path, df = str(tmp_path / "s.sqlite"), _gare(10)
+    fs.sync(df, store_path=path)
+    with fs._connect(path) as conn: # Valore marcato nello store: se la riga viene riletta, compare nelle feature
+        conn.execute(f"UPDATE {fs.FEATURES_TABLE} SET importo_base = -1 WHERE gara_id IN (1, 2)")
+    changed = df.copy()
+    changed.loc[1, 'importo_base'] = 123.0 # Hash diverso: ricalcolata
+    features = fs.get_features(changed, store_path=path)
+    assert features.loc[0, 'importo_base'] == -1
+    assert features.loc[1, 'importo_base'] == 123.0
+    assert features.loc[2:, 'importo_base'].tolist() == df.loc[2:, 'importo_base'].tolist()
+
+def test_rows_without_id_are_not_stored(tmp_path):
+    path = str(tmp_path / "s.sqlite")
+    fs.sync(_gare(5), store_path=path)
+    new = _gare(2, seed=3).drop(columns='id')
+    features = fs.get_features(new, store_path=path)
+    assert len(features) == 2
+    with fs._connect(path) as conn:
+        assert conn.execute(f"SELECT COUNT(*) FROM {fs.FEATURES_TABLE}").fetchone()[0] == 5
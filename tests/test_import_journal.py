@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+import import_utils
+
+def _df(n=10):
+    return pd.DataFrame({'identificativo_gara': [f'Z{i}' for i in range(n)], 'importo_base': [1000.0 * i for i in range(n)],
+                         'data_gara': pd.to_datetime(['2024-01-01'] * n)})
+
+def _interrupt_after(monkeypatch, db, calls):
+    """promote_staging fallisce dopo calls chiamate riuscite (interruzione a metà file)."""
+    original, done = db.promote_staging, []
+    def promote(*args, **kwargs):
+        if len(done) >= calls: raise db.DatabaseError("interrotta")
+        done.append(1); return original(*args, **kwargs)
+    monkeypatch.setattr(db, 'promote_staging', promote)
+
+def test_resume_from_first_unrecorded_chunk(temp_db, monkeypatch):
+    monkeypatch.setattr(import_utils, 'IMPORT_CHUNK_ROWS', 3)
+    with monkeypatch.context() as m:
+        _interrupt_after(m, temp_db, 2)
+        result = import_utils.import_dataframe(_df(), fingerprint='f' * 64, file_name='gare.csv')
+    assert result['importate'] == 6 and result['ultimo_errore'] == "interrotta"
+    journal = import_utils.import_status('f' * 64)
+    assert (journal['stato'], journal['righe_processate'], journal['importate']) == ('in_corso', 6, 6)
+
+    result = import_utils.import_dataframe(_df(), fingerprint='f' * 64, file_name='gare.csv')
+    assert (result['ripresa_da'], result['importate'], result['saltate'], result['ultimo_errore']) == (6, 4, 0, None)
+    journal = import_utils.import_status('f' * 64)
+    assert (journal['stato'], journal['righe_processate'], journal['importate'], journal['saltate']) == ('completato', 10, 10, 0)
+    assert len(temp_db.get_all_gare()) == 10
+
+def test_completed_file_is_imported_again_from_start(temp_db, monkeypatch):
+    monkeypatch.setattr(import_utils, 'IMPORT_CHUNK_ROWS', 4)
+    import_utils.import_dataframe(_df(), fingerprint='a' * 64)
+    result = import_utils.import_dataframe(_df(), fingerprint='a' * 64) # Reimportazione forzata
+    assert (result['ripresa_da'], result['importate'], result['saltate']) == (0, 0, 10)
+    journal = import_utils.import_status('a' * 64)
+    assert (journal['stato'], journal['importate'], journal['saltate']) == ('completato', 0, 10)
+
+def test_changed_row_count_restarts(temp_db, monkeypatch):
+    monkeypatch.setattr(import_utils, 'IMPORT_CHUNK_ROWS', 3)
+    with monkeypatch.context() as m:
+        _interrupt_after(m, temp_db, 1)
+        import_utils.import_dataframe(_df(), fingerprint='b' * 64)
+    result = import_utils.import_dataframe(_df(12), fingerprint='b' * 64) # Stessa impronta, righe diverse: niente ripresa
+    assert (result['ripresa_da'], result['importate'], result['saltate']) == (0, 9, 3)
+
+def test_batch_of_files_records_each_file(temp_db):
+    loaded = [{'path': name, 'df': _df(n).assign(identificativo_gara=lambda d, p=name: p + d['identificativo_gara']),
+               'righe': n, 'impronta': name * 64, 'messages': [], 'seconds': 0.0} for name, n in [('a', 3), ('b', 5)]]
+    result = import_utils.import_staged(import_utils.stage_loaded(loaded))
+    assert result['importate'] == 8
+    assert [(import_utils.import_status(c * 64)['stato'], import_utils.import_status(c * 64)['importate']) for c in 'ab'] == \
+        [('completato', 3), ('completato', 5)]
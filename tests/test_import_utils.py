@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+import import_utils
+
+CSV = "Codice gara;Importo a base d'asta;Data;Cat\nZ1;100000;2024-01-02;OG1\nZ2;200.000,50;03/02/2024;OG3\n".encode()
+HEADERS = ['codice gara', "importo a base d'asta", 'data', 'cat']
+PROFILE_MAPPING = {'codice gara': 'identificativo_gara', "importo a base d'asta": 'importo_base', 'data': 'data_gara', 'cat': 'categoria_lavori'}
+
+def test_load_bytes_with_profiles_does_not_open_db(tmp_path, monkeypatch):
+    import db_utils
+    db_path = tmp_path / "non_creato.db"
+    monkeypatch.setattr(db_utils, 'DB_FILENAME', str(db_path))
+    db_utils.init_connection.clear()
+    profiles = {import_utils.header_signature(HEADERS): {'nome': 'Fornitore', 'mappatura': PROFILE_MAPPING}}
+    result = import_utils.load_bytes('gare.csv', CSV, profiles=profiles)
+    assert result['mappatura']['origine'] == 'profilo'
+    assert result['df']['identificativo_gara'].tolist() == ['Z1', 'Z2']
+    assert not db_path.exists()
+    assert import_utils.load_bytes('gare.csv', CSV, profiles={})['df'] is None # Senza profilo 'codice gara' non è riconosciuto
+
+def test_load_many_applies_saved_profile_in_workers(temp_db, monkeypatch):
+    monkeypatch.setattr(import_utils, 'PARSE_WORKERS', 2)
+    import_utils.save_mapping_profile(HEADERS, PROFILE_MAPPING, name='Fornitore')
+    try:
+        loaded = import_utils.load_many([('a.csv', CSV), ('b.csv', CSV.replace(b'Z1', b'Z3'))])
+    finally:
+        import_utils.get_parse_executor().shutdown()
+        import_utils.get_parse_executor.clear()
+    assert [item['righe'] for item in loaded] == [2, 2]
+    assert [item['mappatura']['nome_profilo'] for item in loaded] == ['Fornitore', 'Fornitore']
+    assert loaded[1]['df']['identificativo_gara'].tolist() == ['Z3', 'Z2']
+
+def test_import_does_not_touch_db(tmp_path):
+    # L'import dei moduli (es. nei worker 'spawn') non crea né modifica il DB nella cwd
+    code = "import db_utils, import_utils, anac_utils, os; assert not os.path.exists(db_utils.DB_FILENAME)"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', code], cwd=tmp_path, check=True, env={**os.environ, 'PYTHONPATH': root})
+
+def test_normalize_header_and_signature():
+    assert import_utils.normalize_header('Ribasso agg. (%)') == ('ribasso', 'agg', 'percentuale')
+    assert import_utils.normalize_header('Nostro ribasso') == ('mio', 'ribasso')
+    assert import_utils.header_signature(['CIG', 'Importo']) == import_utils.header_signature([' importo', 'cig '])
+    assert import_utils.header_signature(['CIG']) != import_utils.header_signature(['CIG', 'Importo'])
+
+def test_suggest_mapping_matches_variants_and_typos():
+    headers = ['Codice CIG', 'Importo base (€)', 'Data della gara', 'Ribasso aggiudicatario perc', 'Numero concorenti',
+               'Ente appaltante', 'Soglia anomalia', 'Descrizione lavori', 'Colore']
+    result = import_utils.suggest_mapping(headers)
+    assert result['mappatura'] == {
+        'codice cig': 'identificativo_gara', 'importo base (€)': 'importo_base', 'data della gara': 'data_gara',
+        'ribasso aggiudicatario perc': 'ribasso_aggiudicatario_percentuale', 'numero concorenti': 'numero_concorrenti',
+        'ente appaltante': 'stazione_appaltante', 'soglia anomalia': 'soglia_anomalia_calcolata', 'descrizione lavori': 'descrizione'}
+    assert result['ignorate'] == ['colore'] and not result['incerte']
+    assert all(import_utils.MAPPING_MIN_SCORE <= score <= 1.0 for score in result['punteggi'].values())
+
+def test_suggest_mapping_assigns_each_column_once_and_flags_ambiguity():
+    result = import_utils.suggest_mapping(['Importo', 'Importo base'])
+    assert list(result['mappatura'].values()).count('importo_base') == 1
+    assert import_utils.suggest_mapping(['Ribasso %'])['incerte'] == ['ribasso %'] # Mio o dell'aggiudicatario
+
+def test_saved_profile_overrides_suggestion(temp_db):
+    assert import_utils.resolve_mapping(HEADERS)['origine'] == 'automatica'
+    signature = import_utils.save_mapping_profile(HEADERS, {**PROFILE_MAPPING, 'assente': 'note'}, name='Fornitore')
+    info = import_utils.resolve_mapping([h.upper() for h in reversed(HEADERS)]) # Stessa firma: ordine e maiuscole non contano
+    assert (info['firma'], info['origine'], info['nome_profilo'], info['mappatura']) == (signature, 'profilo', 'Fornitore', PROFILE_MAPPING)
+    assert import_utils.load_mapping_profiles()[signature]['mappatura'] == PROFILE_MAPPING # Intestazioni estranee scartate
+    df = import_utils.load_bytes('gare.csv', CSV)['df']
+    assert df['identificativo_gara'].tolist() == ['Z1', 'Z2'] and df['importo_base'].tolist() == [100000.0, 200000.5]
+
+def test_profile_rejects_column_mapped_twice(temp_db):
+    with pytest.raises(ValueError):
+        import_utils.save_mapping_profile(HEADERS, {'codice gara': 'identificativo_gara', 'cat': 'identificativo_gara'})
+
+@pytest.mark.parametrize('col, value, expected', [
+    ('importo base', '1.234.567', 1234567.0), ('importo base', '250.000', 250000.0), ('importo base', '1.234,56', 1234.56),
+    ('importo base', '1,234.56', 1234.56), ('importo base', '€ 140.773,77', 140773.77), ('importo base', '250.5', 250.5),
+    ('importo base', '1234.567', 1234.567), ('importo base', 250.125, 250.125),
+    ('ribasso aggiudicatario', '12.345', 12.345), ('ribasso aggiudicatario', '12,5 %', 12.5), ('ribasso aggiudicatario', '1.234.567', 1234567.0),
+])
+def test_clean_data_number_formats(col, value, expected):
+    df = pd.DataFrame({'CIG': ['Z1'], col: [value]})
+    out = import_utils.clean_data(df, report=lambda level, message: None, profiles={})
+    assert out.drop(columns='identificativo_gara').iloc[0, 0] == pytest.approx(expected)
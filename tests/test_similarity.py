@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import similarity_utils
+
+@pytest.fixture
+def index_path(tmp_path, monkeypatch):
+    """Indice su disco in una directory temporanea, senza indice condiviso in memoria."""
+    monkeypatch.setattr(similarity_utils, 'INDEX_PATH', str(tmp_path / "ml_model" / "similarity_index.joblib"))
+    similarity_utils._index_holder.clear()
+    yield similarity_utils.INDEX_PATH
+    similarity_utils._index_holder.clear()
+
+def _gare(n=2, soglie=None):
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'importo_base': np.linspace(1e5, 1e6, n),
+        'categoria_lavori': ['OG1', 'OG3'] * (n // 2) + ['OG1'] * (n % 2),
+        'stazione_appaltante': 'Comune A',
+        'numero_concorrenti': 10.0,
+        'data_gara': pd.date_range('2024-01-01', periods=n, freq='D'),
+        'descrizione': '',
+        'soglia_anomalia_calcolata': np.nan if soglie is None else soglie,
+    })
+
+BANDO = {'importo_base': 2e5, 'categoria_lavori': 'OG1', 'data_gara': '2024-02-01'}
+
+def test_empty_index_then_first_labelled_gara(index_path):
+    df = _gare()
+    assert similarity_utils.find_similar(df, BANDO).empty
+    df.loc[0, 'soglia_anomalia_calcolata'] = 15.0
+    similar = similarity_utils.find_similar(df, BANDO)
+    assert similar['id'].tolist() == [1] and similar['soglia_anomalia_calcolata'].tolist() == [15.0]
+
+def test_empty_index_reloaded_from_disk(index_path):
+    df = _gare()
+    similarity_utils.find_similar(df, BANDO) # Indice vuoto salvato su disco
+    similarity_utils._index_holder.clear() # Riavvio del server: l'indice viene riletto dal file
+    assert similarity_utils._index_holder()['index']['tree'] is None
+    df.loc[1, 'soglia_anomalia_calcolata'] = 12.0
+    assert similarity_utils.find_similar(df, BANDO)['id'].tolist() == [2]
+    similarity_utils._index_holder.clear()
+    assert similarity_utils._index_holder()['index']['ids'].tolist() == [2] # Ricostruito e salvato
+
+def test_small_changes_go_to_buffer(index_path):
+    df = _gare(40, soglie=np.linspace(10, 20, 40))
+    first = similarity_utils.get_index(df)
+    df.loc[0, 'soglia_anomalia_calcolata'] = 30.0
+    index = similarity_utils.get_index(df)
+    assert index['tree'] is first['tree'] and index['buffer_ids'].tolist() == [1] and not index['valid'][0]
+    similar = similarity_utils.find_similar(df, BANDO, k=40)
+    assert sorted(similar['id']) == list(range(1, 41))
+    assert similar.set_index('id').loc[1, 'soglia_anomalia_calcolata'] == 30.0
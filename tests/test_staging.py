@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+import import_utils
+
+def _cigs(db):
+    return sorted(db.get_all_gare()['identificativo_gara'])
+
+def test_validation_states(temp_db):
+    temp_db.add_gara({'identificativo_gara': 'Z0', 'importo_base': 1000.0})
+    rows = [{'identificativo_gara': 'Z0'}, {'identificativo_gara': 'Z1', 'importo_base': 10.0}, {'identificativo_gara': 'Z1'},
+            {'identificativo_gara': '  '}, {}, {'identificativo_gara': 'Z2'}]
+    name = temp_db.create_staging(rows)
+    assert temp_db.validate_staging(name) == {'valida': 2, 'cig_mancante': 2, 'duplicato_file': 1, 'gia_presente': 1}
+    preview = temp_db.get_staging_preview(name, limit=10)
+    assert preview['stato'].tolist() == ['gia_presente', 'valida', 'duplicato_file', 'cig_mancante', 'cig_mancante', 'valida']
+    assert temp_db.promote_staging(name)['valida'] == 2
+    assert _cigs(temp_db) == ['Z0', 'Z1', 'Z2']
+    assert temp_db.get_all_gare().set_index('identificativo_gara').loc['Z1', 'importo_base'] == 10.0 # Vale la prima occorrenza
+    assert [(riga, state) for riga, _, state in temp_db.get_staging_skipped(name)] == \
+        [(1, 'gia_presente'), (3, 'duplicato_file'), (4, 'cig_mancante'), (5, 'cig_mancante')]
+    temp_db.drop_staging(name)
+
+def test_promotion_revalidates_against_concurrent_writes(temp_db):
+    name = temp_db.create_staging([{'identificativo_gara': 'Z1'}, {'identificativo_gara': 'Z2'}])
+    assert temp_db.validate_staging(name)['valida'] == 2
+    temp_db.add_gara({'identificativo_gara': 'Z2'}) # Scrittura tra anteprima e conferma
+    counts = temp_db.promote_staging(name)
+    assert (counts['valida'], counts['gia_presente']) == (1, 1)
+    assert _cigs(temp_db) == ['Z1', 'Z2']
+    temp_db.drop_staging(name)
+
+def test_appended_rows_are_validated_with_the_first_batch(temp_db):
+    name = temp_db.create_staging()
+    temp_db.append_staging(name, [{'identificativo_gara': 'Z1'}, {'identificativo_gara': 'Z2'}], 1)
+    temp_db.append_staging(name, [{'identificativo_gara': 'Z2'}, {'identificativo_gara': 'Z3'}], 3)
+    assert temp_db.validate_staging(name) == {'valida': 3, 'cig_mancante': 0, 'duplicato_file': 1, 'gia_presente': 0}
+    temp_db.drop_staging(name)
+
+def test_import_dataframe_reports_skipped_rows(temp_db):
+    temp_db.add_gara({'identificativo_gara': 'Z0'})
+    df = pd.DataFrame({'identificativo_gara': ['Z0', 'Z1', 'Z1', None], 'importo_base': [1.0, 2.0, 3.0, 4.0],
+                       'data_gara': pd.to_datetime(['2024-01-01'] * 4)})
+    result = import_utils.import_dataframe(df)
+    assert (result['importate'], result['saltate']) == (1, 3)
+    assert result['cig_saltati'] == ['Z0', 'Z1', '(CIG Mancante)']
+    assert _cigs(temp_db) == ['Z0', 'Z1']
+    assert not [t for t in temp_db.init_connection().execute("SELECT name FROM sqlite_master WHERE name LIKE 'staging_import_%'")]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Misura dei tempi dei percorsi critici (query DB, fasi di importazione, sezioni della dashboard, ML).
+
+Le misure sono raccolte in una "esecuzione" (un rerun dell'app, un comando) aperta con start_run()
+nel thread corrente. Senza esecuzione attiva span(), traced() e count() non fanno nulla (un solo
+controllo su una variabile del thread): i moduli core restano strumentati anche in CLI e worker.
+
+    with trace_utils.span('db.query', righe=10): ...        # blocco misurato (annidabile)
+    @trace_utils.traced('ml.preprocess')                     # funzione misurata
+    trace_utils.section('app.filtri')                        # sezione piatta: chiude la precedente
+    trace_utils.count('import.righe', 500)                   # contatore
+"""
+import time
+import json
+import datetime
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+HISTORY_SIZE = 50 # Esecuzioni concluse conservate per l'esportazione del log
+
+_local = threading.local()
+_history = deque(maxlen=HISTORY_SIZE)
+_history_lock = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+class _Run:
+    """Misure di una esecuzione: span (nome, inizio, durata, profondità, attributi) e contatori."""
+    def __init__(self, name):
+        self.name = name
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.depth = 0
+        self.section = None # (nome, inizio) della sezione aperta con section()
+        self.duration = None
+
+    def add(self, name, start, depth, attrs):
+        self.spans.append({'nome': name, 'inizio_ms': (start - self.start) * 1000,
+                           'durata_ms': (time.perf_counter() - start) * 1000, 'livello': depth, **attrs})
+
+    def close_section(self):
+        if self.section is not None:
+            name, start = self.section
+            self.add(name, start, 0, {})
+            self.section = None
+
+    def to_dict(self):
+        return {'esecuzione': self.name, 'inizio': self.started_at.isoformat(timespec='milliseconds'),
+                'durata_ms': self.duration, 'span': self.spans, 'contatori': self.counters}
+
+def _current():
+    return getattr(_local, 'run', None)
+
+def is_active() -> bool:
+    return _current() is not None
+
+def start_run(name="esecuzione", enabled=True):
+    """Apre una nuova esecuzione nel thread corrente (sostituisce quella eventualmente non chiusa)."""
+    _local.run = _Run(name) if enabled else None
+    return _local.run
+
+def end_run():
+    """Chiude l'esecuzione corrente, la aggiunge allo storico e la ritorna (None se non attiva)."""
+    run = _current()
+    if run is None: return None
+    run.close_section()
+    run.duration = (time.perf_counter() - run.start) * 1000
+    _local.run = None
+    with _history_lock: _history.append(run)
+    return run
+
+@contextmanager
+def _span(run, name, attrs):
+    start = time.perf_counter()
+    run.depth += 1
+    try:
+        yield
+    finally:
+        run.depth -= 1
+        run.add(name, start, run.depth + (1 if run.section else 0), attrs)
+
+def span(name, **attrs):
+    """Context manager che misura un blocco (no-op senza esecuzione attiva)."""
+    run = _current()
+    if run is None: return _NULL_SPAN
+    return _span(run, name, attrs)
+
+def traced(name=None):
+    """Decoratore: misura ogni chiamata della funzione come span (nome di default: modulo.funzione)."""
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__name__}"
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            run = _current()
+            if run is None: return func(*args, **kwargs)
+            with _span(run, span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def section(name):
+    """
+    Inizia una sezione di primo livello chiudendo la precedente: utile per script lunghi (l'app)
+    dove un blocco with richiederebbe di reindentare intere sezioni. end_run() chiude l'ultima.
+    """
+    run = _current()
+    if run is None: return
+    run.close_section()
+    run.section = (name, time.perf_counter())
+
+def count(name, value=1):
+    """Incrementa un contatore dell'esecuzione corrente."""
+    run = _current()
+    if run is None: return
+    run.counters[name] = run.counters.get(name, 0) + value
+
+def summary(run) -> list:
+    """Span aggregati per nome: chiamate, tempo totale e massimo (ms), quota sul totale dell'esecuzione."""
+    totals = {}
+    for s in sorted(run.spans, key=lambda s: s['inizio_ms']): # Ordine di inizio: sezioni nell'ordine della pagina, figli dopo i padri
+        entry = totals.setdefault(s['nome'], {'nome': s['nome'], 'livello': s['livello'], 'chiamate': 0, 'totale_ms': 0.0, 'max_ms': 0.0})
+        entry['chiamate'] += 1; entry['totale_ms'] += s['durata_ms']; entry['max_ms'] = max(entry['max_ms'], s['durata_ms'])
+        entry['livello'] = min(entry['livello'], s['livello'])
+    total = run.duration or (time.perf_counter() - run.start) * 1000
+    for entry in totals.values():
+        entry['quota_%'] = entry['totale_ms'] / total * 100 if total else 0.0
+    return list(totals.values())
+
+def history() -> list:
+    with _history_lock: return list(_history)
+
+def export_jsonl(runs=None) -> str:
+    """Esecuzioni (default: tutto lo storico) in formato JSON Lines, una per riga."""
+    runs = history() if runs is None else runs
+    return "\n".join(json.dumps(run.to_dict(), ensure_ascii=False, default=str) for run in runs) + ("\n" if runs else "")
+
+def clear_history():
+    with _history_lock: _history.clear()